@@ -1,8 +1,30 @@
 
 import logging
+import os
+import pickle
+import re
+import sqlite3
+import sys
+import zlib
 
-from time import time
+from ast import literal_eval
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from collections import OrderedDict, deque
 
+try:
+    from collections.abc import Mapping
+except ImportError:  # Python 2
+    from collections import Mapping
+try:
+    from queue import Empty, Queue
+except ImportError:  # Python 2
+    from Queue import Empty, Queue
+from random import choice, random
+from threading import BoundedSemaphore, Event, Lock, Thread, local
+from time import gmtime, strftime, time
+from weakref import WeakKeyDictionary
+
+from pyramid.authentication import AuthTktAuthenticationPolicy
 from pyramid.exceptions import ConfigurationError
 
 try:
@@ -14,19 +36,41 @@ except ImportError:  # pragma: no cover
         LEVEL = None
         SUBTREE = None
         REUSABLE = None
+        ServerPool = object
     ldap3 = _Ldap3Module()
-    LDAPException = Exception
+    LDAPException = LDAPBindError = _LDAPResponseTimeoutError = Exception
+    _server_errors = ()
 else:
     LDAPException = ldap3.core.exceptions.LDAPException
+    LDAPBindError = ldap3.core.exceptions.LDAPBindError
+    _LDAPResponseTimeoutError = ldap3.core.exceptions.LDAPResponseTimeoutError
+    # errors indicating that the server itself has a problem
+    _server_errors = (
+        ldap3.core.exceptions.LDAPCommunicationError,
+        _LDAPResponseTimeoutError)
 
 logger = logging.getLogger(__name__)
 
+
+class LDAPCircuitOpenError(LDAPException):
+    """The LDAP server seems to be unreachable and is not contacted."""
+
+
 _ord = ord if str is bytes else int
 
+# interning is only possible for native strings, i.e. not on Python 2
+_intern = getattr(sys, 'intern', lambda s: s)
+
 _escape_for_search = {
     '*': '\\2A', '(': '\\28', ')': '\\29', '\\': '\\5C', '\0': '\\00'}
 
-__all__ = ['get_ldap_connector', 'get_groups', 'groupfinder']
+_escape_for_dn = dict((c, '\\' + c) for c in ',+"\\<>;=')
+_escape_for_dn['\0'] = '\\00'
+
+__all__ = [
+    'CacheBackend', 'SQLiteCacheBackend', 'LDAPAuthTktAuthenticationPolicy',
+    'LDAPCircuitOpenError', 'authenticate_realms', 'get_ldap_connector',
+    'get_groups', 'groupfinder']
 
 
 def escape_for_search(s):
@@ -41,76 +85,2125 @@ def escape_for_search(s):
     return ''.join((_escape_for_search.get(c, c) for c in s))
 
 
+def escape_for_dn(s):
+    """Escape attribute value for a DN according to RFC4514."""
+    if not s:
+        return s
+    if isinstance(s, bytes):
+        try:
+            s = s.decode('utf-8')
+        except UnicodeDecodeError:
+            return ''.join('\\%02x' % _ord(b) for b in s)
+    chars = [_escape_for_dn.get(c, c) for c in s]
+    if chars[0] in (' ', '#'):
+        chars[0] = '\\' + chars[0]
+    if chars[-1] == ' ':
+        chars[-1] = '\\ '
+    return ''.join(chars)
+
+
+def _sizeof(obj):
+    """Estimate the memory used by a cached query result in bytes."""
+    size = sys.getsizeof(obj)
+    if isinstance(obj, _LDAPAttributes):
+        size += _sizeof(obj._items)
+    elif isinstance(obj, Mapping):
+        size += sum(_sizeof(k) + _sizeof(v) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(_sizeof(v) for v in obj)
+    return size
+
+
+class CacheBackend(object):
+    """Base class for backends storing cached query results.
+
+    A cache backend provides a separate cache for every query through its
+    :meth:`cache` method.  The caches must provide the methods ``lookup``,
+    ``set``, ``delete``, ``clear`` and ``items`` like the caches returned
+    by the :class:`SQLiteCacheBackend`.  Caches which cannot list their
+    contents may raise a ``NotImplementedError`` in ``items``; cached
+    results can then not be invalidated when tracking changes.
+    """
+
+    def cache(self, name, max_entries=0, max_bytes=0, jitter=0):
+        """Get the cache with the given name.
+
+        The cache should evict entries when it holds more than
+        ``max_entries`` entries or more than ``max_bytes`` bytes, and
+        randomly shorten their lifetime by up to the fraction ``jitter``.
+        """
+        raise NotImplementedError
+
+
+class _Cache(object):
+    """Base class for the caches provided by the cache backends."""
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def get(self, key, now=None):
+        """Get an unexpired value from the cache or None."""
+        if now is None:
+            now = time()
+        entry = self.lookup(key, now)
+        if entry is None or entry[1] <= now:
+            return None
+        return entry[0]
+
+
+class _LDAPCache(_Cache):
+    """In-RAM cache for LDAP query results.
+
+    Every entry expires individually after the period it has been stored
+    with, optionally shortened by a random jitter, so that entries stored
+    at the same time do not all expire at the same instant.  If more than
+    ``max_entries`` entries are stored or their estimated size exceeds
+    ``max_bytes``, the least recently used entries are evicted.
+    A value of 0 for ``max_entries`` or ``max_bytes`` means no limit.
+    The ``jitter`` is the maximum fraction of the period by which the
+    lifetime of an entry may be shortened.  Entries can be kept in the cache
+    for some time after they expired, so that they can still be looked up
+    as stale entries.
+    """
+
+    def __init__(self, max_entries=0, max_bytes=0, jitter=0):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.jitter = jitter
+        self.size = 0
+        # key -> (value, expires, keep until, size)
+        self.entries = OrderedDict()
+        self.lock = Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def lookup(self, key, now=None):
+        """Get a value and its expiry time from the cache or None.
+
+        The returned value may be stale if it has been stored with a
+        keep period and has not yet been removed from the cache.
+        """
+        if now is None:
+            now = time()
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                return None
+            if entry[2] <= now:
+                self.size -= entry[3]
+                return None
+            self.entries[key] = entry  # mark as most recently used
+        return entry[:2]
+
+    def set(self, key, value, period, now=None, keep=0):
+        """Store a value in the cache for the given period in seconds.
+
+        If ``keep`` is given, the expired value is kept in the cache for
+        that many seconds after the period as a stale value.
+        """
+        if now is None:
+            now = time()
+        if self.jitter:
+            period *= 1 - self.jitter * random()
+        expires = now + period
+        size = _sizeof(value) if self.max_bytes else 0
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self.size -= entry[3]
+            self.entries[key] = value, expires, expires + keep, size
+            self.size += size
+            self._evict()
+
+    def items(self):
+        """Get a list of all keys and values in the cache."""
+        with self.lock:
+            return [(key, entry[0]) for key, entry in self.entries.items()]
+
+    def delete(self, key):
+        """Remove a value from the cache."""
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self.size -= entry[3]
+
+    def clear(self):
+        """Remove all values from the cache."""
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def _evict(self):
+        entries = self.entries
+        max_entries, max_bytes = self.max_entries, self.max_bytes
+        while entries and (
+                (max_entries and len(entries) > max_entries) or
+                (max_bytes and self.size > max_bytes)):
+            key, entry = entries.popitem(last=False)
+            self.size -= entry[3]
+            logger.debug('evicting %r from cache', key)
+
+
+class _StripedLDAPCache(_Cache):
+    """In-RAM cache for LDAP query results, striped over several shards.
+
+    The entries are distributed over the given number of ``shards`` by the
+    hash values of their keys.  Every shard is an :class:`_LDAPCache` with
+    its own lock, so that threads using different shards do not block each
+    other.  The limits for the number of entries and their size are split
+    evenly between the shards, and entries are evicted per shard.
+    """
+
+    def __init__(self, max_entries=0, max_bytes=0, jitter=0, shards=16):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.jitter = jitter
+        self.shards = tuple(_LDAPCache(
+            -(-max_entries // shards), -(-max_bytes // shards), jitter)
+            for _shard in range(shards))
+
+    def __len__(self):
+        return sum(len(shard) for shard in self.shards)
+
+    def shard(self, key):
+        """Get the shard for the given key."""
+        shards = self.shards
+        return shards[hash(key) % len(shards)]
+
+    def lookup(self, key, now=None):
+        return self.shard(key).lookup(key, now)
+
+    def set(self, key, value, period, now=None, keep=0):
+        self.shard(key).set(key, value, period, now, keep)
+
+    def items(self):
+        return [item for shard in self.shards for item in shard.items()]
+
+    def delete(self, key):
+        self.shard(key).delete(key)
+
+    def clear(self):
+        for shard in self.shards:
+            shard.clear()
+
+
+# Striping the cache only pays off without the global interpreter lock,
+# otherwise only one thread can access the cache at a time anyway.
+_is_gil_enabled = getattr(sys, '_is_gil_enabled', None)
+_CACHE_SHARDS = 1 if _is_gil_enabled is None or _is_gil_enabled() else 16
+
+
+def _new_cache(max_entries=0, max_bytes=0, jitter=0):
+    """Create an in-RAM cache suitable for the current interpreter."""
+    if _CACHE_SHARDS > 1:
+        return _StripedLDAPCache(max_entries, max_bytes, jitter, _CACHE_SHARDS)
+    return _LDAPCache(max_entries, max_bytes, jitter)
+
+
+class SQLiteCacheBackend(CacheBackend):
+    """Cache backend storing query results in an SQLite database.
+
+    The database is stored in a file at the given ``path`` on the local
+    disk, so that the cached results can be shared by all worker processes
+    running on the same node, without the need for an external service.
+    The cached results are pickled, so the file must only be writable by
+    the application.  Every thread in every process uses its own connection
+    to the database, and ``timeout`` is the number of seconds to wait for
+    the database when it is locked by another connection.  Errors when
+    accessing the database are logged, but otherwise ignored.
+    """
+
+    def __init__(self, path, timeout=5):
+        self.path = path
+        self.timeout = timeout
+        self.local = local()
+
+    def __str__(self):
+        return 'SQLite cache at {}'.format(self.path)
+
+    def connection(self):
+        """Get the database connection for the current thread and process."""
+        pid = os.getpid()
+        conn = getattr(self.local, 'conn', None)
+        if conn is None or self.local.pid != pid:
+            conn = sqlite3.connect(
+                self.path, timeout=self.timeout, isolation_level=None)
+            conn.execute('pragma journal_mode=wal')
+            # with WAL, this is safe and avoids syncing every transaction
+            conn.execute('pragma synchronous=normal')
+            conn.execute(
+                'create table if not exists pyramid_ldap3_cache ('
+                'name text, key text, value blob, size integer,'
+                ' expires real, keep real, used real,'
+                ' primary key (name, key))')
+            conn.execute(
+                'create index if not exists pyramid_ldap3_cache_used'
+                ' on pyramid_ldap3_cache (name, used)')
+            self.local.conn, self.local.pid = conn, pid
+        return conn
+
+    def cache(self, name, max_entries=0, max_bytes=0, jitter=0):
+        return _SQLiteCache(self, name, max_entries, max_bytes, jitter)
+
+
+class _SQLiteCache(_Cache):
+    """A cache with the given name stored in an SQLite database.
+
+    Noting the time when an entry has been used requires a write, so this
+    is only done when the time is older than a fraction ``touch`` of the
+    remaining lifetime of the entry.
+    """
+
+    touch = 0.1
+
+    def __init__(self, backend, name, max_entries=0, max_bytes=0, jitter=0):
+        self.backend = backend
+        self.name = name
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.jitter = jitter
+
+    def __len__(self):
+        try:
+            return self.backend.connection().execute(
+                'select count(*) from pyramid_ldap3_cache where name=?',
+                (self.name,)).fetchone()[0]
+        except sqlite3.Error:
+            logger.warning('cannot access the cache', exc_info=True)
+            return 0
+
+    def lookup(self, key, now=None):
+        """Get a value and its expiry time from the cache or None."""
+        if now is None:
+            now = time()
+        args = (self.name, repr(key))
+        try:
+            conn = self.backend.connection()
+            row = conn.execute(
+                'select value, expires, keep, used from pyramid_ldap3_cache'
+                ' where name=? and key=?', args).fetchone()
+            if row is None:
+                return None
+            value, expires, keep, used = row
+            if keep <= now:
+                conn.execute(
+                    'delete from pyramid_ldap3_cache'
+                    ' where name=? and key=?', args)
+                return None
+            if now - used > (expires - used) * self.touch:
+                conn.execute(
+                    'update pyramid_ldap3_cache set used=?'
+                    ' where name=? and key=?', (now,) + args)
+            return pickle.loads(bytes(value)), expires
+        except (sqlite3.Error, pickle.UnpicklingError):
+            logger.warning('cannot access the cache', exc_info=True)
+            return None
+
+    def set(self, key, value, period, now=None, keep=0):
+        """Store a value in the cache for the given period in seconds."""
+        if now is None:
+            now = time()
+        if self.jitter:
+            period *= 1 - self.jitter * random()
+        expires = now + period
+        value = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        name = self.name
+        try:
+            conn = self.backend.connection()
+            conn.execute(
+                'insert or replace into pyramid_ldap3_cache'
+                ' (name, key, value, size, expires, keep, used)'
+                ' values (?, ?, ?, ?, ?, ?, ?)',
+                (name, repr(key), sqlite3.Binary(value), len(value),
+                 expires, expires + keep, now))
+            conn.execute(
+                'delete from pyramid_ldap3_cache'
+                ' where name=? and keep<=?', (name, now))
+            if not (self.max_entries or self.max_bytes):
+                return
+            num, size = conn.execute(
+                'select count(*), sum(size) from pyramid_ldap3_cache'
+                ' where name=?', (name,)).fetchone()
+            if self.max_entries and num > self.max_entries:
+                conn.execute(
+                    'delete from pyramid_ldap3_cache where name=? and key in'
+                    ' (select key from pyramid_ldap3_cache where name=?'
+                    ' order by used desc limit -1 offset ?)',
+                    (name, name, self.max_entries))
+            if self.max_bytes and size > self.max_bytes:
+                size = 0
+                evict = []
+                for key, key_size in conn.execute(
+                        'select key, size from pyramid_ldap3_cache'
+                        ' where name=? order by used desc', (name,)):
+                    size += key_size
+                    if size > self.max_bytes:
+                        evict.append((name, key))
+                conn.executemany(
+                    'delete from pyramid_ldap3_cache'
+                    ' where name=? and key=?', evict)
+        except sqlite3.Error:
+            logger.warning('cannot access the cache', exc_info=True)
+
+    def delete(self, key):
+        """Remove a value from the cache."""
+        try:
+            self.backend.connection().execute(
+                'delete from pyramid_ldap3_cache where name=? and key=?',
+                (self.name, repr(key)))
+        except sqlite3.Error:
+            logger.warning('cannot access the cache', exc_info=True)
+
+    def clear(self):
+        """Remove all values from the cache."""
+        try:
+            self.backend.connection().execute(
+                'delete from pyramid_ldap3_cache where name=?', (self.name,))
+        except sqlite3.Error:
+            logger.warning('cannot access the cache', exc_info=True)
+
+    def items(self):
+        """Get a list of all keys and values in the cache."""
+        try:
+            rows = self.backend.connection().execute(
+                'select key, value from pyramid_ldap3_cache where name=?',
+                (self.name,)).fetchall()
+        except sqlite3.Error:
+            logger.warning('cannot access the cache', exc_info=True)
+            return []
+        return [(literal_eval(key), pickle.loads(bytes(value)))
+                for key, value in rows]
+
+
+def _start_thread(target, name):
+    """Run the given function in a background thread."""
+    thread = Thread(target=target, name=name)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+class _WorkerPool(object):
+    """A fixed number of daemon threads running the submitted functions.
+
+    The threads are only started when functions are submitted, and are
+    started again in forked processes.  Functions that are submitted while
+    all threads are busy wait in a queue.  Functions submitted with
+    :meth:`submit_once` are dropped if ``max_queued`` functions are already
+    waiting.
+    """
+
+    def __init__(self, size, name, max_queued=0):
+        self.size = size
+        self.name = name
+        self.max_queued = max_queued
+        self.lock = Lock()
+        self.tasks = Queue()
+        self.keys = set()
+        self.threads = 0
+        self.pid = os.getpid()
+
+    def __str__(self):
+        return 'size={size}, threads={threads}, queued={queued}'.format(
+            queued=self.tasks.qsize(), **self.__dict__)
+
+    def submit(self, func, *args):
+        """Run the given function with the given arguments in a thread."""
+        with self.lock:
+            tasks = self._start()
+        tasks.put((func, args))
+
+    def submit_once(self, key, func, *args):
+        """Run the given function in a thread unless it is already pending.
+
+        Functions are considered identical if they are using the same key.
+        Returns whether the function has been submitted.
+        """
+        with self.lock:
+            tasks = self._start()
+            if key in self.keys or (
+                    self.max_queued and tasks.qsize() >= self.max_queued):
+                return False
+            self.keys.add(key)
+        tasks.put((self._run_once, (key, func) + args))
+        return True
+
+    def _start(self):
+        """Start another thread if needed and return the queue of tasks."""
+        if self.pid != os.getpid():
+            # the threads of the parent process do not exist in the child
+            self.pid = os.getpid()
+            self.tasks = Queue()
+            self.keys = set()
+            self.threads = 0
+        tasks = self.tasks
+        if self.threads < self.size:
+            self.threads += 1
+            _start_thread(lambda: self.run(tasks), self.name)
+        return tasks
+
+    def _run_once(self, key, func, *args):
+        try:
+            func(*args)
+        finally:
+            with self.lock:
+                self.keys.discard(key)
+
+    @staticmethod
+    def run(tasks):
+        while True:
+            func, args = tasks.get()
+            try:
+                func(*args)
+            except Exception:  # pragma: no cover
+                logger.exception('error in worker thread')
+
+
+_PAGED_RESULTS_OID = '1.2.840.113556.1.4.319'
+
+
+# attribute options used for retrieving values in ranges
+_range_option = re.compile(r'^(.+);range=(\d+)-(\d+|\*)$', re.I)
+
+
+def _get_ranges(conn, response):
+    """Retrieve the missing values of attributes returned in ranges.
+
+    Active Directory returns only a limited number of the values of large
+    multi-valued attributes like ``member``, using attribute names such as
+    ``member;range=0-1499``.  The remaining values are fetched with further
+    searches, which are sent for all entries before waiting for the results,
+    and are stored under the plain attribute name in the given response.
+    The connection must use an asynchronous or pooled strategy.
+    """
+    pending = []
+    for r in response or ():
+        if 'dn' not in r:
+            continue
+        # the same ranges are returned as decoded and as raw values
+        ranges = OrderedDict()
+        for field in 'attributes', 'raw_attributes':
+            attributes = r.get(field)
+            for key in list(attributes or ()):
+                match = _range_option.match(key)
+                if match:
+                    name, end = match.group(1), match.group(3)
+                    values = attributes[name] = list(attributes.pop(key))
+                    item = ranges.setdefault(name.lower(), (name, {}, end))
+                    item[1][field] = values
+        for name, fields, end in ranges.values():
+            if end != '*':
+                pending.append((r['dn'], name, fields, int(end) + 1))
+    while pending:
+        ids = []
+        for item in pending:
+            dn, name, fields, start = item
+            logger.debug(
+                'retrieving values of %s from %d for %r', name, start, dn)
+            ids.append((item, conn.search(
+                dn, '(objectClass=*)', search_scope=ldap3.BASE,
+                attributes=['{};range={:d}-*'.format(name, start)])))
+        pending = []
+        for (dn, name, fields, start), ret in ids:
+            more, ret = conn.get_response(ret)
+            end = None
+            for r in more or ():
+                for field, values in fields.items():
+                    for key, value in (r.get(field) or {}).items():
+                        match = _range_option.match(key)
+                        if match and match.group(1).lower() == name.lower():
+                            values.extend(value)
+                            if value:
+                                end = match.group(3)
+            if end is not None and end != '*':
+                pending.append((dn, name, fields, int(end) + 1))
+    return response
+
+
+def _paged_search(conn, base_dn, filter_str, scope, attributes, page_size,
+                  time_limit=0):
+    """Search using the paged results control and yield all responses.
+
+    The responses are fetched page by page, with ``page_size`` entries per
+    page.  The connection must use an asynchronous or pooled strategy.
+    A ``time_limit`` in seconds can be set for every page.
+    """
+    cookie = None
+    while True:
+        ret = conn.search(
+            base_dn, filter_str, search_scope=scope, attributes=attributes,
+            paged_size=page_size, paged_cookie=cookie, time_limit=time_limit)
+        response, result = conn.get_response(ret)
+        for r in _get_ranges(conn, response) or ():
+            yield r
+        try:
+            cookie = result['controls'][_PAGED_RESULTS_OID]['value'][
+                'cookie']
+        except (KeyError, TypeError):
+            cookie = None
+        if not cookie:
+            break
+
+
+class _Flight(object):
+    """A call that is currently in flight."""
+
+    def __init__(self):
+        self.done = Event()
+        self.waiters = 0
+        self.result = self.exc = None
+
+
+class _SingleFlight(object):
+    """Coalesces identical concurrent calls.
+
+    While a call with a given key is in flight, other callers using the same
+    key do not make the call again, but wait for its result or exception.
+    If the call is aborted by an exception that is not an ``Exception``,
+    the waiters get an ``LDAPException`` instead.
+    """
+
+    def __init__(self):
+        self.flights = {}
+        self.lock = Lock()
+
+    def __len__(self):
+        return len(self.flights)
+
+    def __contains__(self, key):
+        return key in self.flights
+
+    def call(self, key, func, *args, **kw):
+        with self.lock:
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = _Flight()
+            else:
+                flight.waiters += 1
+        if not leader:
+            logger.debug('waiting for call in flight for %r', key)
+            flight.done.wait()
+            if flight.exc is not None:
+                raise flight.exc
+            return flight.result
+        try:
+            flight.result = func(*args, **kw)
+        except Exception as exc:
+            flight.exc = exc
+            raise
+        except BaseException:
+            # interrupts of the leader are not passed on to the waiters
+            flight.exc = LDAPException(
+                'call in flight for {!r} was aborted'.format(key))
+            raise
+        finally:
+            with self.lock:
+                del self.flights[key]
+            flight.done.set()
+        return flight.result
+
+
+class _LDAPAttributes(Mapping):
+    """Compact, immutable mapping of attribute names to values.
+
+    Attribute names are looked up ignoring their case.  Only the attributes
+    with the given ``names`` are kept if names are given.  The names are
+    interned, and lists of values are stored as tuples.
+    """
+
+    __slots__ = ('_items',)
+
+    def __init__(self, attributes=(), names=None):
+        if isinstance(attributes, Mapping):
+            attributes = attributes.items()
+        if names is not None:
+            names = set(name.lower() for name in names)
+        self._items = tuple(
+            (_intern(str(key)), tuple(value)
+             if isinstance(value, list) else value)
+            for key, value in attributes
+            if names is None or key.lower() in names)
+
+    def __getitem__(self, key):
+        for name, value in self._items:
+            if name == key:
+                return value
+        key = key.lower()
+        for name, value in self._items:
+            if name.lower() == key:
+                return value
+        raise KeyError(key)
+
+    def __iter__(self):
+        return (name for name, value in self._items)
+
+    def __len__(self):
+        return len(self._items)
+
+    def __repr__(self):
+        return repr(dict(self._items))
+
+    def __reduce__(self):
+        return self.__class__, (self._items,)
+
+
+class _LDAPEntry(tuple):
+    """Compact, immutable query result entry.
+
+    The entry is a tuple of the DN and the attributes of the entry.
+    """
+
+    __slots__ = ()
+
+    def __new__(cls, dn, attributes):
+        return tuple.__new__(cls, (_intern(dn), attributes))
+
+    def __getnewargs__(self):
+        return tuple(self)
+
+    @property
+    def dn(self):
+        return self[0]
+
+    @property
+    def attributes(self):
+        return self[1]
+
+
+# the clause of the groups filter template matching the user DN
+_member_clause = re.compile(r'\(([A-Za-z][\w.;-]*)=%\(userdn\)s\)')
+
+# upper limit for the length of filters used for batched group searches
+_MAX_FILTER_LENGTH = 8000
+
+
 class _LDAPQuery(object):
     """Represents an LDAP query.
 
     Provides rudimentary in-RAM caching of query results.
+
+    If a ``stale_period`` is set, expired results are still returned for
+    that many seconds while they are refreshed in a background thread.
+    If a ``stale_if_error`` period is set, expired results are returned
+    for that many seconds if the LDAP server cannot be queried.
+
+    If a ``negative_cache_period`` is set, empty results are cached
+    separately for that many seconds, in a cache holding at most
+    ``negative_cache_size`` entries.
+
+    If a ``page_size`` is set, the results are fetched page by page using
+    the paged results control.  A ``time_limit`` in seconds can be set for
+    the searches on the server side.
+
+    If ``compact`` is set, the results are returned and cached as tuples of
+    immutable entries which hold only the requested attributes.
     """
 
-    def __init__(self, base_dn, filter_tmpl, scope, attributes, cache_period):
+    def __init__(self, base_dn, filter_tmpl, scope, attributes, cache_period,
+                 cache_size=10000, cache_bytes=0, cache_jitter=0,
+                 stale_period=0, stale_if_error=0,
+                 negative_cache_period=0, negative_cache_size=1000,
+                 page_size=0, time_limit=0, compact=False):
         self.base_dn = base_dn
         self.filter_tmpl = filter_tmpl
         self.scope = scope
         self.attributes = attributes
+        self.compact = compact
+        self.page_size = page_size
+        self.time_limit = time_limit
         self.cache_period = cache_period
-        self.last_timeslice = 0
-        self.cache = {}
+        self.stale_period = stale_period
+        self.stale_if_error = stale_if_error
+        self.negative_cache_period = negative_cache_period
+        self.cache = _new_cache(cache_size, cache_bytes, cache_jitter)
+        self.negative_cache = _new_cache(negative_cache_size)
+        self.flights = _SingleFlight()
+        self.graph = self.dn_query = None
+        self.member_clause = self.member_attribute = None
+        if filter_tmpl and filter_tmpl.count('%(') == 1 and not (
+                base_dn and '%(' in base_dn):
+            match = _member_clause.search(filter_tmpl)
+            if match:
+                self.member_clause = match.group(0)
+                self.member_attribute = match.group(1)
 
     def __str__(self):
-        return ('base_dn={base_dn}, filter_tmpl={filter_tmpl}, '
-                'scope={scope}, attributes={attributes}, '
-                'cache_period={cache_period}'.format(**self.__dict__))
+        s = ('base_dn={base_dn}, filter_tmpl={filter_tmpl}, '
+             'scope={scope}, attributes={attributes}, '
+             'cache_period={cache_period}, cache_size={cache_size}, '
+             'cache_bytes={cache_bytes}, cache_jitter={cache_jitter}, '
+             'stale_period={stale_period}, '
+             'stale_if_error={stale_if_error}, '
+             'negative_cache_period={negative_cache_period}, '
+             'negative_cache_size={negative_cache_size}, '
+             'page_size={page_size}, time_limit={time_limit}, '
+             'compact={compact}'
+             .format(cache_size=self.cache.max_entries,
+                     cache_bytes=self.cache.max_bytes,
+                     cache_jitter=self.cache.jitter,
+                     negative_cache_size=self.negative_cache.max_entries,
+                     **self.__dict__))
+        if self.graph is not None:
+            s += ', nested=({})'.format(self.graph)
+        return s
 
     def query_cache(self, cache_key):
-        now = time()
-        ts = _timeslice(self.cache_period, now)
+        return self.cache.get(cache_key)
 
-        if ts > self.last_timeslice:
-            logger.debug(
-                'dumping cache; now ts: %r, last_ts: %r',
-                ts, self.last_timeslice)
-            self.cache = {}
-            self.last_timeslice = ts
+    def cached(self, **kw):
+        """Get the result of the query if it can be taken from the cache.
 
-        return self.cache.get(cache_key)
+        Returns ``None`` if the result is not cached or has expired, i.e.
+        if executing the query would need to search the LDAP server.
+        """
+        cache_key = (self.base_dn % kw, self.filter_tmpl % kw)
+        if self.cache_period:
+            result = self.cache.get(cache_key)
+            if result is not None:
+                return result
+        if self.negative_cache_period:
+            if self.negative_cache.get(cache_key) is not None:
+                return []
+        return None
+
+    def use_cache(self, backend, name):
+        """Use a cache with the given name from the given cache backend."""
+        cache = self.cache
+        self.cache = backend.cache(
+            name, cache.max_entries, cache.max_bytes, cache.jitter)
+        self.negative_cache = backend.cache(
+            name + '_negative', self.negative_cache.max_entries)
+        if self.graph is not None:
+            self.graph.use_cache(backend, name + '_nested')
+        if self.dn_query is not None:
+            self.dn_query.use_cache(backend, name + '_dns')
 
     def execute(self, manager, **kw):
         cache_key = (self.base_dn % kw, self.filter_tmpl % kw)
 
         logger.debug('searching for %r', cache_key)
 
-        result = self.query_cache(cache_key) if self.cache_period else None
+        result, stale = self.lookup(manager, cache_key)
         if result is None:
+            try:
+                result = self.search_once(manager, cache_key)
+            except LDAPException:
+                if stale is None:
+                    raise
+                logger.warning(
+                    'search for %r failed, using stale result',
+                    cache_key, exc_info=True)
+                result = stale
+
+        logger.debug('search result: %r', result)
+
+        return result
+
+    def lookup(self, manager, cache_key):
+        """Look up the result for the given cache key in the cache.
+
+        Returns the result that can be used, or ``None`` if the LDAP server
+        must be searched, together with the expired result that may be used
+        if the search fails.  Stale results are refreshed in the background.
+        """
+        result = expires = None
+        if self.cache_period:
+            entry = self.cache.lookup(cache_key)
+            if entry is not None:
+                result, expires = entry
+        if result is None:
+            if self.negative_cache_period:
+                if self.negative_cache.get(cache_key) is not None:
+                    logger.debug(
+                        'empty result for %r retrieved from cache', cache_key)
+                    return [], None
+            return None, None
+        now = time()
+        if expires > now:
+            logger.debug('result for %r retrieved from cache', cache_key)
+            return result, None
+        if self.stale_period and expires + self.stale_period > now:
+            logger.debug(
+                'stale result for %r retrieved from cache', cache_key)
+            self.refresh(manager, cache_key)
+            return result, None
+        if self.stale_if_error and expires + self.stale_if_error > now:
+            return None, result
+        return None, None
+
+    def search_once(self, manager, cache_key):
+        """Search unless an identical search is already running."""
+        return self.flights.call(cache_key, self.search, manager, cache_key)
+
+    def refresh(self, manager, cache_key):
+        """Refresh a cached result in the background.
+
+        The refresh is run by the refresh workers of the manager.  It is
+        dropped if too many refreshes are already waiting for a worker.
+        """
+        if cache_key in self.flights:
+            return
+        if not manager.refresh_workers.submit_once(
+                (self, cache_key), self._refresh, manager, cache_key):
+            logger.debug('not refreshing %r now', cache_key)
+
+    def _refresh(self, manager, cache_key):
+        try:
+            self.search_once(manager, cache_key)
+        except LDAPException:
+            logger.warning('refreshing %r failed', cache_key, exc_info=True)
+
+    def search(self, manager, cache_key):
+        """Search the LDAP server and cache the result."""
+        if self.page_size:
+            with manager.paged_connection() as conn:
+                result = self.convert(_paged_search(
+                    conn, cache_key[0], cache_key[1], self.scope,
+                    self.attributes, self.page_size, self.time_limit))
+        else:
             with manager.connection() as conn:
-                ret = conn.search(
-                    search_scope=self.scope,
-                    attributes=self.attributes, *cache_key)
-                result, ret = conn.get_response(ret)
+                kw = dict(search_scope=self.scope, attributes=self.attributes)
+                if self.time_limit:
+                    kw['time_limit'] = self.time_limit
+                ret = conn.search(*cache_key, **kw)
+                hedger = getattr(manager, 'hedger', None)
+                if hedger is None:
+                    result, ret = conn.get_response(ret)
+                else:
+                    result, ret = hedger.get_response(
+                        conn, ret, *cache_key, **kw)
+                if result is not None:
+                    result = self.convert(_get_ranges(conn, result))
+        return self.store(cache_key, result)
+
+    def iterate(self, manager, page_size=None, **kw):
+        """Yield the query results one by one.
+
+        The results are not cached, but fetched from the LDAP server page by
+        page while iterating, with ``page_size`` entries per page (by default
+        the page size of the query or 500), so that the memory usage does not
+        depend on the number of results.
+        """
+        base_dn, filter_str = self.base_dn % kw, self.filter_tmpl % kw
+        with manager.paged_connection() as conn:
+            for r in _paged_search(
+                    conn, base_dn, filter_str, self.scope, self.attributes,
+                    page_size or self.page_size or 500, self.time_limit):
+                for result in self.convert([r]):
+                    yield result
+
+    def store(self, cache_key, result):
+        """Cache the given query result."""
+        if not result and self.negative_cache_period:
+            # empty results are cached separately
+            self.cache.delete(cache_key)
+            self.negative_cache.set(
+                cache_key, [], self.negative_cache_period)
+        elif result is None:
+            result = []
+        elif self.cache_period:
+            self.cache.set(
+                cache_key, result, self.cache_period,
+                keep=max(self.stale_period, self.stale_if_error))
+        return result or []
+
+    def execute_many(self, manager, userdns, batch_size=100):
+        """Execute the query for many users with as few searches as possible.
+
+        The ``userdns`` must be passed as a dictionary mapping the user DNs
+        to their escaped values.  The clause of the filter template matching
+        the ``member_attribute`` with the user DN is replaced with a
+        disjunction for up to ``batch_size`` users, and the entries found
+        are assigned to the users using the values of the member attribute.
+        Returns a dictionary with the query result for every user DN.
+        """
+        if not self.member_attribute:
+            raise ValueError('The query cannot be used for batches.')
+        results = {}
+        missing = []
+        for userdn, escaped in userdns.items():
+            kw = {'userdn': escaped}
+            cache_key = (self.base_dn % kw, self.filter_tmpl % kw)
+            result = self.cache.get(cache_key) if self.cache_period else None
+            if result is None and self.negative_cache_period:
+                if self.negative_cache.get(cache_key) is not None:
+                    result = []
+            if result is None:
+                missing.append((userdn, escaped, cache_key))
+            else:
+                results[userdn] = result
+        if missing:
+            attributes = self.attributes
+            if attributes != ldap3.ALL_ATTRIBUTES:
+                attributes = list(attributes or []) + [self.member_attribute]
+            with manager.connection() as conn:
+                # send all searches before waiting for the responses
+                ids = []
+                for batch in self._batches(missing, batch_size):
+                    clause = '(|{})'.format(''.join(
+                        self.member_clause % {'userdn': escaped}
+                        for userdn, escaped, cache_key in batch))
+                    filter_str = self.filter_tmpl.replace(
+                        self.member_clause, clause)
+                    logger.debug(
+                        'searching for groups of %d users', len(batch))
+                    kw = dict(search_scope=self.scope, attributes=attributes)
+                    if self.time_limit:
+                        kw['time_limit'] = self.time_limit
+                    ids.append((batch, conn.search(
+                        self.base_dn, filter_str, **kw)))
+                for batch, ret in ids:
+                    response, ret = conn.get_response(ret)
+                    response = _get_ranges(conn, response)
+                    found = self._demultiplex(batch, response or ())
+                    for userdn, escaped, cache_key in batch:
+                        results[userdn] = self.store(
+                            cache_key, self.convert(found[userdn]))
+        return results
+
+    def _batches(self, missing, batch_size):
+        """Split the missing users into batches for the search filters."""
+        batch = []
+        length = len(self.filter_tmpl)
+        for item in missing:
+            size = len(self.member_clause) + len(item[1])
+            if batch and (len(batch) >= batch_size or
+                          length + size > _MAX_FILTER_LENGTH):
+                yield batch
+                batch = []
+                length = len(self.filter_tmpl)
+            batch.append(item)
+            length += size
+        if batch:
+            yield batch
+
+    def _demultiplex(self, batch, response):
+        """Assign the entries found with a batched search to the users."""
+        member = self.member_attribute
+        strip = self.attributes != ldap3.ALL_ATTRIBUTES and not any(
+            a.lower() == member.lower() for a in self.attributes or [])
+        users = {}
+        for item in batch:
+            userdn = item[0]
+            if isinstance(userdn, bytes):
+                try:
+                    userdn = userdn.decode('utf-8')
+                except UnicodeDecodeError:
+                    userdn = userdn.decode('latin-1')
+            users[userdn.lower()] = item[0]
+        found = dict((item[0], []) for item in batch)
+        for r in response:
+            if 'dn' not in r:
+                continue
+            attributes = r['attributes']
+            values = _get_attribute(attributes, member) or []
+            if not isinstance(values, (list, tuple)):
+                values = [values]
+            if strip:
+                r = {'dn': r['dn'], 'attributes': dict(
+                    (key, value) for key, value in attributes.items()
+                    if key.lower() != member.lower())}
+            for value in values:
+                userdn = users.get(value.lower())
+                if userdn is not None:
+                    found[userdn].append(r)
+        return found
+
+    def convert(self, response):
+        """Convert the response of the LDAP server to the query result."""
+        if self.compact:
+            names = self.attributes
+            if names == ldap3.ALL_ATTRIBUTES:
+                names = None
+            return tuple(_LDAPEntry(r['dn'], _LDAPAttributes(
+                r['attributes'], names)) for r in response if 'dn' in r)
+        return [(r['dn'], r['attributes']) for r in response if 'dn' in r]
+
+    def invalidate(self, dns, members=frozenset()):
+        """Remove cached results which may depend on the given entries.
+
+        These are the results containing one of the changed entries and
+        the results of queries made with one of the changed entries or one
+        of their members.  The DNs of the changed entries and their members
+        must be passed as sets of lower case strings.
+        """
+        users = dns | members
+        escaped = [escape_for_search(dn) for dn in users]
+        for cache in self.cache, self.negative_cache:
+            try:
+                items = cache.items()
+            except NotImplementedError:
+                continue
+            for key, result in items:
+                base_dn, filter_str = key[0].lower(), key[1].lower()
+                if (base_dn in users or
+                        any(dn in filter_str for dn in escaped) or
+                        any(dn.lower() in dns
+                            for dn in self.result_dns(result))):
+                    logger.debug('invalidating %r', key)
+                    cache.delete(key)
+        if self.graph is not None:
+            self.graph.invalidate(dns)
+        if self.dn_query is not None:
+            self.dn_query.invalidate(dns, members)
+
+    @staticmethod
+    def result_dns(result):
+        """Get the DNs of the entries in a query result."""
+        return [r[0] for r in result]
+
+
+class _LDAPDNQuery(_LDAPQuery):
+    """Represents a query for the DNs of entries only.
+
+    This is a variant of a given query which does not fetch any attributes.
+    The query results are tuples of interned DN strings instead of lists of
+    tuples with DNs and attribute dictionaries, so that they can be cached
+    in a compact form.
+    """
+
+    def __init__(self, query):
+        super(_LDAPDNQuery, self).__init__(
+            query.base_dn, query.filter_tmpl, query.scope, None,
+            query.cache_period, query.cache.max_entries,
+            query.cache.max_bytes, query.cache.jitter,
+            query.stale_period, query.stale_if_error,
+            query.negative_cache_period, query.negative_cache.max_entries,
+            query.page_size, query.time_limit)
+
+    @staticmethod
+    def convert(response):
+        return tuple(_intern(r['dn']) for r in response if 'dn' in r)
+
+    @staticmethod
+    def result_dns(result):
+        return result
+
+
+class _LDAPGroupGraph(object):
+    """Memoized graph of groups and their parent groups.
+
+    The graph is used for resolving nested group memberships.  The parents of
+    a group are found with the groups query, using the group DN instead of
+    the user DN.  All groups of one level are looked up with searches sent
+    at once over a single connection.  The parents of every group are cached
+    for ``cache_period`` seconds; if it is 0, they will not be cached.
+    Cycles in the graph are detected and ignored.
+    """
+
+    def __init__(self, query, cache_period=0, max_depth=20):
+        self.query = query
+        self.cache_period = cache_period
+        self.max_depth = max_depth
+        self.cache = _new_cache(query.cache.max_entries)
+
+    def __str__(self):
+        return 'cache_period={cache_period}, max_depth={max_depth}'.format(
+            **self.__dict__)
+
+    def use_cache(self, backend, name):
+        """Use a cache with the given name from the given cache backend."""
+        self.cache = backend.cache(name, self.cache.max_entries)
+
+    def parents(self, manager, groups):
+        """Get a dictionary with the parent groups of the given groups."""
+        parents = {}
+        missing = []
+        for dn in groups:
+            result = self.cache.get(dn) if self.cache_period else None
             if result is None:
-                result = []
+                missing.append(dn)
             else:
-                result = [(r['dn'], r['attributes']) for r in result
-                          if 'dn' in r]
-                if self.cache_period:
-                    self.cache[cache_key] = result
+                parents[dn] = result
+        if missing:
+            logger.debug('searching for parents of %r', missing)
+            query = self.query
+            with manager.connection() as conn:
+                # send all searches before waiting for the responses
+                ids = []
+                for dn in missing:
+                    kw = {'userdn': escape_for_search(dn)}
+                    ids.append(conn.search(
+                        query.base_dn % kw, query.filter_tmpl % kw,
+                        search_scope=query.scope,
+                        attributes=query.attributes))
+                for dn, ret in zip(missing, ids):
+                    response, ret = conn.get_response(ret)
+                    response = _get_ranges(conn, response)
+                    result = query.convert(response) if response else []
+                    if self.cache_period:
+                        self.cache.set(dn, result, self.cache_period)
+                    parents[dn] = result
+        return parents
+
+    def invalidate(self, dns):
+        """Remove cached parents which may depend on the given groups."""
+        try:
+            items = self.cache.items()
+        except NotImplementedError:
+            return
+        for dn, parents in items:
+            if dn.lower() in dns or any(r[0].lower() in dns for r in parents):
+                self.cache.delete(dn)
+
+    def expand(self, manager, groups):
+        """Add all ancestors to the given list of groups."""
+        result = list(groups)
+        seen = set(r[0] for r in result)
+        level = [r[0] for r in result]
+        depth = 0
+        while level:
+            if depth >= self.max_depth:
+                logger.warning(
+                    'nested groups deeper than %d levels', self.max_depth)
+                break
+            depth += 1
+            parents = self.parents(manager, level)
+            next_level = []
+            for dn in level:
+                for parent in parents[dn]:
+                    parent_dn = parent[0]
+                    if parent_dn in seen:
+                        logger.debug(
+                            'group %r reached again from %r',
+                            parent_dn, dn)
+                        continue
+                    seen.add(parent_dn)
+                    result.append(parent)
+                    next_level.append(parent_dn)
+            level = next_level
+        return result
+
+
+class _LDAPGroupsIndex(object):
+    """Represents an in-RAM index of the members of all groups.
+
+    All groups are loaded from the LDAP server with a paged search, and an
+    index mapping the DNs of the members to their groups is built, so that
+    the groups of a user can be looked up without querying the LDAP server.
+    The index is reloaded in a background thread when it is older than
+    ``refresh_period`` seconds, and then replaced as a whole.  Only the
+    given ``attributes`` of the groups are kept in the index.
+    """
+
+    raw_userdn = True  # the user DN is not used in a search filter
+
+    def __init__(self, base_dn, group_filter, scope,
+                 member_attribute='member', attributes=None,
+                 refresh_period=600, page_size=500):
+        self.base_dn = base_dn
+        self.group_filter = group_filter
+        self.scope = scope
+        self.member_attribute = member_attribute
+        self.attributes = attributes
+        self.refresh_period = refresh_period
+        self.page_size = page_size
+        self.index = None
+        self.groups = frozenset()
+        self.loaded = 0
+        self.flights = _SingleFlight()
+
+    def __str__(self):
+        return ('base_dn={base_dn}, group_filter={group_filter}, '
+                'scope={scope}, member_attribute={member_attribute}, '
+                'attributes={attributes}, refresh_period={refresh_period}, '
+                'page_size={page_size}'.format(**self.__dict__))
+
+    def execute(self, manager, userdn):
+        index = self.index
+        if index is None:
+            index = self.flights.call('index', self.load, manager)
+        elif (self.refresh_period and
+                self.loaded + self.refresh_period <= time()):
+            self.refresh(manager)
+        result = list(index.get(userdn.lower(), ()))
+
+        logger.debug('groups from index: %r', result)
+
+        return result
+
+    def invalidate(self, dns, members=frozenset()):
+        """Reload the index soon if any groups may have been changed.
+
+        This is assumed if one of the given DNs is a known group, or is
+        below the base DN of the groups and not a known member.
+        """
+        index = self.index
+        if index is None:
+            return
+        base_dn = ',' + self.base_dn.lower()
+        if any(dn in self.groups or (
+                dn.endswith(base_dn) and dn not in index) for dn in dns):
+            logger.debug('groups index will be reloaded')
+            self.loaded = 0
+
+    def refresh(self, manager):
+        """Reload the index in a background thread."""
+        if 'index' in self.flights:
+            return
+
+        def refresh():
+            try:
+                self.flights.call('index', self.load, manager)
+            except LDAPException:
+                logger.warning('refreshing groups index failed',
+                               exc_info=True)
+
+        _start_thread(refresh, 'pyramid_ldap3 index')
+
+    def load(self, manager):
+        """Load all groups from the LDAP server and build the index."""
+        logger.debug('loading groups index from %r', self.base_dn)
+        member_attribute = self.member_attribute
+        attributes = [member_attribute]
+        if self.attributes:
+            attributes.extend(
+                a for a in self.attributes if a != member_attribute)
+        keep = set(a.lower() for a in self.attributes or ())
+        index = {}
+        num_groups = 0
+        with manager.paged_connection() as conn:
+            for r in _paged_search(
+                    conn, self.base_dn, self.group_filter, self.scope,
+                    attributes, self.page_size):
+                if 'dn' not in r:
+                    continue
+                num_groups += 1
+                attrs = r['attributes']
+                group = (r['dn'], dict(
+                    (k, v) for k, v in attrs.items() if k.lower() in keep))
+                members = _get_attribute(attrs, member_attribute) or ()
+                if not isinstance(members, (list, tuple)):
+                    members = [members]
+                for member in members:
+                    index.setdefault(member.lower(), []).append(group)
+        index = dict((k, tuple(v)) for k, v in index.items())
+        groups = frozenset(
+            g[0].lower() for v in index.values() for g in v)
+        self.index, self.groups, self.loaded = index, groups, time()
+        logger.debug('loaded groups index with %d groups and %d members',
+                     num_groups, len(index))
+        return index
+
+
+def _get_attribute(attributes, name):
+    """Get the values of an attribute ignoring the case of its name."""
+    values = attributes.get(name)
+    if values is None:
+        name = name.lower()
+        for key, values in attributes.items():
+            if key.lower() == name:
+                break
         else:
-            logger.debug('result for %r retrieved from cache', cache_key)
+            values = None
+    return values
 
-        logger.debug('search result: %r', result)
 
+class _LDAPGroupsAttribute(_LDAPQuery):
+    """Represents a query for the groups stored in a user attribute.
+
+    Instead of searching for the groups that have the user as member, the
+    group DNs are read from an attribute such as ``memberOf`` of the user
+    entry.  The query results can be filled in from the user entries found
+    when authenticating users, so that no additional search is needed.
+    """
+
+    raw_userdn = True  # the user DN is used as base DN
+
+    def __init__(self, attribute, cache_period, *args, **kw):
+        super(_LDAPGroupsAttribute, self).__init__(
+            '%(userdn)s', '(objectClass=*)', ldap3.BASE, [attribute],
+            cache_period, *args, **kw)
+        self.attribute = attribute
+
+    def __str__(self):
+        return 'attribute={}, {}'.format(
+            self.attribute, super(_LDAPGroupsAttribute, self).__str__())
+
+    def convert(self, response):
+        result = []
+        for r in response:
+            if 'dn' in r:
+                values = _get_attribute(r['attributes'], self.attribute)
+                if values:
+                    if not isinstance(values, (list, tuple)):
+                        values = [values]
+                    result.extend((dn, {}) for dn in values)
         return result
 
+    def remember(self, userdn, attributes):
+        """Cache the groups from the attributes of a user entry."""
+        if not (self.cache_period or self.negative_cache_period):
+            return
+        if not attributes or _get_attribute(
+                attributes, self.attribute) is None:
+            return
+        cache_key = (self.base_dn % {'userdn': userdn},
+                     self.filter_tmpl % {'userdn': userdn})
+        result = self.convert([{'dn': userdn, 'attributes': attributes}])
+        if not result and self.negative_cache_period:
+            self.negative_cache.set(
+                cache_key, [], self.negative_cache_period)
+        elif self.cache_period:
+            self.cache.set(
+                cache_key, result, self.cache_period,
+                keep=max(self.stale_period, self.stale_if_error))
+
+
+class _LDAPLoginBind(object):
+    """Represents a direct bind with a user DN built from the login.
+
+    The user attributes are only fetched if ``attributes`` are specified.
+    """
 
-def _timeslice(period, when=None):
-    if when is None:  # pragma: no cover
-        when = time()
-    return when - (when % period)
+    def __init__(self, dn_tmpl, attributes=None):
+        self.dn_tmpl = dn_tmpl
+        self.attributes = attributes
+
+    def __str__(self):
+        return 'dn_tmpl={dn_tmpl}, attributes={attributes}'.format(
+            **self.__dict__)
+
+    def authenticate(self, manager, login, password):
+        """Bind with the given credentials and return the user entry.
+
+        Raises an LDAPException if the credentials are invalid.
+        """
+        login_dn = self.dn_tmpl % {'login': escape_for_dn(login)}
+
+        logger.debug('binding as %r', login_dn)
+
+        # the connection is already bound, so leaving its context would not
+        # unbind it, but unbinding also returns pooled connections
+        conn = manager.connection(login_dn, password)
+        try:
+            if not self.attributes:
+                return login_dn, {}
+            conn.search(
+                login_dn, '(objectClass=*)', search_scope=ldap3.BASE,
+                attributes=self.attributes)
+            result = [(r['dn'], r['attributes']) for r in conn.response or []
+                      if 'dn' in r]
+        finally:
+            conn.unbind()
+
+        logger.debug('search result: %r', result)
+
+        return result[0] if result else (login_dn, {})
 
 
 def _add_realm(base_identifier, realm=None):
     return '{}_{}'.format(base_identifier, realm) if realm else base_identifier
 
 
+class _PooledConnection(object):
+    """A connection that has been borrowed from a bind pool.
+
+    Unbinding the connection or leaving its context returns it to the pool.
+    All other attributes are delegated to the actual connection.
+    """
+
+    def __init__(self, pool, conn, created):
+        self.pool = pool
+        self.conn = conn
+        self.created = created
+
+    def __getattr__(self, name):
+        return getattr(self.conn, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_args):
+        self.unbind()
+
+    def unbind(self):
+        conn, self.conn = self.conn, None
+        if conn is not None:
+            self.pool.release(conn, self.created)
+
+
+class _GuardedConnection(object):
+    """A connection whose communication errors are noted by a breaker.
+
+    Leaving the context of the connection or unbinding it records whether
+    the LDAP server could be reached.  All other attributes are delegated
+    to the actual connection.
+    """
+
+    def __init__(self, breaker, conn):
+        self.breaker = breaker
+        self.conn = conn
+
+    def __getattr__(self, name):
+        return getattr(self.conn, name)
+
+    def __enter__(self):
+        try:
+            self.conn.__enter__()
+        except Exception as e:
+            self.record(e)
+            raise
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            return self.conn.__exit__(exc_type, exc_value, traceback)
+        finally:
+            self.record(exc_value)
+
+    def unbind(self):
+        self.record()
+        return self.conn.unbind()
+
+    def record(self, exc=None):
+        breaker, self.breaker = self.breaker, None
+        if breaker is not None:
+            if isinstance(exc, _server_errors):
+                breaker.failure()
+            else:
+                breaker.success()
+
+
+class _CircuitBreaker(object):
+    """Fails fast while the LDAP server seems to be unreachable.
+
+    After ``max_failures`` consecutive communication errors, the circuit is
+    opened, and new connections are refused immediately by raising an
+    :exc:`LDAPCircuitOpenError`.  After ``reset_timeout`` seconds, one
+    connection is let through as a probe.  If it succeeds, the circuit is
+    closed again, otherwise it stays open for another ``reset_timeout``
+    seconds.
+    """
+
+    def __init__(self, max_failures=5, reset_timeout=30):
+        self.max_failures = max_failures
+        self.reset_timeout = reset_timeout
+        self.failures = 0  # consecutive failures
+        self.opened = None  # when the circuit has been opened
+        self.probing = None  # when the last probe has been let through
+        self.trips = self.rejected = 0
+        self.lock = Lock()
+
+    def __str__(self):
+        return ('state={state}, failures={failures}, '
+                'max_failures={max_failures}, '
+                'reset_timeout={reset_timeout}, trips={trips}, '
+                'rejected={rejected}'.format(
+                    state=self.state, **self.__dict__))
+
+    __repr__ = __str__
+
+    @property
+    def state(self):
+        """The state of the circuit: closed, open or half-open."""
+        if self.opened is None:
+            return 'closed'
+        return 'open' if self.probing is None else 'half-open'
+
+    def allow(self):
+        """Check whether the LDAP server shall be contacted.
+
+        Raises an :exc:`LDAPCircuitOpenError` if the circuit is open.
+        """
+        with self.lock:
+            opened = self.opened
+            if opened is None:
+                return
+            now = time()
+            reset_timeout = self.reset_timeout
+            if now >= opened + reset_timeout and (
+                    self.probing is None or
+                    now >= self.probing + reset_timeout):
+                self.probing = now
+                logger.info('probing whether the LDAP server is back')
+                return
+            self.rejected += 1
+        raise LDAPCircuitOpenError(
+            'the LDAP server seems to be unreachable')
+
+    def success(self):
+        """Record that the LDAP server could be reached."""
+        with self.lock:
+            self.failures = 0
+            if self.opened is not None:
+                self.opened = self.probing = None
+                logger.warning('closing circuit, the LDAP server is back')
+
+    def failure(self):
+        """Record that the LDAP server could not be reached."""
+        with self.lock:
+            self.failures += 1
+            if self.opened is not None:  # the probe failed
+                self.opened = time()
+                self.probing = None
+            elif self.failures >= self.max_failures:
+                self.opened = time()
+                self.trips += 1
+                logger.warning(
+                    'opening circuit after %d failures for %d seconds',
+                    self.failures, self.reset_timeout)
+
+
+class _BindPool(object):
+    """Bounded pool of open connections for checking user credentials.
+
+    The connections are re-bound with the credentials of each user and
+    returned to the pool afterwards, so that checking credentials costs
+    only a bind round trip instead of opening a new connection every time.
+    At most ``size`` connections can be used at the same time, connections
+    are recreated when they are older than ``lifetime`` seconds or when
+    they turn out to have been closed by the server while idle.
+    The bind times and errors are recorded in the ``server_pool`` if given.
+    """
+
+    def __init__(self, connect, size=10, lifetime=3600, server_pool=None):
+        self.connect = connect
+        self.size = size
+        self.lifetime = lifetime
+        self.server_pool = server_pool
+        self.idle = []  # (created, connection)
+        self.slots = BoundedSemaphore(size)
+        self.lock = Lock()
+
+    def __len__(self):
+        return len(self.idle)
+
+    def acquire(self, user, password):
+        """Get a connection from the pool bound with the given credentials.
+
+        Raises an LDAPBindError if the credentials are invalid.
+        """
+        self.slots.acquire()
+        try:
+            conn = None
+            now = time()
+            with self.lock:
+                while self.idle:
+                    created, conn = self.idle.pop()
+                    if not conn.closed and created + self.lifetime > now:
+                        break
+                    self._discard(conn)
+                    conn = None
+            reused = conn is not None
+            while True:
+                if conn is None:
+                    conn = self.connect()
+                    created = time()
+                start = time()
+                try:
+                    bound = conn.rebind(user, password)
+                except LDAPException as exc:
+                    self._discard(conn)
+                    if isinstance(exc, _server_errors):
+                        if reused:
+                            # the idle connection may have been closed
+                            # by the server, so try a new connection
+                            logger.debug(
+                                'reused bind connection failed, reconnecting',
+                                exc_info=True)
+                            conn, reused = None, False
+                            continue
+                        if self.server_pool is not None:
+                            self.server_pool.failure(conn.server)
+                    raise
+                break
+            if self.server_pool is not None:
+                self.server_pool.success(conn.server, time() - start)
+        except Exception:
+            self.slots.release()
+            raise
+        if not bound:
+            self.release(conn, created)
+            raise LDAPBindError('invalid credentials for %r' % (user,))
+        return _PooledConnection(self, conn, created)
+
+    def release(self, conn, created):
+        """Return a connection to the pool."""
+        try:
+            if not conn.closed and created + self.lifetime > time():
+                with self.lock:
+                    self.idle.append((created, conn))
+            else:
+                self._discard(conn)
+        finally:
+            self.slots.release()
+
+    def clear(self):
+        """Close all idle connections in the pool."""
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for _created, conn in idle:
+            self._discard(conn)
+
+    def warm_up(self, num):
+        """Open idle connections in advance, up to the given number."""
+        num = min(num, self.size)
+        for _n in range(num):
+            if len(self.idle) >= num or not self.slots.acquire(False):
+                break
+            try:
+                conn = self.connect()
+                conn.open()
+            except Exception:
+                self.slots.release()
+                raise
+            self.release(conn, time())
+
+    def reset(self):
+        """Forget all connections, e.g. those inherited by a child process.
+
+        The connections are not unbound, since they may still be used by
+        the parent process.
+        """
+        self.idle = []
+        self.slots = BoundedSemaphore(self.size)
+        self.lock = Lock()
+
+    @staticmethod
+    def _discard(conn):
+        try:
+            conn.unbind()
+        except LDAPException:
+            logger.debug('Exception when closing bind connection',
+                         exc_info=True)
+
+
+class _ChangeTracker(object):
+    """Tracks changes of LDAP entries and invalidates cached results.
+
+    The LDAP server is polled every ``interval`` seconds for entries below
+    ``base_dn`` matching ``filter_str`` whose ``attribute`` (usually
+    ``modifyTimestamp`` or ``uSNChanged``) is not lower than the last value
+    seen.  Cached results of the queries that may depend on these entries
+    or on their members (as given by ``member_attribute``) are invalidated,
+    so that they will be fetched again from the LDAP server.  Note that
+    deleted entries cannot be detected this way.
+
+    The queries are taken from the ``registry`` for the given ``realm``.
+    """
+
+    def __init__(self, manager, registry, base_dn, interval=60,
+                 filter_str='(objectClass=*)', attribute='modifyTimestamp',
+                 member_attribute='member', realm=None):
+        self.manager = manager
+        self.registry = registry
+        self.base_dn = base_dn
+        self.interval = interval
+        self.filter_str = filter_str
+        self.attribute = attribute
+        self.member_attribute = member_attribute
+        self.query_identifiers = [
+            _add_realm('ldap_login_query', realm),
+            _add_realm('ldap_groups_query', realm)]
+        self.last_value = None
+        self.last_dns = set()  # the DNs seen with the last value
+        self.thread = None
+        self.stopped = Event()
+        self.lock = Lock()
+
+    def __str__(self):
+        return ('base_dn={base_dn}, interval={interval}, '
+                'filter_str={filter_str}, attribute={attribute}, '
+                'member_attribute={member_attribute}'.format(**self.__dict__))
+
+    def start(self):
+        """Start polling in a background thread if not already running."""
+        thread = self.thread
+        if thread is not None and thread.is_alive():
+            return
+        with self.lock:
+            thread = self.thread
+            if thread is None or not thread.is_alive():
+                self.stopped.clear()
+                self.thread = _start_thread(self.run, 'pyramid_ldap3 tracker')
+
+    def stop(self):
+        """Stop polling."""
+        self.stopped.set()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.poll()
+            except LDAPException:
+                logger.warning('polling for changes failed', exc_info=True)
+
+    def initial_value(self):
+        """Get the value of the tracked attribute to start with."""
+        if self.attribute.lower() == 'usnchanged':
+            with self.manager.connection() as conn:
+                ret = conn.search(
+                    '', '(objectClass=*)', search_scope=ldap3.BASE,
+                    attributes=['highestCommittedUSN'])
+                response, ret = conn.get_response(ret)
+            for r in response or ():
+                value = _get_attribute(
+                    r['raw_attributes'], 'highestCommittedUSN')
+                if value:
+                    return _decode(value[0])
+            return '0'
+        return strftime('%Y%m%d%H%M%SZ', gmtime(time() - self.interval))
+
+    def poll(self):
+        """Poll once for changed entries and invalidate cached results.
+
+        Returns the set of DNs of the changed entries.
+        """
+        if self.last_value is None:
+            self.last_value = self.initial_value()
+            logger.debug('tracking changes since %s', self.last_value)
+        attribute = self.attribute
+        filter_str = '(&{}({}>={}))'.format(
+            self.filter_str, attribute, escape_for_search(self.last_value))
+        last_value, last_dns = self.last_value, self.last_dns
+        changed = set()
+        members = set()
+        with self.manager.connection() as conn:
+            ret = conn.search(
+                self.base_dn, filter_str, search_scope=ldap3.SUBTREE,
+                attributes=[attribute, self.member_attribute])
+            response, ret = conn.get_response(ret)
+            response = _get_ranges(conn, response)
+        for r in response or ():
+            if 'dn' not in r:
+                continue
+            dn = r['dn'].lower()
+            value = _get_attribute(r['raw_attributes'], attribute)
+            value = _decode(value[0]) if value else None
+            if value == self.last_value and dn in self.last_dns:
+                continue  # seen in the last poll already
+            changed.add(dn)
+            values = _get_attribute(
+                r['attributes'], self.member_attribute) or ()
+            if not isinstance(values, (list, tuple)):
+                values = [values]
+            members.update(member.lower() for member in values)
+            if value is not None:
+                if _value_key(value) > _value_key(last_value):
+                    last_value, last_dns = value, set()
+                if value == last_value:
+                    last_dns.add(dn)
+        self.last_value, self.last_dns = last_value, last_dns
+        if changed:
+            logger.debug('entries changed: %r', changed)
+            for identifier in self.query_identifiers:
+                query = getattr(self.registry, identifier, None)
+                invalidate = getattr(query, 'invalidate', None)
+                if invalidate is not None:
+                    invalidate(changed, members)
+        return changed
+
+
+def _decode(value):
+    return value.decode('utf-8') if isinstance(value, bytes) else value
+
+
+def _value_key(value):
+    """Get a key for comparing values of timestamps or change numbers."""
+    return (len(value), value) if value.isdigit() else (0, value)
+
+
+class _ServerStats(object):
+    """Health and latency statistics for one server."""
+
+    __slots__ = ('latency', 'errors', 'quarantines', 'until',
+                 'successes', 'failures')
+
+    def __init__(self):
+        self.latency = None  # moving average in seconds
+        self.errors = 0  # consecutive errors
+        self.quarantines = 0  # consecutive quarantines
+        self.until = 0  # end of the quarantine
+        self.successes = self.failures = 0
+
+    def as_dict(self):
+        return dict((name, getattr(self, name)) for name in self.__slots__)
+
+
+class _ServerPool(ldap3.ServerPool):
+    """Server pool selecting the fastest healthy server for new connections.
+
+    The latency of every server is tracked as an exponentially weighted
+    moving average with the given ``decay`` of the times needed for binding
+    and, if a ``check_interval`` is set, for reading the root DSE, which is
+    done for all servers every ``check_interval`` seconds in a background
+    thread.  Servers that have not been measured yet are only used when no
+    measured server is healthy.
+
+    If the pool is ``active``, the selected server is probed before a new
+    connection is opened, and the next healthy server is selected if it
+    cannot be reached.  The probes are recorded like all other operations,
+    so that this also covers the connections opened by the workers of a
+    reusable connection pool.
+
+    After ``max_errors`` consecutive communication errors, a server is put
+    into quarantine for ``quarantine`` seconds, doubling with every further
+    quarantine up to ``max_quarantine`` seconds.  When the quarantine has
+    ended, the server is tried again, and the next error puts it back into
+    quarantine.  If all servers are in quarantine, the server whose
+    quarantine ends first will be used.
+    """
+
+    def __init__(self, servers, decay=0.2, max_errors=3, quarantine=5,
+                 max_quarantine=300, check_interval=0, active=True):
+        super(_ServerPool, self).__init__(
+            servers, ldap3.FIRST, active=active)
+        self.decay = decay
+        self.max_errors = max_errors
+        self.quarantine = quarantine
+        self.max_quarantine = max_quarantine
+        self.check_interval = check_interval
+        self.stats = [(server, _ServerStats()) for server in self.servers]
+        self.selected = local()
+        self.thread = None
+        self.stopped = Event()
+        self.lock = Lock()
+
+    def __str__(self):
+        return ('latency_decay={decay}, quarantine_errors={max_errors}, '
+                'quarantine_period={quarantine}, '
+                'max_quarantine_period={max_quarantine}, '
+                'health_check_interval={check_interval}'.format(
+                    **self.__dict__))
+
+    def server_stats(self):
+        """Get the statistics of all servers as a dictionary."""
+        with self.lock:
+            return OrderedDict(
+                ('{}:{}'.format(server.host, server.port), stats.as_dict())
+                for server, stats in self.stats)
+
+    def _stats(self, server):
+        for pool_server, stats in self.stats:
+            if pool_server is server:
+                return stats
+        return None
+
+    def get_server(self, connection=None):
+        """Get the server that shall be used for a new connection."""
+        unavailable = []
+        for _n in range(len(self.servers)):
+            server = self.select(exclude=unavailable)
+            if not self.active:
+                break
+            start = time()
+            if server.check_availability():
+                self.success(server, time() - start)
+                break
+            logger.debug('server %s:%s is not available',
+                         server.host, server.port)
+            self.failure(server)
+            unavailable.append(server)
+        # remember the server in case the connection cannot be created
+        self.selected.server = server
+        return server
+
+    def select(self, exclude=()):
+        """Select the fastest healthy server, but not the excluded ones."""
+        now = time()
+        with self.lock:
+            stats = [(server, stats) for server, stats in self.stats
+                     if not any(server is excluded
+                                for excluded in exclude)] or self.stats
+            healthy = [
+                (stats.latency is None, stats.latency or 0, random(), server)
+                for server, stats in stats if stats.until <= now]
+            if healthy:
+                return min(healthy)[3]
+            return min(
+                (stats.until, random(), server)
+                for server, stats in stats)[2]
+
+    def selected_server(self):
+        """Get the server last selected in the current thread."""
+        return getattr(self.selected, 'server', None)
+
+    def success(self, server, elapsed):
+        """Record a successful operation on the given server."""
+        with self.lock:
+            stats = self._stats(server)
+            if stats is None:
+                return
+            stats.successes += 1
+            stats.errors = stats.quarantines = stats.until = 0
+            latency = stats.latency
+            stats.latency = elapsed if latency is None else (
+                latency + self.decay * (elapsed - latency))
+
+    def failure(self, server):
+        """Record a communication error with the given server."""
+        with self.lock:
+            stats = self._stats(server)
+            if stats is None:
+                return
+            stats.failures += 1
+            stats.errors += 1
+            if stats.errors < self.max_errors:
+                return
+            stats.quarantines += 1
+            period = min(self.quarantine * 2 ** (stats.quarantines - 1),
+                         self.max_quarantine)
+            stats.until = time() + period
+        logger.warning('putting server %s:%s into quarantine for %d seconds',
+                       server.host, server.port, period)
+
+    def start(self):
+        """Start checking the servers if not already running."""
+        if not self.check_interval:
+            return
+        thread = self.thread
+        if thread is not None and thread.is_alive():
+            return
+        with self.lock:
+            thread = self.thread
+            if thread is None or not thread.is_alive():
+                self.stopped.clear()
+                self.thread = _start_thread(
+                    self.run, 'pyramid_ldap3 health check')
+
+    def stop(self):
+        """Stop checking the servers."""
+        self.stopped.set()
+
+    def run(self):
+        while not self.stopped.wait(self.check_interval):
+            self.check()
+
+    def check(self, connection_class=None):
+        """Check all servers by reading their root DSE."""
+        if connection_class is None:
+            connection_class = ldap3.Connection
+        for server in self.servers:
+            start = time()
+            try:
+                conn = connection_class(
+                    server, client_strategy=ldap3.SYNC, read_only=True)
+                conn.open()
+                try:
+                    conn.search('', '(objectClass=*)',
+                                search_scope=ldap3.BASE, attributes=['1.1'])
+                finally:
+                    conn.unbind()
+            except LDAPException:
+                logger.debug('health check for server %s:%s failed',
+                             server.host, server.port, exc_info=True)
+                self.failure(server)
+            else:
+                self.success(server, time() - start)
+
+
+class _Hedger(object):
+    """Sends searches to a second server if the first one is slow.
+
+    The response times of the last ``window`` searches are recorded.  If a
+    search has not been answered after the given ``percentile`` of these
+    response times, the same search is sent to another server using a
+    separate connection, and the response that arrives first is used.
+    No more than the fraction ``budget`` of all searches is sent twice.
+    """
+
+    min_samples = 20  # needed for estimating the percentile
+    max_tokens = 10  # maximum number of hedges in a burst
+
+    def __init__(self, manager, percentile=95, budget=0.05, window=1000):
+        self.manager = manager
+        self.percentile = percentile
+        self.budget = budget
+        self.samples = deque(maxlen=window)
+        self.delay = None
+        self.tokens = 0
+        self.searches = self.hedged = self.won = 0
+        self.lock = Lock()
+
+    def __str__(self):
+        return ('hedge_percentile={percentile}, hedge_budget={budget}, '
+                'searches={searches}, hedged={hedged}, '
+                'won={won}'.format(**self.__dict__))
+
+    def record(self, elapsed):
+        """Record the response time of a search."""
+        with self.lock:
+            samples = self.samples
+            samples.append(elapsed)
+            self.searches += 1
+            self.tokens = min(self.tokens + self.budget, self.max_tokens)
+            num = len(samples)
+            if num >= self.min_samples and (
+                    self.delay is None or self.searches % 50 == 0):
+                index = min(num * self.percentile // 100, num - 1)
+                self.delay = sorted(samples)[int(index)]
+
+    def take(self):
+        """Check whether a search may be hedged under the budget."""
+        with self.lock:
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            self.hedged += 1
+            return True
+
+    def get_response(self, conn, msg_id, base_dn, filter_str, **kw):
+        """Get the response of a search that has been sent on a connection.
+
+        If the search is slow, the search is sent to another server with
+        the given parameters, and the first response will be returned.
+        """
+        start = time()
+        delay = self.delay
+        if delay is None:
+            response = conn.get_response(msg_id)
+        else:
+            try:
+                response = conn.get_response(msg_id, timeout=delay)
+            except _LDAPResponseTimeoutError:
+                if not self.take():
+                    response = conn.get_response(msg_id)
+                else:
+                    logger.debug('hedging search for %r', filter_str)
+                    response = self.hedge(
+                        conn, msg_id, base_dn, filter_str, **kw)
+        self.record(time() - start)
+        return response
+
+    def hedge(self, conn, msg_id, base_dn, filter_str, **kw):
+        """Wait for the response on the connection and from another server."""
+        responses = Queue()
+
+        def first():
+            try:
+                responses.put((False, conn.get_response(msg_id)))
+            except Exception as exc:
+                responses.put((False, exc))
+
+        def second():
+            try:
+                hedge_conn = self.manager.hedge_connection(conn)
+                try:
+                    ret = hedge_conn.search(base_dn, filter_str, **kw)
+                    responses.put((True, hedge_conn.get_response(ret)))
+                finally:
+                    hedge_conn.unbind()
+            except Exception as exc:
+                responses.put((True, exc))
+
+        _start_thread(first, 'pyramid_ldap3 search')
+        _start_thread(second, 'pyramid_ldap3 hedge')
+        error = None
+        for _n in range(2):
+            hedged, response = responses.get()
+            if not isinstance(response, Exception):
+                if hedged:
+                    with self.lock:
+                        self.won += 1
+                return response
+            if error is None:
+                error = response
+        raise error
+
+
 class ConnectionManager(object):
     """Provides API methods for managing LDAP connections."""
 
@@ -118,10 +2211,16 @@ class ConnectionManager(object):
     def __init__(
             self, uri, bind=None, passwd=None, tls=None,
             use_pool=True, pool_size=10, pool_lifetime=3600,
-            get_info=None, ldap3=ldap3, realm=None):
+            get_info=None, ldap3=ldap3, realm=None,
+            bind_pool_size=0, bind_pool_lifetime=3600,
+            latency_aware=False, latency_decay=0.2, quarantine_errors=3,
+            quarantine_period=5, max_quarantine_period=300,
+            health_check_interval=0, hedge_percentile=0, hedge_budget=0.05,
+            breaker_failures=0, breaker_reset_timeout=30,
+            refresh_workers=2, max_refreshes=100):
         self.ldap3 = ldap3
         uris = uri if isinstance(uri, (list, tuple)) else uri.split()
-        self.uri = uri[0] if len(uris) == 1 else uris
+        self.uri = uris[0] if len(uris) == 1 else uris
         if get_info is None:
             get_info = ldap3.NONE
         servers = []
@@ -140,8 +2239,16 @@ class ConnectionManager(object):
                 host, port=port, use_ssl=use_ssl, tls=tls,
                 get_info=get_info)
             servers.append(server)
-        self.server = servers[
-            0] if len(servers) == 1 else self.ldap3.ServerPool(servers)
+        if len(servers) == 1:
+            self.server = servers[0]
+            self.server_pool = None
+        elif latency_aware:
+            self.server = self.server_pool = _ServerPool(
+                servers, latency_decay, quarantine_errors, quarantine_period,
+                max_quarantine_period, health_check_interval)
+        else:
+            self.server = self.ldap3.ServerPool(servers)
+            self.server_pool = None
         self.bind, self.passwd = bind, passwd
         if use_pool:
             self.strategy = ldap3.REUSABLE
@@ -151,36 +2258,215 @@ class ConnectionManager(object):
         else:
             self.strategy = ldap3.ASYNC
             self.pool_name = self.pool_size = self.pool_lifetime = None
+        self.bind_pool = _BindPool(
+            self.bind_connection, bind_pool_size, bind_pool_lifetime,
+            self.server_pool) if bind_pool_size else None
+        self.hedger = _Hedger(
+            self, hedge_percentile, hedge_budget) if hedge_percentile and (
+                len(servers) > 1) else None
+        self.breaker = _CircuitBreaker(
+            breaker_failures,
+            breaker_reset_timeout) if breaker_failures else None
+        self.refresh_workers = _WorkerPool(
+            refresh_workers, 'pyramid_ldap3 refresh', max_refreshes)
+        self.tracker = None
+        self.pid = os.getpid()
+        self.warm_up_pid = None
+        self.async_pools = WeakKeyDictionary()  # used by pyramid_ldap3.aio
 
     def __str__(self):
         return ('uri={uri}, bind={bind}/{passwd},pool={pool_size}'.format(
             **self.__dict__))
 
     def connection(self, user=None, password=None):
+        return self._guarded(self._connection, user, password)
+
+    def paged_connection(self):
+        """Create a connection for searching with the paged results control.
+
+        Servers keep the state of paged searches per connection, but the
+        requests sent over a pooled connection are spread over all the
+        connections of the pool.  Therefore, a separate connection is used
+        for every paged search.  It is bound when entering its context and
+        unbound when leaving it.
+        """
+        return self._guarded(
+            self.ldap3.Connection, self.server,
+            user=self.bind, password=self.passwd,
+            client_strategy=ldap3.ASYNC if self.pool_name else self.strategy,
+            lazy=False, read_only=True)
+
+    def _guarded(self, connect, *args, **kw):
+        """Create a connection, noting errors in the circuit breaker."""
+        if self.pid != os.getpid():
+            self.after_fork()
+        breaker = self.breaker
+        if breaker is None:
+            return connect(*args, **kw)
+        breaker.allow()
+        try:
+            conn = connect(*args, **kw)
+        except _server_errors:
+            breaker.failure()
+            raise
+        except LDAPException:
+            breaker.success()  # the server has answered
+            raise
+        return _GuardedConnection(breaker, conn)
+
+    def _connection(self, user, password):
         if user:
-            conn = self.ldap3.Connection(
-                self.server, user=user, password=password,
+            if self.bind_pool is not None:
+                return self.bind_pool.acquire(user, password)
+            conn = self._connect(
+                user=user, password=password,
                 client_strategy=ldap3.SYNC,
                 auto_bind=True, lazy=False, read_only=True)
         else:
-            conn = self.ldap3.Connection(
-                self.server, user=self.bind, password=self.passwd,
+            conn = self._connect(
+                user=self.bind, password=self.passwd,
                 client_strategy=self.strategy,
                 pool_name=self.pool_name, pool_size=self.pool_size,
                 pool_lifetime=self.pool_lifetime,
                 auto_bind=True, lazy=False, read_only=True)
         return conn
 
+    def _connect(self, **kw):
+        """Create a connection, tracking the health of the server."""
+        server_pool = self.server_pool
+        if server_pool is None or kw['client_strategy'] == ldap3.REUSABLE:
+            # connections of a reusable pool are opened in worker threads
+            return self.ldap3.Connection(self.server, **kw)
+        start = time()
+        try:
+            conn = self.ldap3.Connection(self.server, **kw)
+        except _server_errors:
+            server_pool.failure(server_pool.selected_server())
+            raise
+        server_pool.success(conn.server, time() - start)
+        return conn
+
+    def bind_connection(self):
+        """Create an unbound connection for the bind pool."""
+        return self.ldap3.Connection(
+            self.server, client_strategy=ldap3.SYNC,
+            lazy=False, read_only=True)
+
+    def async_connection(self):
+        """Open a connection for sending searches from coroutines.
+
+        The connection uses the asynchronous strategy even if a connection
+        pool is used, so that many searches can be sent over it without
+        waiting for their responses.  This is used by ``pyramid_ldap3.aio``.
+        """
+        conn = self._connect(
+            user=self.bind, password=self.passwd,
+            client_strategy=ldap3.ASYNC if self.pool_name else self.strategy,
+            auto_bind=True, lazy=False, read_only=True)
+        if not conn.bound:  # mocked connections are not bound automatically
+            conn.open()
+            conn.bind()
+        return conn
+
+    def hedge_connection(self, conn):
+        """Open a connection for sending a search a second time.
+
+        The connection is opened to another server than the one that is
+        most likely processing the search on the given connection.
+        """
+        server_pool = self.server_pool
+        if self.strategy == ldap3.REUSABLE:
+            # the workers use the servers selected when they connected
+            busy = None if server_pool is None else server_pool.select()
+        else:
+            busy = conn.server
+        if server_pool is None:
+            server = choice([
+                server for server in self.server.servers
+                if server is not busy] or self.server.servers)
+        else:
+            server = server_pool.select(exclude=(busy,))
+        return self.ldap3.Connection(
+            server, user=self.bind, password=self.passwd,
+            client_strategy=ldap3.ASYNC,
+            auto_bind=True, lazy=False, read_only=True)
+
+    def after_fork(self):
+        """Forget the connections inherited from the parent process.
+
+        This is called automatically when a connection is requested in a
+        child process, so that the sockets and pool threads of the parent
+        process are not used by the child process.
+        """
+        logger.debug('recreating connection pools in process %d', os.getpid())
+        self.pid = os.getpid()
+        if self.pool_name:
+            try:
+                from ldap3.strategy.reusable import ReusableStrategy
+            except ImportError:  # pragma: no cover
+                pass
+            else:
+                # the worker threads of the pool do not exist in the child
+                ReusableStrategy.pools.pop(self.pool_name, None)
+        if self.bind_pool is not None:
+            self.bind_pool.reset()
+        self.async_pools = WeakKeyDictionary()
+
+    def warm_up(self, num):
+        """Open up to ``num`` pooled connections in advance.
+
+        When using a connection pool, this sends ``num`` searches for the
+        root DSE at once, so that usually as many connections of the pool
+        will be opened and bound.  When using a bind pool, up to ``num``
+        connections will be opened for binding users.
+        """
+        if self.pool_name:
+            with self.connection() as conn:
+                ids = [conn.search(
+                    '', '(objectClass=*)', search_scope=ldap3.BASE,
+                    attributes=['1.1']) for _n in range(num)]
+                for ret in ids:
+                    conn.get_response(ret)
+        if self.bind_pool is not None:
+            self.bind_pool.warm_up(num)
+        logger.debug('warmed up %d connections in process %d',
+                     num, os.getpid())
+
+    def start_warm_up(self, num):
+        """Warm up the connections in a background thread.
+
+        This is done only once in every process.
+        """
+        pid = os.getpid()
+        if self.warm_up_pid == pid:
+            return
+        self.warm_up_pid = pid
+
+        def warm_up():
+            try:
+                self.warm_up(num)
+            except LDAPException:
+                logger.warning('warming up connections failed', exc_info=True)
+
+        _start_thread(warm_up, 'pyramid_ldap3 warm-up')
+
 
 class Connector(object):
-    """Provides API methods for accessing LDAP authentication information."""
+    """Provides API methods for accessing LDAP authentication information.
+
+    If ``memoize`` is set, the groups of every user are only searched once
+    during the lifetime of the connector.  This is used for the connectors
+    attached to the requests, which live only as long as the request.
+    """
 
-    def __init__(self, registry, manager, realm=None):
+    def __init__(self, registry, manager, realm=None, memoize=False):
         self.registry = registry
         self.manager = manager
         self.realm = realm
         self.login_query_identifier = _add_realm('ldap_login_query', realm)
         self.group_query_identifier = _add_realm('ldap_groups_query', realm)
+        self.groups_memo = {} if memoize else None
+        self.group_dns_memo = {} if memoize else None
 
     def authenticate(self, login, password):
         """Validate the given login name and password.
@@ -199,7 +2485,12 @@ class Connector(object):
         RFC-4513 <https://tools.ietf.org/html/rfc4513#section-5.1.2>`_ for a
         description of this behavior.
 
-        If :meth:`pyramid.config.Configurator.ldap_set_login_query` was not
+        If :meth:`pyramid.config.Configurator.ldap_set_login_dn` has been
+        called instead, the user is bound directly with a DN built from the
+        login name, without searching for the user first.
+
+        If neither :meth:`pyramid.config.Configurator.ldap_set_login_query`
+        nor :meth:`pyramid.config.Configurator.ldap_set_login_dn` was
         called, using this function will raise an
         :exc:`pyramid.exceptions.ConfiguratorError`.
         """
@@ -207,10 +2498,38 @@ class Connector(object):
         if password == '':
             return None
 
+        search = self._login_query()
+        result = self._search_login(search, login, password)
+        if result is None or isinstance(search, _LDAPLoginBind):
+            return result
+        return self._bind_login(result, login, password)
+
+    def _login_query(self):
         search = getattr(self.registry, self.login_query_identifier, None)
         if search is None:
             raise ConfigurationError(
                 'ldap_set_login_query was not called during setup')
+        return search
+
+    def _search_login(self, search, login, password):
+        """Search the entry of the user with the given login.
+
+        Returns the entry if exactly one entry has been found.  If the user
+        is bound directly with a DN built from the login, the user is already
+        bound and the entry is only returned if the password is correct.
+        """
+        if isinstance(search, _LDAPLoginBind):
+            if not login:
+                return None
+            try:
+                result = search.authenticate(self.manager, login, password)
+            except LDAPException:
+                logger.debug(
+                    'Exception in authenticate with login %r', login,
+                    exc_info=True)
+                return None
+            self._remember_groups(result)
+            return result
 
         result = search.execute(
             self.manager, login=escape_for_search(login),
@@ -218,7 +2537,10 @@ class Connector(object):
 
         if not result or len(result) > 1:
             return None
-        result = result[0]
+        return result[0]
+
+    def _bind_login(self, result, login, password):
+        """Check the password by binding with the DN of the found entry."""
         login_dn = result[0]
 
         try:
@@ -229,8 +2551,15 @@ class Connector(object):
                 exc_info=True)
             return None
 
+        self._remember_groups(result)
         return result
 
+    def _remember_groups(self, result):
+        """Fill the groups cache from an authenticated user entry."""
+        search = getattr(self.registry, self.group_query_identifier, None)
+        if isinstance(search, _LDAPGroupsAttribute):
+            search.remember(*result)
+
     def user_groups(self, userdn):
         """Get the groups the user belongs to.
 
@@ -242,18 +2571,164 @@ class Connector(object):
         distinguished name of the group.  Attrdict will be a dictionary
         mapping LDAP group attributes to sequences of values.
 
-        If :meth:`pyramid.config.Configurator.ldap_set_groups_query` was not
-        called, using this function will raise an
-        :exc:`pyramid.exceptions.ConfiguratorError`
+        If the groups query has been set up with ``nested=True``, the groups
+        which contain these groups will be returned as well, recursively.
+
+        If :meth:`pyramid.config.Configurator.ldap_set_groups_attribute`
+        has been called instead, the group DNs will be taken from the
+        given attribute of the user entry, and the attribute dictionaries
+        will be empty.
+
+        If :meth:`pyramid.config.Configurator.ldap_set_groups_index` has
+        been called instead, the groups will be looked up in an index of
+        all groups that is kept in memory.
 
+        If none of these configurator methods was called, using this
+        function will raise an :exc:`pyramid.exceptions.ConfiguratorError`
+
+        The connector attached to a request remembers the groups of every
+        user, so that repeated calls in the same request are not costly.
+        """
+        memo = self.groups_memo
+        if memo is None:
+            return self._user_groups(userdn)
+        try:
+            return memo[userdn]
+        except KeyError:
+            result = memo[userdn] = self._user_groups(userdn)
+            return result
+
+    def user_group_dns(self, userdn):
+        """Get the DNs of the groups the user belongs to.
+
+        Given a user DN, return a sequence of the DNs of the groups of which
+        the DN is a member.  If the DN does not exist, return ``None``.
+
+        If the groups query fetches attributes and nested groups shall not
+        be resolved, this uses a variant of the groups query that does not
+        fetch any attributes of the groups and caches the results in a more
+        compact form, unless the groups are already in the cache of the
+        groups query.
         """
+        memo = self.group_dns_memo
+        if memo is not None:
+            try:
+                return memo[userdn]
+            except KeyError:
+                pass
+            if userdn in self.groups_memo:
+                groups = self.groups_memo[userdn]
+                return groups if groups is None else [r[0] for r in groups]
+        search = self._groups_query()
+        dn_query = getattr(search, 'dn_query', None)
+        if dn_query is None:
+            groups = self.user_groups(userdn)
+            return groups if groups is None else [r[0] for r in groups]
+        userdn_value = self._userdn(dn_query, userdn)
+        try:
+            # the groups may already be cached with their attributes
+            groups = search.cached(userdn=userdn_value)
+            if groups is None:
+                result = list(dn_query.execute(
+                    self.manager, userdn=userdn_value))
+            else:
+                result = [r[0] for r in groups]
+        except LDAPException:
+            logger.debug(
+                'Exception in user_group_dns with userdn %r', userdn,
+                exc_info=True)
+            result = None
+        if memo is not None:
+            memo[userdn] = result
+        return result
+
+    def user_groups_many(self, userdns, batch_size=100):
+        """Get the groups of many users at once.
+
+        Given a sequence of user DNs, return a dictionary mapping every user
+        DN to the groups the user belongs to, in the same form as returned
+        by :meth:`user_groups`.
+
+        If the filter template of the groups query contains a simple clause
+        such as ``(member=%(userdn)s)``, the groups of up to ``batch_size``
+        users are searched with a single query, where this clause is replaced
+        with a disjunction of the clauses for every user.  Otherwise, the
+        groups will be searched for every user separately.
+        """
+        search = self._groups_query()
+        memo = self.groups_memo
+        results = {}
+        if memo:
+            for userdn in userdns:
+                if userdn in memo:
+                    results[userdn] = memo[userdn]
+        userdns = [userdn for userdn in userdns if userdn not in results]
+        if userdns and getattr(search, 'member_clause', None):
+            try:
+                found = search.execute_many(self.manager, dict(
+                    (userdn, escape_for_search(userdn))
+                    for userdn in userdns), batch_size)
+                graph = search.graph
+                if graph is not None:
+                    for userdn, result in found.items():
+                        if result:
+                            found[userdn] = graph.expand(self.manager, result)
+            except LDAPException:
+                logger.debug(
+                    'Exception in user_groups_many with userdns %r', userdns,
+                    exc_info=True)
+                found = dict.fromkeys(userdns)
+            if memo is not None:
+                memo.update(found)
+            results.update(found)
+        else:
+            for userdn in userdns:
+                results[userdn] = self.user_groups(userdn)
+        return results
+
+    def iter_user_groups(self, userdn, page_size=None):
+        """Iterate over the groups the user belongs to.
+
+        This yields the same ``(dn, attrdict)`` tuples as returned by
+        :meth:`user_groups`, but the groups are not cached and fetched page
+        by page from the LDAP server while iterating, with ``page_size``
+        groups per page, so that the memory usage does not depend on the
+        number of groups.  Nested groups are not resolved.
+
+        Unlike :meth:`user_groups`, this raises an ``LDAPException`` if the
+        LDAP server cannot be queried.
+        """
+        search = self._groups_query()
+        iterate = getattr(search, 'iterate', None)
+        if iterate is None:  # the groups are already in memory
+            return iter(self.user_groups(userdn) or ())
+        return iterate(
+            self.manager, page_size, userdn=self._userdn(search, userdn))
+
+    def _groups_query(self):
         search = getattr(self.registry, self.group_query_identifier, None)
         if search is None:
             raise ConfigurationError(
                 'set_ldap_groups_query was not called during setup')
+        return search
+
+    @staticmethod
+    def _userdn(search, userdn):
+        if getattr(search, 'raw_userdn', False):
+            if isinstance(userdn, bytes):
+                userdn = userdn.decode('utf-8')
+        else:
+            userdn = escape_for_search(userdn)
+        return userdn
+
+    def _user_groups(self, userdn):
+        search = self._groups_query()
+        userdn = self._userdn(search, userdn)
         try:
-            result = search.execute(
-                self.manager, userdn=escape_for_search(userdn))
+            result = search.execute(self.manager, userdn=userdn)
+            graph = getattr(search, 'graph', None)
+            if graph is not None and result:
+                result = graph.expand(self.manager, result)
         except LDAPException:
             logger.debug(
                 'Exception in user_groups with userdn %r', userdn,
@@ -265,8 +2740,12 @@ class Connector(object):
 
 def ldap_set_login_query(
         config, base_dn, filter_tmpl,
-        scope=ldap3.LEVEL, attributes=None,
-        cache_period=0, realm=None):
+        scope=ldap3.LEVEL, attributes=None, page_size=0, time_limit=0,
+        compact=False,
+        cache_period=0, cache_size=10000, cache_bytes=0, cache_jitter=0,
+        stale_period=0, stale_if_error=0,
+        negative_cache_period=0, negative_cache_size=1000,
+        cache_backend=None, realm=None):
     """Configurator method to set the LDAP login search.
 
     ``base_dn`` is the DN at which to begin the search.
@@ -276,8 +2755,39 @@ def ldap_set_login_query(
     (e.g. ``ldap3.LEVEL`` or ``ldap3.SUBTREE``).
     ``attributes`` is an optional list of attributes that shall be returned
     (can also be set to None or ``ldap3.ALL_ATTRIBUTES``).
+    ``page_size`` can be set to fetch the search results page by page with
+    that many entries per page, using the paged results control; this is
+    needed if the results exceed the size limit of the server.
+    ``time_limit`` is an optional time limit for the searches in seconds.
+    ``compact`` can be set to True in order to get the results as tuples of
+    compact, immutable entries holding only the requested attributes, which
+    can be cached with less memory; the entries can still be unpacked into
+    the DN and a read-only dictionary of attributes.
     ``cache_period`` is the number of seconds to cache login search results;
     if it is 0 (the default), login search results will not be cached.
+    ``cache_size`` is the maximum number of cached search results
+    (default is 10000, 0 means no limit); the least recently used
+    results will be evicted from the cache when the limit is reached.
+    ``cache_bytes`` is an optional limit for the estimated memory used by
+    cached search results in bytes (default is 0, meaning no limit).
+    ``cache_jitter`` is the maximum fraction of the ``cache_period`` by
+    which the lifetime of a cached result may be randomly shortened, so that
+    results cached at the same time do not all expire at the same time
+    (default is 0, meaning no jitter).
+    ``stale_period`` is the number of seconds after the ``cache_period``
+    during which an expired login search result is still returned while it is
+    refreshed in a background thread (default is 0, meaning no refresh).
+    ``stale_if_error`` is the number of seconds after the ``cache_period``
+    during which an expired login search result is still returned when the
+    LDAP server cannot be queried (default is 0).
+    ``negative_cache_period`` is the number of seconds to cache empty
+    login search results, i.e. logins that could not be found; if it is 0
+    (the default), empty results are cached like all other results.
+    ``negative_cache_size`` is the maximum number of cached empty
+    results (default is 1000, 0 means no limit).
+    ``cache_backend`` is an optional :class:`CacheBackend` that shall be
+    used for caching instead of the default in-RAM cache; if it is not set,
+    the cache backend passed to :func:`ldap_setup` will be used if any.
     ``realm`` is an optional realm for this connection.
     This allows multiple ldap servers to be used.
 
@@ -292,7 +2802,56 @@ def ldap_set_login_query(
     a valid login.
     """
     query_identifier = _add_realm('ldap_login_query', realm)
-    query = _LDAPQuery(base_dn, filter_tmpl, scope, attributes, cache_period)
+    query = _LDAPQuery(
+        base_dn, filter_tmpl, scope, attributes, cache_period,
+        cache_size, cache_bytes, cache_jitter, stale_period, stale_if_error,
+        negative_cache_period, negative_cache_size,
+        page_size, time_limit, compact)
+
+    def register():
+        backend = cache_backend
+        if backend is None:
+            backend = getattr(config.registry, _add_realm(
+                'ldap_cache_backend', realm), None)
+        if backend is not None:
+            query.use_cache(backend, query_identifier)
+        setattr(config.registry, query_identifier, query)
+
+    introspectable_name = '{} login query'.format(
+        _add_realm('pyramid_ldap3', realm))
+    introspectable = config.introspectable(
+        introspectable_name,
+        None,
+        str(query),
+        introspectable_name)
+
+    action_name = 'setup_{}'.format(query_identifier)
+    config.action(action_name, register,
+                  introspectables=(introspectable,))
+
+
+def ldap_set_login_dn(config, dn_tmpl, attributes=None, realm=None):
+    """Configurator method to bind users directly with a DN template.
+
+    This can be used instead of :func:`ldap_set_login_query` if the DN of
+    a user can be derived from the login name, saving the login search.
+    ``dn_tmpl`` is a string which will be used as the DN of the user:
+    it should contain the replacement value ``%(login)s``.
+    ``attributes`` is an optional list of attributes that shall be returned;
+    they will be fetched in the same connection after the user has been bound.
+    If no attributes are specified (the default), no search will be made.
+    ``realm`` is an optional realm for this connection.
+    This allows multiple ldap servers to be used.
+
+    Example::
+
+        config.ldap_set_login_dn(
+            dn_tmpl='uid=%(login)s,ou=people,dc=example,dc=com',
+            attributes=['cn', 'mail'])
+
+    """
+    query_identifier = _add_realm('ldap_login_query', realm)
+    query = _LDAPLoginBind(dn_tmpl, attributes)
 
     def register():
         setattr(config.registry, query_identifier, query)
@@ -312,8 +2871,12 @@ def ldap_set_login_query(
 
 def ldap_set_groups_query(
         config, base_dn, filter_tmpl,
-        scope=ldap3.SUBTREE, attributes=None,
-        cache_period=0, realm=None):
+        scope=ldap3.SUBTREE, attributes=None, page_size=0, time_limit=0,
+        compact=False,
+        cache_period=0, cache_size=10000, cache_bytes=0, cache_jitter=0,
+        stale_period=0, stale_if_error=0,
+        negative_cache_period=0, negative_cache_size=1000,
+        nested=False, nested_cache_period=0, cache_backend=None, realm=None):
     """ Configurator method to set the LDAP groups search.
 
     ``base_dn`` is the DN at which to begin the search.
@@ -323,8 +2886,46 @@ def ldap_set_groups_query(
     (e.g. ``ldap3.LEVEL`` or ``ldap3.SUBTREE``).
     ``attributes`` is an optional list of attributes that shall be returned
     (can also be set to None or ``ldap3.ALL_ATTRIBUTES``).
+    ``page_size`` can be set to fetch the search results page by page with
+    that many entries per page, using the paged results control; this is
+    needed if the results exceed the size limit of the server.
+    ``time_limit`` is an optional time limit for the searches in seconds.
+    ``compact`` can be set to True in order to get the results as tuples of
+    compact, immutable entries holding only the requested attributes, which
+    can be cached with less memory; the entries can still be unpacked into
+    the DN and a read-only dictionary of attributes.
     ``cache_period`` is the number of seconds to cache groups search results;
     if it is 0 (the default), groups search results will not be cached.
+    ``cache_size`` is the maximum number of cached search results
+    (default is 10000, 0 means no limit); the least recently used
+    results will be evicted from the cache when the limit is reached.
+    ``cache_bytes`` is an optional limit for the estimated memory used by
+    cached search results in bytes (default is 0, meaning no limit).
+    ``cache_jitter`` is the maximum fraction of the ``cache_period`` by
+    which the lifetime of a cached result may be randomly shortened, so that
+    results cached at the same time do not all expire at the same time
+    (default is 0, meaning no jitter).
+    ``stale_period`` is the number of seconds after the ``cache_period``
+    during which an expired groups search result is still returned while it is
+    refreshed in a background thread (default is 0, meaning no refresh).
+    ``stale_if_error`` is the number of seconds after the ``cache_period``
+    during which an expired groups search result is still returned when the
+    LDAP server cannot be queried (default is 0).
+    ``negative_cache_period`` is the number of seconds to cache empty
+    groups search results, i.e. for users without groups; if it is 0
+    (the default), empty results are cached like all other results.
+    ``negative_cache_size`` is the maximum number of cached empty
+    results (default is 1000, 0 means no limit).
+    ``nested`` can be set to True in order to also return the groups which
+    contain the groups of the user, recursively.  The parent groups of a
+    group will be found with the same query, using the DN of the group
+    instead of the DN of the user.
+    ``nested_cache_period`` is the number of seconds to cache the parent
+    groups of a group when ``nested`` is set; if it is 0 (the default),
+    the parent groups will not be cached.
+    ``cache_backend`` is an optional :class:`CacheBackend` that shall be
+    used for caching instead of the default in-RAM cache; if it is not set,
+    the cache backend passed to :func:`ldap_setup` will be used if any.
     ``realm`` is an optional realm for this connection.
     This allows multiple ldap servers to be used.
 
@@ -337,7 +2938,145 @@ def ldap_set_groups_query(
 
     """
     query_identifier = _add_realm('ldap_groups_query', realm)
-    query = _LDAPQuery(base_dn, filter_tmpl, scope, attributes, cache_period)
+    query = _LDAPQuery(
+        base_dn, filter_tmpl, scope, attributes, cache_period,
+        cache_size, cache_bytes, cache_jitter, stale_period, stale_if_error,
+        negative_cache_period, negative_cache_size,
+        page_size, time_limit, compact)
+    if nested:
+        query.graph = _LDAPGroupGraph(query, nested_cache_period)
+    elif attributes and list(attributes) != ['1.1']:
+        # without attributes, the query itself only fetches the DNs
+        query.dn_query = _LDAPDNQuery(query)
+
+    def register():
+        backend = cache_backend
+        if backend is None:
+            backend = getattr(config.registry, _add_realm(
+                'ldap_cache_backend', realm), None)
+        if backend is not None:
+            query.use_cache(backend, query_identifier)
+        setattr(config.registry, query_identifier, query)
+
+    introspectable_name = '{} groups query'.format(
+        _add_realm('pyramid_ldap3', realm))
+    introspectable = config.introspectable(
+        introspectable_name,
+        None,
+        str(query),
+        introspectable_name)
+
+    action_name = 'setup_{}'.format(query_identifier)
+    config.action(action_name, register,
+                  introspectables=(introspectable,))
+
+
+def ldap_set_groups_attribute(
+        config, attribute='memberOf',
+        cache_period=0, cache_size=10000, cache_bytes=0, cache_jitter=0,
+        stale_period=0, stale_if_error=0,
+        negative_cache_period=0, negative_cache_size=1000,
+        cache_backend=None, realm=None):
+    """Configurator method to get the groups from an attribute of the user.
+
+    This can be used instead of :func:`ldap_set_groups_query` if the user
+    entries carry the DNs of their groups in an attribute, as it is the case
+    for the ``memberOf`` attribute in Active Directory or in OpenLDAP with
+    the memberof overlay.  Instead of searching for the groups, only the
+    user entry will then be read.
+
+    ``attribute`` is the name of the attribute containing the group DNs
+    (default is ``memberOf``).
+    ``cache_period`` is the number of seconds to cache the groups of a user;
+    if it is 0 (the default), the groups will not be cached.
+    If the groups are cached and the attribute is also returned by the login
+    query, then the groups will already be cached when a user is
+    authenticated, so that no additional search is needed.
+    ``cache_backend`` is an optional :class:`CacheBackend` that shall be
+    used for caching instead of the default in-RAM cache; if it is not set,
+    the cache backend passed to :func:`ldap_setup` will be used if any.
+    The other cache parameters and ``realm`` have the same meaning as in
+    :func:`ldap_set_groups_query`.
+
+    Example::
+
+        config.ldap_set_login_query(
+            base_dn='CN=Users,DC=example,DC=com',
+            filter_tmpl='(sAMAccountName=%(login)s)',
+            attributes=['cn', 'memberOf'],
+            cache_period=600)
+        config.ldap_set_groups_attribute(
+            attribute='memberOf',
+            cache_period=600)
+
+    """
+    query_identifier = _add_realm('ldap_groups_query', realm)
+    query = _LDAPGroupsAttribute(
+        attribute, cache_period,
+        cache_size, cache_bytes, cache_jitter, stale_period, stale_if_error,
+        negative_cache_period, negative_cache_size)
+
+    def register():
+        backend = cache_backend
+        if backend is None:
+            backend = getattr(config.registry, _add_realm(
+                'ldap_cache_backend', realm), None)
+        if backend is not None:
+            query.use_cache(backend, query_identifier)
+        setattr(config.registry, query_identifier, query)
+
+    introspectable_name = '{} groups query'.format(
+        _add_realm('pyramid_ldap3', realm))
+    introspectable = config.introspectable(
+        introspectable_name,
+        None,
+        str(query),
+        introspectable_name)
+
+    action_name = 'setup_{}'.format(query_identifier)
+    config.action(action_name, register,
+                  introspectables=(introspectable,))
+
+
+def ldap_set_groups_index(
+        config, base_dn, group_filter='(objectClass=group)',
+        scope=ldap3.SUBTREE, member_attribute='member', attributes=None,
+        refresh_period=600, page_size=500, realm=None):
+    """Configurator method to look up groups in an index of all groups.
+
+    This can be used instead of :func:`ldap_set_groups_query` if the number
+    of groups is moderate.  All groups will be loaded from the LDAP server
+    periodically, and the groups of a user will be looked up in an index
+    kept in memory instead of searching the LDAP server for every user.
+
+    ``base_dn`` is the DN at which to begin the search for groups.
+    ``group_filter`` is an LDAP filter matching all groups
+    (default is ``(objectClass=group)``).
+    ``scope`` is any valid LDAP scope value
+    (e.g. ``ldap3.LEVEL`` or ``ldap3.SUBTREE``, which is the default).
+    ``member_attribute`` is the name of the attribute containing the DNs of
+    the members of a group (default is ``member``).
+    ``attributes`` is an optional list of group attributes that shall be
+    kept in the index and returned; by default, no attributes are kept.
+    ``refresh_period`` is the number of seconds after which the index will
+    be reloaded in the background (default is 600, 0 means never).
+    ``page_size`` is the number of groups fetched with each page of the
+    paged search (default is 500).
+    ``realm`` is an optional realm for this connection.
+    This allows multiple ldap servers to be used.
+
+    Example::
+
+        config.ldap_set_groups_index(
+            base_dn='CN=Users,DC=example,DC=com',
+            group_filter='(objectCategory=group)',
+            refresh_period=300)
+
+    """
+    query_identifier = _add_realm('ldap_groups_query', realm)
+    query = _LDAPGroupsIndex(
+        base_dn, group_filter, scope, member_attribute, attributes,
+        refresh_period, page_size)
 
     def register():
         setattr(config.registry, query_identifier, query)
@@ -359,7 +3098,16 @@ def ldap_setup(
         config, uri,
         bind=None, passwd=None, use_tls=False,
         use_pool=True, pool_size=10, pool_lifetime=3600,
-        get_info=None, realm=None):
+        get_info=None, realm=None,
+        bind_pool_size=0, bind_pool_lifetime=3600,
+        track_changes=0, track_base_dn=None, track_filter='(objectClass=*)',
+        track_attribute='modifyTimestamp', track_member_attribute='member',
+        cache_backend=None, warm_up=0,
+        latency_aware=False, latency_decay=0.2, quarantine_errors=3,
+        quarantine_period=5, max_quarantine_period=300,
+        health_check_interval=0, hedge_percentile=0, hedge_budget=0.05,
+        breaker_failures=0, breaker_reset_timeout=30,
+        refresh_workers=2, max_refreshes=100, login_workers=16):
     """Configurator method to set up an LDAP connection pool.
 
     - **uri**: ldap server uri(s) **[mandatory]**
@@ -377,16 +3125,106 @@ def ldap_setup(
       for proper formatting of attributes.  **default: None**
     - **realm**: specify a realm for this connection.
       This allows multiple ldap servers to be used.  **default: None**
+    - **bind_pool_size**: size of a separate pool of open connections that
+      are re-bound with the credentials of users in order to authenticate
+      them.  If 0, a new connection will be opened for every authentication.
+      **default: 0**
+    - **bind_pool_lifetime**: number of seconds before recreating a new
+      connection in the bind pool.  **default: 3600**
+    - **track_changes**: number of seconds between polls for changed
+      entries.  Cached query results depending on changed entries will be
+      invalidated.  If 0, changes will not be tracked.  **default: 0**
+    - **track_base_dn**: the DN below which changes shall be tracked.
+      **mandatory when tracking changes**
+    - **track_filter**: filter for the entries which shall be tracked.
+      **default: (objectClass=*)**
+    - **track_attribute**: the attribute used for tracking changes,
+      e.g. ``uSNChanged`` with Active Directory.
+      **default: modifyTimestamp**
+    - **track_member_attribute**: the attribute containing the members of
+      changed groups, whose cached results will be invalidated as well.
+      **default: member**
+    - **cache_backend**: a :class:`CacheBackend` that shall be used for
+      caching the results of the queries for this realm instead of the
+      default in-RAM cache, e.g. a :class:`SQLiteCacheBackend`.
+      **default: None**
+    - **warm_up**: number of pooled connections that shall be opened in
+      advance in a background thread when the first request is handled in
+      a process, e.g. in every worker process of a pre-forking server.
+      If 0, connections will be opened when they are needed.
+      **default: 0**
+    - **latency_aware**: if several server uris are given, new connections
+      will be opened to the healthy server with the lowest latency instead
+      of using the servers in turn.  **default: False**
+    - **latency_decay**: weight of a new measurement in the moving average
+      of the latency of a server.  **default: 0.2**
+    - **quarantine_errors**: number of consecutive communication errors
+      after which a server will not be used for some time.  **default: 3**
+    - **quarantine_period**: number of seconds a failing server will not be
+      used, doubled every time the server fails again.  **default: 5**
+    - **max_quarantine_period**: maximum number of seconds a failing server
+      will not be used.  **default: 300**
+    - **health_check_interval**: number of seconds between checks of the
+      latency and availability of all servers in a background thread.
+      If 0, only the binds will be measured.  **default: 0**
+    - **hedge_percentile**: if several server uris are given, searches which
+      have not been answered after this percentile of the recent response
+      times will be sent to another server as well, and the first response
+      will be used.  Paged searches are never sent twice.  If 0, searches
+      will not be sent twice.  **default: 0**
+    - **hedge_budget**: the maximum fraction of searches that will be sent
+      to another server as well.  **default: 0.05**
+    - **breaker_failures**: number of consecutive communication errors after
+      which the LDAP server will not be contacted any more for some time,
+      letting all operations fail immediately with an
+      :exc:`LDAPCircuitOpenError`.  If 0, the LDAP server will always be
+      contacted.  **default: 0**
+    - **breaker_reset_timeout**: number of seconds after which the LDAP
+      server will be contacted again after it could not be reached.
+      **default: 30**
+    - **refresh_workers**: number of threads refreshing stale query results
+      in the background.  **default: 2**
+    - **max_refreshes**: maximum number of refreshes waiting for one of these
+      threads.  Further stale results will not be refreshed until the
+      number of waiting refreshes has decreased.  **default: 100**
+    - **login_workers**: number of threads used by
+      :func:`authenticate_realms` for searching logins.  These threads are
+      shared by all realms; if different numbers are set up for different
+      realms, the largest number is used.  **default: 16**
     """
     connection_identifier = _add_realm('ldap_connector', realm)
 
+    if track_changes and not track_base_dn:
+        raise ConfigurationError(
+            'track_base_dn must be set when tracking changes')
+
     manager = ConnectionManager(
         uri, bind, passwd, use_tls,
         use_pool, pool_size if use_pool else None,
-        pool_lifetime if use_pool else None, get_info, realm=realm)
+        pool_lifetime if use_pool else None, get_info, realm=realm,
+        bind_pool_size=bind_pool_size, bind_pool_lifetime=bind_pool_lifetime,
+        latency_aware=latency_aware, latency_decay=latency_decay,
+        quarantine_errors=quarantine_errors,
+        quarantine_period=quarantine_period,
+        max_quarantine_period=max_quarantine_period,
+        health_check_interval=health_check_interval,
+        hedge_percentile=hedge_percentile, hedge_budget=hedge_budget,
+        breaker_failures=breaker_failures,
+        breaker_reset_timeout=breaker_reset_timeout,
+        refresh_workers=refresh_workers, max_refreshes=max_refreshes)
+    if track_changes:
+        manager.tracker = _ChangeTracker(
+            manager, config.registry, track_base_dn, track_changes,
+            track_filter, track_attribute, track_member_attribute, realm)
 
     def get_connector(request):
-        return Connector(request.registry, manager, realm)
+        if manager.tracker is not None:
+            manager.tracker.start()
+        if manager.server_pool is not None:
+            manager.server_pool.start()
+        if warm_up:
+            manager.start_warm_up(warm_up)
+        return Connector(request.registry, manager, realm, memoize=True)
 
     config.add_request_method(
         get_connector, connection_identifier, property=True, reify=True)
@@ -397,9 +3235,25 @@ def ldap_setup(
         None,
         str(manager),
         introspectable_name)
+    if manager.breaker is not None:
+        # the breaker shows its current state when being introspected
+        introspectable['circuit_breaker'] = manager.breaker
+
+    def register():
+        if cache_backend is not None:
+            setattr(config.registry, _add_realm(
+                'ldap_cache_backend', realm), cache_backend)
+        workers = getattr(config.registry, 'ldap_login_workers', None)
+        if workers is None:
+            config.registry.ldap_login_workers = _WorkerPool(
+                login_workers, 'pyramid_ldap3 login')
+        elif workers.size < login_workers:
+            workers.size = login_workers
 
     action_name = 'setup_{}'.format(connection_identifier)
-    config.action(action_name, None, introspectables=(introspectable,))
+    # the cache backend must be registered before the queries
+    config.action(action_name, register, order=-1,
+                  introspectables=(introspectable,))
 
 
 def get_ldap_connector_name(realm=None):
@@ -428,6 +3282,95 @@ def get_ldap_connector(request, realm=None):
     return connector
 
 
+# the threads used for searching logins in several realms if not set up
+_login_workers = _WorkerPool(16, 'pyramid_ldap3 login')
+
+
+def authenticate_realms(request, login, password, realms, max_workers=4):
+    """Validate the given login name and password in several realms.
+
+    The login searches are run in parallel for all of the given ``realms``,
+    using at most ``max_workers`` threads at the same time.  The threads
+    are taken from a pool shared by all calls, whose size can be set with
+    the ``login_workers`` parameter of :func:`ldap_setup`, so that the
+    number of threads stays bounded even if many users log in at the same
+    time; searches wait until a thread is available.
+
+    The password is checked in the first realm in which exactly one entry
+    has been found for the login.  If the password is not correct, the next
+    realm in which the login has been found is tried, and so on.  Searches
+    in the remaining realms are not started any more or their results are
+    ignored.  Realms in which the user is bound directly with a DN built
+    from the login (see :func:`ldap_set_login_dn`) are only tried after
+    that, one after the other in the given order, so that the password is
+    not sent to these realms unless needed.
+
+    Returns a tuple ``(realm, (dn, attrdict))`` with the realm in which the
+    user has been authenticated, or ``None`` if the user could not be
+    authenticated in any realm.  If the login search failed in some realm
+    and the user could not be authenticated in any other realm, the
+    exception is raised.
+    """
+    if password == '':
+        return None
+    # get the connectors and queries in the thread of the request
+    pending = Queue()
+    binds = []
+    for realm in realms:
+        connector = get_ldap_connector(request, realm)
+        query = connector._login_query()
+        if isinstance(query, _LDAPLoginBind):
+            binds.append((realm, connector, query))
+        else:
+            pending.put((realm, connector, query))
+    num_realms = pending.qsize()
+    results = Queue()
+    done = Event()
+
+    def search():
+        while not done.is_set():
+            try:
+                realm, connector, query = pending.get_nowait()
+            except Empty:
+                break
+            try:
+                result = connector._search_login(query, login, password)
+            except Exception as exc:
+                logger.debug(
+                    'Exception in authenticate with login %r in realm %r',
+                    login, realm, exc_info=True)
+                result = exc
+            results.put((realm, connector, query, result))
+
+    workers = getattr(request.registry, 'ldap_login_workers', None)
+    if workers is None:
+        workers = _login_workers
+    for _n in range(min(max_workers, num_realms)):
+        workers.submit(search)
+
+    error = None
+    try:
+        for _n in range(num_realms):
+            realm, connector, query, result = results.get()
+            if isinstance(result, Exception):
+                if error is None:
+                    error = result
+                continue
+            if result is not None:
+                result = connector._bind_login(result, login, password)
+            if result is not None:
+                return realm, result
+    finally:
+        done.set()
+    for realm, connector, query in binds:
+        result = connector._search_login(query, login, password)
+        if result is not None:
+            return realm, result
+    if error is not None:
+        raise error
+    return None
+
+
 def get_groups(userdn, request):
     """Raw groupfinder function returning the complete group query result."""
     connector = get_ldap_connector(request)
@@ -442,14 +3385,125 @@ def groupfinder(userdn, request):
     belonging to the user specified by ``userdn`` to as a principal
     in the list of results; if the user does not exist, it returns None.
     """
-    groups = get_groups(userdn, request)
-    if groups:
-        groups = [r[0] for r in groups]
-    return groups
+    connector = get_ldap_connector(request)
+    return connector.user_group_dns(userdn)
+
+
+class LDAPAuthTktAuthenticationPolicy(AuthTktAuthenticationPolicy):
+    """Auth ticket policy which stores the groups of the user in the ticket.
+
+    The groups are looked up with the ``callback`` (by default, this is the
+    :func:`groupfinder` of this package) when the ticket is created with
+    ``remember()``, and they are stored in compressed form as a token in the
+    ticket, which is signed with the ``secret``.  On subsequent requests, the
+    groups will be taken from the ticket without querying the LDAP server,
+    until they are older than ``groups_max_age`` seconds (default is 300).
+    Then they will be looked up again and the ticket will be reissued.
+
+    If the encoded groups would be longer than ``groups_max_size`` bytes
+    (default is 2000), they will not be stored in the ticket, since cookies
+    are limited in size; the groups will then be looked up on every request.
+
+    All other parameters are passed to
+    :class:`pyramid.authentication.AuthTktAuthenticationPolicy`.
+    """
+
+    groups_token_prefix = 'ldapgroups'
+
+    def __init__(self, secret, callback=None,
+                 groups_max_age=300, groups_max_size=2000, **kw):
+        super(LDAPAuthTktAuthenticationPolicy, self).__init__(
+            secret, callback=self.find_groups, **kw)
+        self.groupfinder = callback or groupfinder
+        self.groups_max_age = groups_max_age
+        self.groups_max_size = groups_max_size
+
+    def encode_groups(self, groups, now=None):
+        """Encode the group DNs as a token, or return None if too large."""
+        if now is None:
+            now = time()
+        data = '\n'.join(['{:d}'.format(int(now))] + list(groups))
+        data = urlsafe_b64encode(zlib.compress(data.encode('utf-8')))
+        token = self.groups_token_prefix + data.decode('ascii').rstrip('=')
+        if len(token) > self.groups_max_size:
+            logger.debug('too many groups to store them in the ticket')
+            return None
+        return token
+
+    def decode_groups(self, token):
+        """Decode the group DNs from a token.
+
+        Returns a tuple of the time when the groups were looked up and the
+        list of group DNs, or None if the token cannot be decoded.
+        """
+        data = token[len(self.groups_token_prefix):]
+        data += '=' * (-len(data) % 4)
+        try:
+            data = zlib.decompress(urlsafe_b64decode(data.encode('ascii')))
+            data = data.decode('utf-8').split('\n')
+            return int(data[0]), data[1:]
+        except (TypeError, ValueError, zlib.error):
+            return None
+
+    def remember(self, request, userid, **kw):
+        """Remember the user and the groups of the user in the ticket."""
+        groups = self.groupfinder(userid, request)
+        kw['tokens'] = self._tokens(groups, kw.get('tokens'))
+        return super(LDAPAuthTktAuthenticationPolicy, self).remember(
+            request, userid, **kw)
+
+    def find_groups(self, userid, request):
+        """Get the groups from the ticket or look them up if needed.
+
+        If the groups in the ticket are outdated, the ticket is reissued
+        with the groups that have been looked up again.
+        """
+        identity = self.cookie.identify(request)
+        if not identity or identity['userid'] != userid:
+            return self.groupfinder(userid, request)
+        prefix = self.groups_token_prefix
+        for token in identity['tokens']:
+            if token.startswith(prefix):
+                break
+        else:  # the groups are not stored in the ticket
+            return self.groupfinder(userid, request)
+        decoded = self.decode_groups(token)
+        if decoded:
+            timestamp, groups = decoded
+            if time() - timestamp <= self.groups_max_age:
+                return groups
+        groups = self.groupfinder(userid, request)
+        if not getattr(request, '_ldap_groups_reissued', False):
+            request._ldap_groups_reissued = True
+            headers = super(LDAPAuthTktAuthenticationPolicy, self).remember(
+                request, userid, max_age=self.cookie.max_age,
+                tokens=self._tokens(groups, identity['tokens']))
+
+            def reissue_ticket(request, response):
+                response.headerlist.extend(headers)
+
+            # the ticket must not be reissued with the outdated groups
+            request._authtkt_reissue_revoked = True
+            request.add_response_callback(reissue_ticket)
+        return groups
+
+    def _tokens(self, groups, tokens=None):
+        """Replace the groups token in the given tokens."""
+        tokens = [token for token in tokens or ()
+                  if token and not token.startswith(self.groups_token_prefix)]
+        if groups is not None:
+            token = self.encode_groups(groups)
+            if token:
+                tokens.append(token)
+        return tokens
 
 
 def includeme(config):
     """Set up Configurator methods for pyramid_ldap3."""
     config.add_directive('ldap_setup', ldap_setup)
     config.add_directive('ldap_set_login_query', ldap_set_login_query)
+    config.add_directive('ldap_set_login_dn', ldap_set_login_dn)
     config.add_directive('ldap_set_groups_query', ldap_set_groups_query)
+    config.add_directive(
+        'ldap_set_groups_attribute', ldap_set_groups_attribute)
+    config.add_directive('ldap_set_groups_index', ldap_set_groups_index)
@@ -0,0 +1,347 @@
+"""Asyncio interface for pyramid_ldap3.
+
+This module can only be used with Python 3.5 and newer.
+"""
+
+import asyncio
+import os
+
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from threading import Lock
+
+from ldap3 import get_config_parameter
+
+from . import (
+    LDAPException, _LDAPLoginBind, _LDAPQuery, _get_ranges, _range_option,
+    _server_errors, escape_for_search, get_ldap_connector, logger)
+
+__all__ = ['AsyncConnector', 'get_async_ldap_connector']
+
+
+def _wake(future):
+    if not future.done():
+        future.set_result(None)
+
+
+class _AsyncConnection(object):
+    """A connection using the asynchronous strategy of ldap3.
+
+    The receiver thread of the connection signals complete responses to the
+    strategy, and the coroutines waiting for these responses are woken up
+    in their event loop, so that no thread is needed for waiting.  When the
+    connection is closed, all waiting coroutines are woken up as well.
+    All other attributes are delegated to the actual connection.
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.waiters = {}
+        self.lock = Lock()
+        strategy = conn.strategy
+        self._set_event, self._close = (
+            strategy.set_event_for_message, strategy.close)
+        strategy.set_event_for_message = self.set_event_for_message
+        strategy.close = self.close
+
+    def __getattr__(self, name):
+        return getattr(self.conn, name)
+
+    def set_event_for_message(self, message_id):
+        self._set_event(message_id)
+        with self.lock:
+            waiter = self.waiters.pop(message_id, None)
+        if waiter is not None:
+            waiter[0].call_soon_threadsafe(_wake, waiter[1])
+
+    def close(self):
+        try:
+            self._close()
+        finally:
+            with self.lock:
+                waiters, self.waiters = self.waiters, {}
+            for loop, future in waiters.values():
+                loop.call_soon_threadsafe(_wake, future)
+
+    async def get_response(self, message_id):
+        """Wait for the response to the message with the given id."""
+        strategy = self.conn.strategy
+        if not strategy.no_real_dsa:  # mocked responses are already there
+            loop = asyncio.get_event_loop()
+            future = loop.create_future()
+            with self.lock:
+                self.waiters[message_id] = loop, future
+            try:
+                # the response may have arrived before the waiter was added
+                if not strategy._get_event_for_message(message_id).is_set():
+                    await asyncio.wait_for(
+                        future,
+                        get_config_parameter('RESPONSE_WAITING_TIMEOUT'))
+            except asyncio.TimeoutError:
+                pass  # raised as an LDAP exception below
+            finally:
+                with self.lock:
+                    self.waiters.pop(message_id, None)
+        return self.conn.get_response(message_id, timeout=0)
+
+
+class _AsyncPool(object):
+    """Runs the LDAP operations of the coroutines in one event loop.
+
+    Searches are sent over a shared connection using the asynchronous
+    strategy, and their responses are awaited without occupying a thread.
+    The other blocking LDAP operations are run in a thread pool.  At most
+    ``size`` of these operations are run at the same time, further
+    operations are queued without occupying a thread until one of the
+    running operations has finished.  Identical operations which are
+    awaited at the same time are coalesced into one.
+    """
+
+    def __init__(self, manager, size=10):
+        self.manager = manager
+        self.size = size
+        self.executor = ThreadPoolExecutor(size)
+        self.flights = {}
+        self.conn = None
+
+    def __str__(self):
+        return 'size={size}, flights={flights}'.format(
+            size=self.size, flights=len(self.flights))
+
+    def run(self, func, *args, **kw):
+        """Run the given function in the thread pool."""
+        loop = asyncio.get_event_loop()
+        return loop.run_in_executor(self.executor, partial(func, *args, **kw))
+
+    def run_once(self, key, func, *args, **kw):
+        """Await the result of the given function unless already running.
+
+        The function must return an awaitable, such as a coroutine.
+
+        Operations are considered identical if they are using the same key.
+        """
+        future = self.flights.get(key)
+        if future is None:
+            future = self.flights[key] = asyncio.ensure_future(
+                func(*args, **kw))
+            future.add_done_callback(lambda f: self.flights.pop(key, None))
+        else:
+            logger.debug('waiting for operation in flight for %r', key)
+        # cancelling one waiter shall not cancel the others
+        return asyncio.shield(future)
+
+    async def connection(self):
+        """Get the shared connection, opening it if necessary."""
+        conn = self.conn
+        if conn is None or conn.closed:
+            conn = await self.run_once(('connection',), self._connect)
+        return conn
+
+    async def _connect(self):
+        conn = self.conn = _AsyncConnection(
+            await self.run(self.manager.async_connection))
+        return conn
+
+    def discard(self, conn):
+        """Stop using the given connection after a communication error."""
+        if self.conn is conn:
+            self.conn = None
+        self.run(self._unbind, conn)
+
+    @staticmethod
+    def _unbind(conn):
+        try:
+            conn.unbind()
+        except LDAPException:
+            logger.debug('Exception when closing async connection',
+                         exc_info=True)
+
+    async def search(self, search, cache_key):
+        """Search the LDAP server and cache the result."""
+        breaker = getattr(self.manager, 'breaker', None)
+        if breaker is not None:
+            breaker.allow()
+        conn = None
+        try:
+            conn = await self.connection()
+            kw = dict(search_scope=search.scope, attributes=search.attributes)
+            if search.time_limit:
+                kw['time_limit'] = search.time_limit
+            result, ret = await conn.get_response(
+                conn.search(*cache_key, **kw))
+            if result and any(
+                    _range_option.match(key)
+                    for r in result for key in r.get('attributes') or ()):
+                result = await self.run(_get_ranges, conn.conn, result)
+        except _server_errors:
+            if breaker is not None:
+                breaker.failure()
+            if conn is not None:
+                self.discard(conn)
+            raise
+        except LDAPException:
+            if breaker is not None:
+                breaker.success()  # the server has answered
+            raise
+        if breaker is not None:
+            breaker.success()
+        if result is not None:
+            result = search.convert(result)
+        return search.store(cache_key, result)
+
+
+class AsyncConnector(object):
+    """Provides the API methods of a connector as coroutines.
+
+    The asynchronous connector wraps a :class:`pyramid_ldap3.Connector` and
+    uses the same configuration, queries and caches.  Results that can be
+    taken from the cache are returned immediately.  Searches are sent over
+    a connection using the asynchronous strategy that is shared by all
+    asynchronous connectors for the same LDAP server and event loop, and
+    many of them can be in flight at the same time without occupying a
+    thread.  Binds, paged and hedged searches and the resolution of nested
+    groups are still blocking and are run in a thread pool, with as many
+    threads as there are pooled connections.
+    """
+
+    def __init__(self, connector):
+        self.connector = connector
+
+    @property
+    def pool(self):
+        """The pool used for the current event loop."""
+        manager = self.connector.manager
+        if manager.pid != os.getpid():
+            manager.after_fork()
+        loop = asyncio.get_event_loop()
+        pool = manager.async_pools.get(loop)
+        if pool is None:
+            pool = manager.async_pools[loop] = _AsyncPool(
+                manager, manager.pool_size or 10)
+        return pool
+
+    def _awaitable(self, search):
+        """Check whether the given query can be awaited without a thread."""
+        return isinstance(search, _LDAPQuery) and not search.page_size and (
+            getattr(self.connector.manager, 'hedger', None) is None)
+
+    async def authenticate(self, login, password):
+        """Validate the given login name and password.
+
+        See :meth:`pyramid_ldap3.Connector.authenticate`.
+        """
+        if password == '':
+            return None
+        connector = self.connector
+        search = connector._login_query()
+        if isinstance(search, _LDAPLoginBind) or not self._awaitable(search):
+            return await self.pool.run(
+                connector.authenticate, login, password)
+        result = await self.execute(
+            search, login=escape_for_search(login),
+            password=escape_for_search(password))
+        if not result or len(result) > 1:
+            return None
+        return await self.pool.run(
+            connector._bind_login, result[0], login, password)
+
+    async def user_groups(self, userdn):
+        """Get the groups the user belongs to.
+
+        See :meth:`pyramid_ldap3.Connector.user_groups`.
+        """
+        connector = self.connector
+        memo = connector.groups_memo
+        if memo is not None and userdn in memo:
+            return memo[userdn]
+        search = connector._groups_query()
+        if self._awaitable(search) and search.graph is None:
+            try:
+                result = await self.execute(
+                    search, userdn=connector._userdn(search, userdn))
+            except LDAPException:
+                logger.debug(
+                    'Exception in user_groups with userdn %r', userdn,
+                    exc_info=True)
+                result = None
+        else:
+            pool = self.pool
+            result = await pool.run_once(
+                ('user_groups', userdn), pool.run,
+                connector._user_groups, userdn)
+        if memo is not None:
+            memo[userdn] = result
+        return result
+
+    async def user_group_dns(self, userdn):
+        """Get the DNs of the groups the user belongs to.
+
+        See :meth:`pyramid_ldap3.Connector.user_group_dns`.
+        """
+        connector = self.connector
+        memo = connector.group_dns_memo
+        if memo is not None and userdn in memo:
+            return memo[userdn]
+        search = connector._groups_query()
+        dn_query = getattr(search, 'dn_query', None)
+        if dn_query is None:
+            groups = await self.user_groups(userdn)
+            return groups if groups is None else [r[0] for r in groups]
+        userdn_value = connector._userdn(dn_query, userdn)
+        try:
+            groups = search.cached(userdn=userdn_value)
+            if groups is None:
+                result = list(await self.execute(
+                    dn_query, userdn=userdn_value))
+            else:
+                result = [r[0] for r in groups]
+        except LDAPException:
+            logger.debug(
+                'Exception in user_group_dns with userdn %r', userdn,
+                exc_info=True)
+            result = None
+        if memo is not None:
+            memo[userdn] = result
+        return result
+
+    async def execute(self, search, **kw):
+        """Execute the given query with the given parameters.
+
+        The query is one of the queries that have been set up with the
+        configurator methods, e.g. ``registry.ldap_login_query``.  Unlike
+        the other methods, this raises an ``LDAPException`` if the LDAP
+        server cannot be queried.
+        """
+        result = search.cached(**kw)
+        if result is not None:
+            return result
+        manager = self.connector.manager
+        pool = self.pool
+        if not self._awaitable(search):
+            key = (id(search),) + tuple(sorted(kw.items()))
+            return await pool.run_once(
+                key, pool.run, search.execute, manager, **kw)
+        cache_key = (search.base_dn % kw, search.filter_tmpl % kw)
+        logger.debug('searching for %r', cache_key)
+        result, stale = search.lookup(manager, cache_key)
+        if result is None:
+            try:
+                result = await pool.run_once(
+                    (id(search),) + cache_key, pool.search, search, cache_key)
+            except LDAPException:
+                if stale is None:
+                    raise
+                logger.warning(
+                    'search for %r failed, using stale result',
+                    cache_key, exc_info=True)
+                result = stale
+        return result
+
+
+def get_async_ldap_connector(request, realm=None):
+    """Return an asynchronous LDAP connector for the request.
+
+    The asynchronous connector wraps the connector attached to the request.
+    You can also specify the ``realm`` for the connector.
+    """
+    return AsyncConnector(get_ldap_connector(request, realm))
@@ -1,3 +1,4 @@
+from os import getpid
 from unittest import TestCase
 
 from pyramid.testing import DummyRequest
@@ -6,7 +7,7 @@ from pyramid.exceptions import ConfigurationError
 __all__ = [
     'ConfigurationError', 'Dummy', 'DummyConfig', 'DummyLdap3',
     'DummyLDAPConnector', 'DummyManager', 'DummyRequest', 'DummySearch',
-    'TestCase']
+    'TestCase', 'mock_manager']
 
 
 class DummyLDAPConnector(object):
@@ -18,6 +19,10 @@ class DummyLDAPConnector(object):
     def user_groups(self, userdn):
         return self.group_list
 
+    def user_group_dns(self, userdn):
+        groups = self.user_groups(userdn)
+        return groups if groups is None else [r[0] for r in groups]
+
 
 class Dummy(object):
 
@@ -25,14 +30,22 @@ class Dummy(object):
         pass
 
 
+class DummyIntrospectable(dict):
+
+    def __init__(self, category_name, discriminator, title, type_name):
+        dict.__init__(self)
+        self.title = title
+
+
 class DummyConfig(object):
 
-    introspectable = Dummy
+    introspectable = DummyIntrospectable
 
     def __init__(self):
         self.registry = Dummy()
         self.directives = []
         self.req_method = self.req_method_args = None
+        self.introspectables = []
 
     # noinspection PyUnusedLocal
     def add_directive(self, name, directive):
@@ -43,15 +56,21 @@ class DummyConfig(object):
         self.req_method_args = name, property, reify
 
     # noinspection PyUnusedLocal
-    @staticmethod
-    def action(discriminator, action_task, introspectables=()):
+    def action(self, discriminator, action_task, order=0, introspectables=()):
+        self.introspectables.extend(introspectables)
         if action_task:
             action_task()
 
 
 class DummyManager(object):
 
+    pool_size = None
+
     def __init__(self, with_error=None, with_result=None):
+        from pyramid_ldap3 import _WorkerPool
+        self.pid = getpid()
+        self.async_pools = {}
+        self.refresh_workers = _WorkerPool(2, 'pyramid_ldap3 refresh', 100)
         self.with_error = with_error
         self.with_result = with_result
         self.user = self.password = None
@@ -73,6 +92,9 @@ class DummyManager(object):
         self.bind()
         return self
 
+    def paged_connection(self):
+        return self.connection()
+
     def bind(self):
         self.bound = True
         return False
@@ -85,6 +107,7 @@ class DummyManager(object):
             raise AssertionError('connection not yet bound')
         self.search_args = args
         self.search_kwargs = kwargs
+        self.response = self.with_result
         self.result_id += 1
         return self.result_id
 
@@ -139,6 +162,39 @@ class DummyLdap3Connection(object):
         self.pool_name = pool_name
         self.pool_size = pool_size
         self.pool_lifetime = pool_lifetime
+        self.closed = True
+        self.bound = False
+
+    def rebind(self, user=None, password=None):
+        self.closed = False
+        self.user = user
+        self.password = password
+        self.bound = password == 'secret'
+        return self.bound
+
+    def unbind(self):
+        self.closed = True
+        self.bound = False
+
+    def open(self):
+        self.closed = False
+
+    def bind(self):
+        return self.rebind(self.user, self.password)
+
+    def search(self, base, filter_str, search_scope=None, attributes=None):
+        self.searches = getattr(self, 'searches', 0) + 1
+        return self.searches
+
+    def get_response(self, msg_id):
+        return [], {'result': 0}
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
 
 
 class DummyLdap3(object):
@@ -152,3 +208,22 @@ class DummyLdap3(object):
 
     Server = DummyLdap3Server
     Connection = DummyLdap3Connection
+
+
+def mock_manager(entries):
+    """Get a connection manager for a mocked LDAP server with given entries.
+
+    The entries must be given as a dictionary mapping DNs to attributes.
+    The manager binds as ``cn=admin,o=org`` with password ``secret``.
+    """
+    import ldap3
+    from pyramid_ldap3 import ConnectionManager
+    manager = ConnectionManager(
+        'mockhost', 'cn=admin,o=org', 'secret', use_pool=False)
+    manager.strategy = ldap3.MOCK_ASYNC
+    conn = ldap3.Connection(
+        manager.server, client_strategy=ldap3.MOCK_ASYNC)
+    conn.strategy.add_entry('cn=admin,o=org', {'userPassword': 'secret'})
+    for dn, attributes in entries.items():
+        conn.strategy.add_entry(dn, attributes)
+    return manager
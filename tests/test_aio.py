@@ -0,0 +1,253 @@
+import sys
+
+from unittest import skipIf
+
+from . import (
+    TestCase, Dummy, DummyManager, DummyRequest, DummySearch, mock_manager)
+
+
+def run(*coros):
+    import asyncio
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        if len(coros) == 1:
+            return loop.run_until_complete(coros[0])
+        return loop.run_until_complete(asyncio.gather(*coros))
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
+
+
+@skipIf(sys.version_info < (3, 5), 'asyncio interface needs Python 3.5')
+class TestAsyncConnector(TestCase):
+
+    def _make_one(self, registry, manager, memoize=False):
+        from pyramid_ldap3 import Connector
+        from pyramid_ldap3.aio import AsyncConnector
+        return AsyncConnector(Connector(registry, manager, memoize=memoize))
+
+    def _manager(self):
+        return mock_manager({
+            'cn=fred,o=org': {
+                'objectClass': 'person', 'userPassword': 'secret'},
+            'cn=a,o=org': {
+                'objectClass': 'groupOfNames', 'member': ['cn=fred,o=org']}})
+
+    def test_authenticate(self):
+        from pyramid_ldap3 import _LDAPLoginBind
+        manager = DummyManager()
+        registry = Dummy()
+        registry.ldap_login_query = _LDAPLoginBind('uid=%(login)s,o=org')
+        inst = self._make_one(registry, manager)
+        self.assertEqual(
+            run(inst.authenticate('fred', 'flint')), ('uid=fred,o=org', {}))
+        self.assertEqual(manager.user, 'uid=fred,o=org')
+        self.assertIsNone(run(inst.authenticate('fred', '')))
+
+    def test_user_groups(self):
+        from pyramid_ldap3 import _LDAPQuery
+        manager = self._manager()
+        search = _LDAPQuery(
+            'o=org', '(member=%(userdn)s)', 'SUBTREE', ['cn'], 600)
+        registry = Dummy()
+        registry.ldap_groups_query = search
+        inst = self._make_one(registry, manager, memoize=True)
+        groups = [('cn=a,o=org', {'cn': ['a']})]
+        self.assertEqual(run(inst.user_groups('cn=fred,o=org')), groups)
+        self.assertEqual(inst.connector.groups_memo['cn=fred,o=org'], groups)
+        self.assertEqual(
+            search.cached(userdn='cn=fred,o=org'), groups)
+        # must be taken from the cache
+        inst = self._make_one(registry, mock_manager({}))
+        self.assertEqual(run(inst.user_groups('cn=fred,o=org')), groups)
+        self.assertEqual(run(inst.user_groups('cn=barney,o=org')), [])
+
+    def test_user_group_dns(self):
+        from pyramid_ldap3 import _LDAPQuery, _LDAPDNQuery
+        manager = self._manager()
+        search = _LDAPQuery(
+            'o=org', '(member=%(userdn)s)', 'SUBTREE', ['cn'], 600)
+        registry = Dummy()
+        registry.ldap_groups_query = search
+        inst = self._make_one(registry, manager, memoize=True)
+        self.assertEqual(
+            run(inst.user_group_dns('cn=fred,o=org')), ['cn=a,o=org'])
+        search.dn_query = _LDAPDNQuery(search)
+        inst = self._make_one(registry, manager, memoize=True)
+        self.assertEqual(
+            run(inst.user_group_dns('cn=fred,o=org')), ['cn=a,o=org'])
+        self.assertEqual(
+            inst.connector.group_dns_memo, {'cn=fred,o=org': ['cn=a,o=org']})
+
+    def test_concurrent_operations_are_coalesced(self):
+        import asyncio
+        from threading import Event, Thread
+        manager = self._manager()
+        started, release = Event(), Event()
+        calls = []
+
+        class SlowSearch(DummySearch):
+
+            def cached(self, **kw):
+                return None
+
+            def execute(self, manager, **kw):
+                calls.append(kw)
+                started.set()
+                release.wait(5)
+                return super(SlowSearch, self).execute(manager, **kw)
+
+        search = SlowSearch([('cn=a,o=org', {})])
+        inst = self._make_one(Dummy(), manager)
+
+        def release_later():
+            started.wait(5)
+            release.set()
+
+        Thread(target=release_later).start()
+
+        async def execute():
+            results = await asyncio.gather(*(
+                inst.execute(search, userdn='cn=fred,o=org')
+                for _n in range(20)))
+            return results, inst.pool.flights
+
+        results, flights = run(execute())
+        self.assertEqual(results, [[('cn=a,o=org', {})]] * 20)
+        self.assertEqual(calls, [{'userdn': 'cn=fred,o=org'}])
+        self.assertEqual(flights, {})
+
+    def test_searches_share_one_connection(self):
+        import asyncio
+        from pyramid_ldap3 import _LDAPQuery
+        manager = self._manager()
+        connections = []
+        async_connection = manager.async_connection
+
+        def count_connections():
+            connections.append(None)
+            return async_connection()
+
+        manager.async_connection = count_connections
+        search = _LDAPQuery(
+            'o=org', '(member=%(userdn)s)', 'SUBTREE', ['cn'], 0)
+        inst = self._make_one(Dummy(), manager)
+
+        async def execute(names):
+            return await asyncio.gather(*(
+                inst.execute(search, userdn='cn={},o=org'.format(name))
+                for name in names))
+
+        async def execute_twice():
+            first = await execute(['fred', 'barney'])
+            inst.pool.conn.unbind()  # the next search must reconnect
+            second = await execute(['fred'])
+            return first + second
+
+        groups = [('cn=a,o=org', {'cn': ['a']})]
+        self.assertEqual(run(execute(['fred', 'barney', 'wilma'])),
+                         [groups, [], []])
+        self.assertEqual(len(connections), 1)
+        self.assertEqual(run(execute_twice()), [groups, [], groups])
+        self.assertEqual(len(connections), 3)
+
+    def test_pool_per_event_loop(self):
+        manager = self._manager()
+        inst = self._make_one(Dummy(), manager)
+
+        async def pools():
+            return (inst.pool, self._make_one(Dummy(), manager).pool,
+                    list(manager.async_pools.values()))
+
+        pool, other_pool, all_pools = run(pools())
+        self.assertIs(other_pool, pool)
+        self.assertEqual(pool.size, 10)
+        self.assertEqual(all_pools, [pool])
+        self.assertIsNot(run(pools())[0], pool)
+        manager.pid = -1  # pretend that we are in a forked process
+        pool, other_pool, all_pools = run(pools())
+        self.assertEqual(all_pools, [pool])
+
+
+class DummyAsyncStrategy(object):
+
+    no_real_dsa = False
+
+    def __init__(self):
+        self.events = {}
+        self.closed = False
+
+    def set_event_for_message(self, message_id):
+        self._get_event_for_message(message_id).set()
+
+    def _get_event_for_message(self, message_id):
+        from threading import Event
+        return self.events.setdefault(message_id, Event())
+
+    def close(self):
+        self.closed = True
+
+
+class DummyAsyncConnection(object):
+
+    def __init__(self):
+        self.strategy = DummyAsyncStrategy()
+        self.responses = {}
+
+    def get_response(self, message_id, timeout=None):
+        from pyramid_ldap3 import _LDAPResponseTimeoutError
+        try:
+            return self.responses.pop(message_id), {'result': 0}
+        except KeyError:
+            raise _LDAPResponseTimeoutError('no response')
+
+
+@skipIf(sys.version_info < (3, 5), 'asyncio interface needs Python 3.5')
+class TestAsyncConnection(TestCase):
+
+    def _make_one(self):
+        from pyramid_ldap3.aio import _AsyncConnection
+        return _AsyncConnection(DummyAsyncConnection())
+
+    def test_response_is_awaited(self):
+        from threading import Timer
+        conn = self._make_one()
+
+        def receive():
+            conn.responses[1] = ['entry']
+            conn.strategy.set_event_for_message(1)
+
+        Timer(0.05, receive).start()
+        self.assertEqual(run(conn.get_response(1)), (['entry'], {'result': 0}))
+        self.assertEqual(conn.waiters, {})
+
+    def test_response_has_already_arrived(self):
+        conn = self._make_one()
+        conn.responses[1] = ['entry']
+        conn.strategy.set_event_for_message(1)
+        self.assertEqual(run(conn.get_response(1)), (['entry'], {'result': 0}))
+
+    def test_closing_wakes_up_waiters(self):
+        from threading import Timer
+        from pyramid_ldap3 import _LDAPResponseTimeoutError
+        conn = self._make_one()
+        Timer(0.05, conn.strategy.close).start()
+        self.assertRaises(
+            _LDAPResponseTimeoutError, run,
+            conn.get_response(1), conn.get_response(2))
+        self.assertTrue(conn.strategy.closed)
+        self.assertEqual(conn.waiters, {})
+
+
+@skipIf(sys.version_info < (3, 5), 'asyncio interface needs Python 3.5')
+class TestGetAsyncLdapConnector(TestCase):
+
+    def test_with_connector(self):
+        from pyramid_ldap3 import Connector
+        from pyramid_ldap3.aio import get_async_ldap_connector
+        request = DummyRequest()
+        connector = Connector(None, mock_manager({}), 'test_realm')
+        request.ldap_connector_test_realm = connector
+        inst = get_async_ldap_connector(request, 'test_realm')
+        self.assertIs(inst.connector, connector)
@@ -0,0 +1,91 @@
+from . import TestCase, DummyRequest, DummyLDAPConnector
+
+
+class TestLDAPAuthTktAuthenticationPolicy(TestCase):
+
+    def _make_one(self, **kw):
+        from pyramid_ldap3 import LDAPAuthTktAuthenticationPolicy
+        return LDAPAuthTktAuthenticationPolicy('seekr1t', **kw)
+
+    def _request(self, groups, headers=None):
+        request = DummyRequest()
+        request.ldap_connector = DummyLDAPConnector(groups)
+        if headers:
+            name, value = headers[0][1].split(';', 1)[0].split('=', 1)
+            request.cookies[name] = value.strip('"')
+        return request
+
+    def test_encode_and_decode_groups(self):
+        inst = self._make_one()
+        groups = ['cn=a,o=org', u'cn=\xe4,o=org']
+        token = inst.encode_groups(groups, now=1000)
+        self.assertTrue(token.startswith('ldapgroups'))
+        self.assertNotIn('=', token)
+        self.assertEqual(inst.decode_groups(token), (1000, groups))
+        self.assertIsNone(inst.decode_groups('ldapgroupsxyz'))
+
+    def test_encode_too_many_groups(self):
+        inst = self._make_one(groups_max_size=100)
+        groups = ['cn=group{:d},o=org'.format(n) for n in range(1000)]
+        self.assertIsNone(inst.encode_groups(groups))
+
+    def test_groups_taken_from_ticket(self):
+        inst = self._make_one()
+        request = self._request([('cn=a,o=org', {})])
+        headers = inst.remember(request, 'cn=fred,o=org')
+        request = self._request(None, headers)
+        self.assertEqual(
+            inst.effective_principals(request)[-2:],
+            ['cn=fred,o=org', 'cn=a,o=org'])
+        self.assertFalse(request.response_callbacks)
+
+    def test_user_without_groups(self):
+        inst = self._make_one()
+        request = self._request([])
+        headers = inst.remember(request, 'cn=fred,o=org')
+        request = self._request(None, headers)
+        self.assertEqual(inst.find_groups('cn=fred,o=org', request), [])
+
+    def test_unknown_user(self):
+        inst = self._make_one()
+        request = self._request(None)
+        headers = inst.remember(request, 'cn=fred,o=org')
+        request = self._request([('cn=a,o=org', {})], headers)
+        self.assertEqual(
+            inst.find_groups('cn=fred,o=org', request), ['cn=a,o=org'])
+        self.assertFalse(request.response_callbacks)
+
+    def test_outdated_groups_are_looked_up(self):
+        inst = self._make_one(groups_max_age=-1)
+        request = self._request([('cn=a,o=org', {})])
+        headers = inst.remember(request, 'cn=fred,o=org')
+        request = self._request([('cn=b,o=org', {})], headers)
+        self.assertEqual(
+            inst.find_groups('cn=fred,o=org', request), ['cn=b,o=org'])
+        self.assertEqual(len(request.response_callbacks), 1)
+        self.assertEqual(
+            inst.find_groups('cn=fred,o=org', request), ['cn=b,o=org'])
+        self.assertEqual(len(request.response_callbacks), 1)
+        response = request.response
+        request.response_callbacks[0](request, response)
+        headers = [h for h in response.headerlist if h[0] == 'Set-Cookie']
+        inst.groups_max_age = 300
+        request = self._request(None, headers)
+        self.assertEqual(
+            inst.find_groups('cn=fred,o=org', request), ['cn=b,o=org'])
+
+    def test_groups_too_large_for_ticket(self):
+        inst = self._make_one(groups_max_size=10)
+        request = self._request([('cn=a,o=org', {})])
+        headers = inst.remember(request, 'cn=fred,o=org')
+        request = self._request([('cn=b,o=org', {})], headers)
+        self.assertEqual(
+            inst.find_groups('cn=fred,o=org', request), ['cn=b,o=org'])
+        self.assertFalse(request.response_callbacks)
+
+    def test_custom_callback(self):
+        inst = self._make_one(callback=lambda userid, request: ['group'])
+        request = self._request(None)
+        headers = inst.remember(request, 'fred')
+        request = self._request(None, headers)
+        self.assertEqual(inst.find_groups('fred', request), ['group'])
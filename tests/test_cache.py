@@ -0,0 +1,174 @@
+from os import path
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from . import TestCase, DummyConfig, DummyManager
+
+
+class TestSQLiteCacheBackend(TestCase):
+
+    def setUp(self):
+        self.tempdir = mkdtemp()
+        self.path = path.join(self.tempdir, 'cache.db')
+
+    def tearDown(self):
+        rmtree(self.tempdir)
+
+    def _make_one(self, name='test', max_entries=0, max_bytes=0, jitter=0):
+        from pyramid_ldap3 import SQLiteCacheBackend
+        backend = SQLiteCacheBackend(self.path)
+        return backend.cache(name, max_entries, max_bytes, jitter)
+
+    def test_get_and_set(self):
+        inst = self._make_one()
+        self.assertIsNone(inst.get(('a', 'b')))
+        value = [('dn', {'attr': ['value']})]
+        inst.set(('a', 'b'), value, 10)
+        self.assertEqual(inst.get(('a', 'b')), value)
+        self.assertIn(('a', 'b'), inst)
+        self.assertEqual(len(inst), 1)
+        self.assertEqual(inst.items(), [(('a', 'b'), value)])
+
+    def test_shared_between_backends(self):
+        inst = self._make_one()
+        other = self._make_one()
+        another = self._make_one('other')
+        inst.set('foo', 'bar', 10)
+        self.assertEqual(other.get('foo'), 'bar')
+        self.assertIsNone(another.get('foo'))
+        other.delete('foo')
+        self.assertIsNone(inst.get('foo'))
+
+    def test_entries_expire_individually(self):
+        inst = self._make_one()
+        inst.set('foo', 'bar', 10, now=100)
+        inst.set('baz', 'qux', 20, now=105, keep=5)
+        self.assertEqual(inst.get('foo', now=109), 'bar')
+        self.assertIsNone(inst.get('foo', now=110))
+        self.assertEqual(inst.lookup('baz', now=127), ('qux', 125))
+        self.assertIsNone(inst.get('baz', now=127))
+        self.assertIsNone(inst.lookup('baz', now=130))
+        self.assertEqual(len(inst), 0)
+
+    def test_clear(self):
+        inst = self._make_one()
+        other = self._make_one('other')
+        inst.set('foo', 'bar', 10)
+        other.set('foo', 'bar', 10)
+        inst.clear()
+        self.assertEqual(len(inst), 0)
+        self.assertEqual(len(other), 1)
+
+    def test_max_entries_evicts_least_recently_used(self):
+        inst = self._make_one(max_entries=2)
+        inst.set('a', 1, 10, now=1)
+        inst.set('b', 2, 10, now=2)
+        self.assertEqual(inst.get('a', now=3), 1)
+        inst.set('c', 3, 10, now=4)
+        self.assertEqual(len(inst), 2)
+        self.assertEqual(inst.get('a', now=5), 1)
+        self.assertIsNone(inst.get('b', now=5))
+        self.assertEqual(inst.get('c', now=5), 3)
+
+    def test_time_of_use_is_noted_only_once_in_a_while(self):
+        inst = self._make_one()
+        conn = inst.backend.connection()
+        self.assertEqual(
+            conn.execute('pragma synchronous').fetchone()[0], 1)  # normal
+
+        def used():
+            return conn.execute(
+                'select used from pyramid_ldap3_cache').fetchone()[0]
+
+        inst.set('foo', 'bar', 100, now=0)
+        self.assertEqual(inst.get('foo', now=5), 'bar')
+        self.assertEqual(used(), 0)
+        self.assertEqual(inst.get('foo', now=20), 'bar')
+        self.assertEqual(used(), 20)
+        self.assertEqual(inst.get('foo', now=25), 'bar')
+        self.assertEqual(used(), 20)
+
+    def test_max_bytes(self):
+        inst = self._make_one(max_bytes=1000)
+        value = 'x' * 300
+        for n in range(10):
+            inst.set(n, value, 100, now=n)
+        self.assertEqual(len(inst), 3)
+        self.assertEqual(inst.get(9, now=10), value)
+        self.assertIsNone(inst.get(0, now=10))
+
+    def test_database_error(self):
+        from pyramid_ldap3 import SQLiteCacheBackend
+        backend = SQLiteCacheBackend(path.join(self.tempdir, 'no', 'cache'))
+        inst = backend.cache('test')
+        inst.set('foo', 'bar', 10)
+        self.assertIsNone(inst.get('foo'))
+        self.assertEqual(len(inst), 0)
+        self.assertEqual(inst.items(), [])
+        inst.delete('foo')
+        inst.clear()
+
+    def test_query_with_backend(self):
+        from pyramid_ldap3 import SQLiteCacheBackend, _LDAPQuery
+        backend = SQLiteCacheBackend(self.path)
+        inst = _LDAPQuery('DN=Org', '(cn=%(login)s)', 'scope', 'attrs', 10,
+                          cache_size=5)
+        inst.use_cache(backend, 'ldap_login_query')
+        self.assertEqual(inst.cache.max_entries, 5)
+        manager = DummyManager(
+            with_result=[{'dn': 'a', 'attributes': {'b': 'c'}}])
+        self.assertEqual(inst.execute(manager, login='foo'),
+                         [('a', {'b': 'c'})])
+        other = _LDAPQuery('DN=Org', '(cn=%(login)s)', 'scope', 'attrs', 10)
+        other.use_cache(backend, 'ldap_login_query')
+        manager = DummyManager(with_error=AssertionError)
+        self.assertEqual(other.execute(manager, login='foo'),
+                         [('a', {'b': 'c'})])
+        other.invalidate(set(['a']))
+        self.assertEqual(len(inst.cache), 0)
+
+
+class TestCacheBackendSetup(TestCase):
+
+    def test_backend_from_setup(self):
+        from pyramid_ldap3 import (
+            CacheBackend, ldap_setup, ldap_set_groups_query)
+
+        class Backend(CacheBackend):
+            def cache(self, name, max_entries=0, max_bytes=0, jitter=0):
+                return name, max_entries
+
+        backend = Backend()
+        config = DummyConfig()
+        ldap_setup(config, 'ldap://dummyhost', cache_backend=backend,
+                   realm='test')
+        self.assertIs(config.registry.ldap_cache_backend_test, backend)
+        ldap_set_groups_query(config, 'dn', 'tmpl', nested=True,
+                              cache_size=42, realm='test')
+        query = config.registry.ldap_groups_query_test
+        self.assertEqual(query.cache, ('ldap_groups_query_test', 42))
+        self.assertEqual(
+            query.graph.cache, ('ldap_groups_query_test_nested', 42))
+        ldap_set_groups_query(config, 'dn', 'tmpl')
+        query = config.registry.ldap_groups_query
+        self.assertNotIsInstance(query.cache, tuple)
+
+    def test_backend_for_query(self):
+        from pyramid_ldap3 import (
+            CacheBackend, ldap_set_login_query, ldap_set_groups_attribute)
+
+        class Backend(CacheBackend):
+            def cache(self, name, max_entries=0, max_bytes=0, jitter=0):
+                return name
+
+        config = DummyConfig()
+        ldap_set_login_query(config, 'dn', 'tmpl', cache_backend=Backend())
+        self.assertEqual(
+            config.registry.ldap_login_query.cache, 'ldap_login_query')
+        ldap_set_groups_attribute(config, cache_backend=Backend())
+        self.assertEqual(
+            config.registry.ldap_groups_query.cache, 'ldap_groups_query')
+
+    def test_base_backend(self):
+        from pyramid_ldap3 import CacheBackend
+        self.assertRaises(NotImplementedError, CacheBackend().cache, 'test')
@@ -1,6 +1,8 @@
+from threading import enumerate as enumerate_threads
+
 from . import (
     TestCase, ConfigurationError,
-    Dummy, DummyRequest, DummyManager, DummySearch)
+    Dummy, DummyRequest, DummyManager, DummySearch, mock_manager)
 
 
 class TestGetLdapConnector(TestCase):
@@ -98,6 +100,294 @@ class TestConnectorWithoutRealm(TestCase):
         self.assertEqual(search.kw['login'], '\\61\\62\\e7\\31\\32\\33')
         self.assertIs(manager.bound, False)
 
+    def _login_bind(self, dn_tmpl, attributes=None):
+        from pyramid_ldap3 import _LDAPLoginBind
+        return _LDAPLoginBind(dn_tmpl, attributes)
+
+    def test_authenticate_direct_bind(self):
+        manager = DummyManager()
+        registry = Dummy()
+        registry.ldap_login_query = self._login_bind('uid=%(login)s,o=org')
+        inst = self._make_one(registry, manager)
+        self.assertEqual(
+            inst.authenticate('fred', 'flint'), ('uid=fred,o=org', {}))
+        self.assertEqual(manager.user, 'uid=fred,o=org')
+        self.assertEqual(manager.password, 'flint')
+        self.assertIsNone(manager.search_args)
+        self.assertIs(manager.bound, False)
+
+    def test_authenticate_direct_bind_escapes(self):
+        manager = DummyManager()
+        registry = Dummy()
+        registry.ldap_login_query = self._login_bind('uid=%(login)s,o=org')
+        inst = self._make_one(registry, manager)
+        self.assertEqual(
+            inst.authenticate('a,b=c', 'flint'), ('uid=a\\,b\\=c,o=org', {}))
+        self.assertEqual(
+            inst.authenticate(' #x ', 'flint'), ('uid=\\ #x\\ ,o=org', {}))
+        self.assertEqual(
+            inst.authenticate(b'ab\xe7', 'flint'),
+            ('uid=\\61\\62\\e7,o=org', {}))
+
+    def test_authenticate_direct_bind_with_attributes(self):
+        manager = DummyManager(with_result=[
+            {'dn': 'uid=fred,o=org', 'attributes': {'cn': ['Fred']}}])
+        registry = Dummy()
+        registry.ldap_login_query = self._login_bind(
+            'uid=%(login)s,o=org', ['cn'])
+        inst = self._make_one(registry, manager)
+        self.assertEqual(
+            inst.authenticate('fred', 'flint'),
+            ('uid=fred,o=org', {'cn': ['Fred']}))
+        self.assertEqual(manager.search_args,
+                         ('uid=fred,o=org', '(objectClass=*)'))
+        self.assertEqual(manager.search_kwargs['attributes'], ['cn'])
+        self.assertIs(manager.bound, False)
+
+    def test_authenticate_direct_bind_unbinds(self):
+        class AutoBindManager(DummyManager):
+            # like ldap3, do not unbind connections bound before the context
+            def __exit__(self, *_args):
+                pass
+
+        for attributes in None, ['cn']:
+            manager = AutoBindManager(with_result=[
+                {'dn': 'uid=fred,o=org', 'attributes': {'cn': ['Fred']}}])
+            registry = Dummy()
+            registry.ldap_login_query = self._login_bind(
+                'uid=%(login)s,o=org', attributes)
+            inst = self._make_one(registry, manager)
+            self.assertIsNotNone(inst.authenticate('fred', 'flint'))
+            self.assertIs(manager.bound, False)
+
+    def test_authenticate_direct_bind_raises(self):
+        from pyramid_ldap3 import LDAPException
+        manager = DummyManager(with_error=LDAPException)
+        registry = Dummy()
+        registry.ldap_login_query = self._login_bind('uid=%(login)s,o=org')
+        inst = self._make_one(registry, manager)
+        self.assertIsNone(inst.authenticate('fred', 'flint'))
+        self.assertIsNone(manager.bound)
+
+    def test_authenticate_direct_bind_empty_login(self):
+        manager = DummyManager()
+        registry = Dummy()
+        registry.ldap_login_query = self._login_bind('uid=%(login)s,o=org')
+        inst = self._make_one(registry, manager)
+        self.assertIsNone(inst.authenticate('', 'flint'))
+        self.assertIsNone(manager.bound)
+
+    def _groups_attribute(self, cache_period=10):
+        from pyramid_ldap3 import _LDAPGroupsAttribute
+        return _LDAPGroupsAttribute('memberOf', cache_period)
+
+    def test_authenticate_remembers_groups(self):
+        manager = DummyManager()
+        registry = Dummy()
+        registry.ldap_login_query = DummySearch(
+            [('cn=fred,o=org', {'memberOf': ['cn=a,o=org']})])
+        registry.ldap_groups_query = self._groups_attribute()
+        inst = self._make_one(registry, manager)
+        inst.authenticate('fred', 'flint')
+        manager.search_args = None
+        self.assertEqual(
+            inst.user_groups('cn=fred,o=org'), [('cn=a,o=org', {})])
+        self.assertIsNone(manager.search_args)
+
+    def test_authenticate_direct_bind_remembers_groups(self):
+        manager = DummyManager(with_result=[
+            {'dn': 'cn=fred,o=org', 'attributes': {'memberOf': ['cn=a']}}])
+        registry = Dummy()
+        registry.ldap_login_query = self._login_bind(
+            'cn=%(login)s,o=org', ['memberOf'])
+        registry.ldap_groups_query = self._groups_attribute()
+        inst = self._make_one(registry, manager)
+        inst.authenticate('fred', 'flint')
+        manager.search_args = None
+        self.assertEqual(inst.user_groups('cn=fred,o=org'), [('cn=a', {})])
+        self.assertIsNone(manager.search_args)
+
+    def test_user_groups_attribute_does_not_escape(self):
+        manager = DummyManager(with_result=[
+            {'dn': 'cn=a\\,b,o=org', 'attributes': {'memberOf': ['cn=g']}}])
+        registry = Dummy()
+        registry.ldap_groups_query = self._groups_attribute(0)
+        inst = self._make_one(registry, manager)
+        self.assertEqual(inst.user_groups('cn=a\\,b,o=org'), [('cn=g', {})])
+        self.assertEqual(manager.search_args[0], 'cn=a\\,b,o=org')
+        self.assertEqual(inst.user_groups(b'cn=a\\,b,o=org'), [('cn=g', {})])
+        self.assertEqual(manager.search_args[0], 'cn=a\\,b,o=org')
+
+    def test_user_groups_nested(self):
+        from pyramid_ldap3 import _LDAPQuery, _LDAPGroupGraph
+        manager = mock_manager({
+            'cn=a,o=org': {
+                'objectClass': 'groupOfNames', 'member': ['cn=fred,o=org']},
+            'cn=b,o=org': {
+                'objectClass': 'groupOfNames', 'member': ['cn=a,o=org']}})
+        search = _LDAPQuery(
+            'o=org', '(member=%(userdn)s)', 'SUBTREE', ['cn'], 0)
+        registry = Dummy()
+        registry.ldap_groups_query = search
+        inst = self._make_one(registry, manager)
+        self.assertEqual(inst.user_groups('cn=fred,o=org'), [
+            ('cn=a,o=org', {'cn': ['a']})])
+        search.graph = _LDAPGroupGraph(search)
+        self.assertEqual(inst.user_groups('cn=fred,o=org'), [
+            ('cn=a,o=org', {'cn': ['a']}), ('cn=b,o=org', {'cn': ['b']})])
+
+    def test_user_groups_many(self):
+        from pyramid_ldap3 import Connector, _LDAPQuery, _LDAPGroupGraph
+        manager = mock_manager({
+            'cn=a,o=org': {
+                'objectClass': 'groupOfNames',
+                'member': ['cn=fred,o=org', 'cn=barney,o=org']},
+            'cn=b,o=org': {
+                'objectClass': 'groupOfNames', 'member': ['cn=a,o=org']}})
+        search = _LDAPQuery(
+            'o=org', '(member=%(userdn)s)', 'SUBTREE', ['cn'], 0)
+        search.graph = _LDAPGroupGraph(search)
+        registry = Dummy()
+        registry.ldap_groups_query = search
+        inst = Connector(registry, manager, memoize=True)
+        inst.groups_memo['cn=dino,o=org'] = [('cn=d,o=org', {})]
+        self.assertEqual(inst.user_groups_many(
+            ['cn=fred,o=org', 'cn=barney,o=org', 'cn=dino,o=org']), {
+                'cn=fred,o=org': [
+                    ('cn=a,o=org', {'cn': ['a']}),
+                    ('cn=b,o=org', {'cn': ['b']})],
+                'cn=barney,o=org': [
+                    ('cn=a,o=org', {'cn': ['a']}),
+                    ('cn=b,o=org', {'cn': ['b']})],
+                'cn=dino,o=org': [('cn=d,o=org', {})]})
+        self.assertEqual(len(inst.groups_memo), 3)
+
+    def test_iter_user_groups(self):
+        from pyramid_ldap3 import _LDAPQuery
+        manager = mock_manager(dict(('cn=g%d,o=org' % i, {
+            'objectClass': 'groupOfNames', 'member': ['cn=fred,o=org']})
+            for i in range(5)))
+        search = _LDAPQuery(
+            'o=org', '(member=%(userdn)s)', 'SUBTREE', None, 0)
+        registry = Dummy()
+        registry.ldap_groups_query = search
+        inst = self._make_one(registry, manager)
+        self.assertEqual(
+            sorted(r[0] for r in inst.iter_user_groups('cn=fred,o=org', 2)),
+            ['cn=g%d,o=org' % i for i in range(5)])
+
+    def test_iter_user_groups_index(self):
+        from pyramid_ldap3 import _LDAPGroupsIndex
+        search = _LDAPGroupsIndex('o=org', '(objectClass=group)', 'SUBTREE')
+        search.index = {'cn=fred,o=org': (('cn=g,o=org', {}),)}
+        search.loaded = 1 << 31
+        registry = Dummy()
+        registry.ldap_groups_query = search
+        inst = self._make_one(registry, DummyManager())
+        self.assertEqual(list(inst.iter_user_groups('cn=fred,o=org')),
+                         [('cn=g,o=org', {})])
+        self.assertEqual(list(inst.iter_user_groups('cn=barney,o=org')), [])
+
+    def test_user_group_dns(self):
+        from pyramid_ldap3 import Connector, _LDAPQuery, _LDAPDNQuery
+        manager = mock_manager({
+            'cn=a,o=org': {
+                'objectClass': 'groupOfNames', 'member': ['cn=fred,o=org']}})
+        search = _LDAPQuery(
+            'o=org', '(member=%(userdn)s)', 'SUBTREE', ['cn'], 0)
+        search.dn_query = _LDAPDNQuery(search)
+        registry = Dummy()
+        registry.ldap_groups_query = search
+        inst = Connector(registry, manager, memoize=True)
+        self.assertEqual(inst.user_group_dns('cn=fred,o=org'), ['cn=a,o=org'])
+        self.assertEqual(inst.group_dns_memo, {
+            'cn=fred,o=org': ['cn=a,o=org']})
+        self.assertEqual(inst.groups_memo, {})
+        self.assertEqual(inst.user_group_dns('cn=barney,o=org'), [])
+
+    def test_user_group_dns_uses_groups_memo(self):
+        from pyramid_ldap3 import Connector, _LDAPQuery, _LDAPDNQuery
+        search = _LDAPQuery(
+            'o=org', '(member=%(userdn)s)', 'SUBTREE', ['cn'], 0)
+        search.dn_query = _LDAPDNQuery(search)
+        registry = Dummy()
+        registry.ldap_groups_query = search
+        manager = DummyManager()
+        inst = Connector(registry, manager, memoize=True)
+        inst.groups_memo['cn=fred,o=org'] = [('cn=a,o=org', {'cn': ['a']})]
+        self.assertEqual(inst.user_group_dns('cn=fred,o=org'), ['cn=a,o=org'])
+        self.assertIsNone(manager.search_args)
+
+    def test_user_group_dns_uses_groups_cache(self):
+        from pyramid_ldap3 import Connector, _LDAPQuery, _LDAPDNQuery
+        search = _LDAPQuery(
+            'o=org', '(member=%(userdn)s)', 'SUBTREE', ['cn'], 10)
+        search.dn_query = _LDAPDNQuery(search)
+        search.cache.set(('o=org', '(member=cn=fred,o=org)'),
+                         [('cn=a,o=org', {'cn': ['a']})], 10)
+        registry = Dummy()
+        registry.ldap_groups_query = search
+        manager = DummyManager()
+        inst = Connector(registry, manager)
+        self.assertEqual(inst.user_group_dns('cn=fred,o=org'), ['cn=a,o=org'])
+        self.assertIsNone(manager.search_args)
+        self.assertEqual(len(search.dn_query.cache), 0)
+
+    def test_user_group_dns_without_dn_query(self):
+        manager = DummyManager()
+        registry = Dummy()
+        registry.ldap_groups_query = DummySearch([('a', 'b')])
+        inst = self._make_one(registry, manager)
+        self.assertEqual(inst.user_group_dns('abc'), ['a'])
+        registry.ldap_groups_query = DummySearch(None)
+        self.assertIsNone(inst.user_group_dns('abc'))
+
+    def test_user_group_dns_execute_raises(self):
+        from pyramid_ldap3 import LDAPException, _LDAPQuery, _LDAPDNQuery
+        manager = DummyManager(with_error=LDAPException)
+        search = _LDAPQuery(
+            'o=org', '(member=%(userdn)s)', 'SUBTREE', ['cn'], 0)
+        search.dn_query = _LDAPDNQuery(search)
+        registry = Dummy()
+        registry.ldap_groups_query = search
+        inst = self._make_one(registry, manager)
+        self.assertIsNone(inst.user_group_dns('abc'))
+
+    def test_user_groups_many_without_batches(self):
+        manager = DummyManager()
+        registry = Dummy()
+        search = DummySearch([('a', 'b')])
+        registry.ldap_groups_query = search
+        inst = self._make_one(registry, manager)
+        self.assertEqual(inst.user_groups_many(['abc', 'def']), {
+            'abc': [('a', 'b')], 'def': [('a', 'b')]})
+
+    def test_user_groups_many_execute_raises(self):
+        from pyramid_ldap3 import _LDAPQuery, LDAPException
+        manager = DummyManager(with_error=LDAPException)
+        registry = Dummy()
+        registry.ldap_groups_query = _LDAPQuery(
+            'o=org', '(member=%(userdn)s)', 'SUBTREE', ['cn'], 0)
+        inst = self._make_one(registry, manager)
+        self.assertEqual(inst.user_groups_many(['abc', 'def']), {
+            'abc': None, 'def': None})
+
+    def test_user_groups_index(self):
+        from pyramid_ldap3 import _LDAPGroupsIndex
+        manager = DummyManager()
+        search = _LDAPGroupsIndex('o=org', '(objectClass=group)', 'SUBTREE')
+        search.index = {'cn=a\\,b,o=org': (('cn=g,o=org', {}),)}
+        search.loaded = 1 << 31
+        registry = Dummy()
+        registry.ldap_groups_query = search
+        inst = self._make_one(registry, manager)
+        self.assertEqual(
+            inst.user_groups('cn=a\\,b,o=org'), [('cn=g,o=org', {})])
+        self.assertEqual(
+            inst.user_groups_many(['cn=a\\,b,o=org', 'cn=c,o=org']), {
+                'cn=a\\,b,o=org': [('cn=g,o=org', {})], 'cn=c,o=org': []})
+        self.assertIsNone(manager.bound)
+
     def test_user_groups_no_ldap_groups_query(self):
         manager = DummyManager()
         inst = self._make_one(None, manager)
@@ -122,6 +412,34 @@ class TestConnectorWithoutRealm(TestCase):
         self.assertIsNone(inst.user_groups(None))
         self.assertIsNone(manager.bound)
 
+    def test_user_groups_not_memoized(self):
+        manager = DummyManager()
+        registry = Dummy()
+        search = DummySearch([('a', 'b')])
+        registry.ldap_groups_query = search
+        inst = self._make_one(registry, manager)
+        self.assertIsNone(inst.groups_memo)
+        self.assertEqual(inst.user_groups('abc'), [('a', 'b')])
+        search.result = [('c', 'd')]
+        self.assertEqual(inst.user_groups('abc'), [('c', 'd')])
+
+    def test_user_groups_memoized(self):
+        from pyramid_ldap3 import Connector, LDAPException
+        manager = DummyManager()
+        registry = Dummy()
+        search = DummySearch([('a', 'b')])
+        registry.ldap_groups_query = search
+        inst = Connector(registry, manager, memoize=True)
+        self.assertEqual(inst.user_groups('abc'), [('a', 'b')])
+        search.result = [('c', 'd')]
+        self.assertEqual(inst.user_groups('abc'), [('a', 'b')])
+        self.assertEqual(inst.user_groups('def'), [('c', 'd')])
+        search.exc = LDAPException
+        self.assertIsNone(inst.user_groups('ghi'))
+        search.exc = None
+        self.assertIsNone(inst.user_groups('ghi'))
+        self.assertEqual(len(inst.groups_memo), 3)
+
     def test_user_groups_search_escapes(self):
         manager = DummyManager()
         registry = Dummy()
@@ -186,3 +504,159 @@ class TestConnectorWithRealm(TestCase):
         inst = self._make_one(registry, manager, 'another_realm')
         self.assertEqual(inst.user_groups(None), [('c', 'd')])
         self.assertIsNone(manager.bound)
+
+
+class TestAuthenticateRealms(TestCase):
+
+    def _call_fut(self, request, login, password, realms, **kw):
+        from pyramid_ldap3 import authenticate_realms
+        return authenticate_realms(request, login, password, realms, **kw)
+
+    def _request(self, searches, managers=None):
+        from pyramid_ldap3 import Connector
+        request = DummyRequest()
+        registry = Dummy()
+        for realm, search in searches.items():
+            setattr(registry, 'ldap_login_query_' + realm, search)
+            manager = managers.get(realm) if managers else None
+            setattr(request, 'ldap_connector_' + realm, Connector(
+                registry, manager or DummyManager(), realm))
+        return request
+
+    def test_authenticated_in_realm_with_match(self):
+        request = self._request({
+            'a': DummySearch([]),
+            'b': DummySearch([('cn=fred,o=b', {})]),
+            'c': DummySearch([('cn=fred,o=c', {}), ('cn=fred,o=c2', {})])})
+        self.assertEqual(
+            self._call_fut(request, 'fred', 'flint', ['a', 'b', 'c']),
+            ('b', ('cn=fred,o=b', {})))
+        self.assertEqual(
+            request.ldap_connector_b.manager.user, 'cn=fred,o=b')
+        self.assertIsNone(request.ldap_connector_a.manager.user)
+        self.assertIsNone(request.ldap_connector_c.manager.user)
+
+    def test_not_found(self):
+        request = self._request({'a': DummySearch([]), 'b': DummySearch([])})
+        self.assertIsNone(self._call_fut(request, 'fred', 'flint', ['a', 'b']))
+        self.assertIsNone(self._call_fut(request, 'fred', '', ['a', 'b']))
+
+    def test_wrong_password_in_one_realm(self):
+        from pyramid_ldap3 import LDAPException
+        request = self._request({
+            'a': DummySearch([('cn=fred,o=a', {})]),
+            'b': DummySearch([('cn=fred,o=b', {})])},
+            {'a': DummyManager(with_error=LDAPException)})
+        self.assertEqual(
+            self._call_fut(request, 'fred', 'flint', ['a', 'b']),
+            ('b', ('cn=fred,o=b', {})))
+
+    def test_search_error(self):
+        from pyramid_ldap3 import LDAPException
+        request = self._request({
+            'a': DummySearch(None, LDAPException('down')),
+            'b': DummySearch([('cn=fred,o=b', {})]),
+            'c': DummySearch([])})
+        self.assertEqual(
+            self._call_fut(request, 'fred', 'flint', ['a', 'b']),
+            ('b', ('cn=fred,o=b', {})))
+        self.assertRaises(
+            LDAPException, self._call_fut, request, 'fred', 'flint',
+            ['a', 'c'])
+
+    def test_slow_realm_is_ignored(self):
+        from threading import Event
+        release = Event()
+
+        class SlowSearch(DummySearch):
+
+            def execute(self, manager, **kw):
+                release.wait(5)
+                return super(SlowSearch, self).execute(manager, **kw)
+
+        request = self._request({
+            'slow': SlowSearch([('cn=fred,o=slow', {})]),
+            'fast': DummySearch([('cn=fred,o=fast', {})])})
+        try:
+            self.assertEqual(self._call_fut(
+                request, 'fred', 'flint', ['slow', 'fast']),
+                ('fast', ('cn=fred,o=fast', {})))
+            self.assertFalse(release.is_set())
+        finally:
+            release.set()
+
+    def test_max_workers(self):
+        request = self._request(dict(
+            (realm, DummySearch([])) for realm in 'abcde'))
+        self.assertIsNone(self._call_fut(
+            request, 'fred', 'flint', list('abcde'), max_workers=2))
+
+    def test_direct_binds_after_searches(self):
+        from pyramid_ldap3 import LDAPException, _LDAPLoginBind
+        request = self._request({
+            'a': _LDAPLoginBind('uid=%(login)s,o=a'),
+            'b': DummySearch([('cn=fred,o=b', {})])})
+        self.assertEqual(
+            self._call_fut(request, 'fred', 'flint', ['a', 'b']),
+            ('b', ('cn=fred,o=b', {})))
+        self.assertIsNone(request.ldap_connector_a.manager.user)
+        request = self._request({
+            'a': _LDAPLoginBind('uid=%(login)s,o=a'),
+            'b': DummySearch([]),
+            'c': _LDAPLoginBind('uid=%(login)s,o=c'),
+            'd': _LDAPLoginBind('uid=%(login)s,o=d')},
+            {'a': DummyManager(with_error=LDAPException)})
+        self.assertEqual(
+            self._call_fut(request, 'fred', 'flint', ['a', 'b', 'c', 'd']),
+            ('c', ('uid=fred,o=c', {})))
+        self.assertEqual(request.ldap_connector_a.manager.user, 'uid=fred,o=a')
+        self.assertIsNone(request.ldap_connector_d.manager.user)
+
+    def test_threads_are_shared(self):
+        from pyramid_ldap3 import _login_workers
+        request = self._request(dict(
+            (realm, DummySearch([])) for realm in 'abcde'))
+        for _n in range(50):
+            self.assertIsNone(self._call_fut(
+                request, 'fred', 'flint', list('abcde'), max_workers=5))
+        self.assertLessEqual(_login_workers.threads, _login_workers.size)
+        self.assertLessEqual(
+            len([thread for thread in enumerate_threads()
+                 if thread.name == 'pyramid_ldap3 login']),
+            _login_workers.size)
+
+    def test_unknown_realm(self):
+        request = self._request({'a': DummySearch([])})
+        self.assertRaises(
+            ConfigurationError, self._call_fut, request, 'fred', 'flint',
+            ['a', 'b'])
+
+
+class TestWorkerPool(TestCase):
+
+    def _make_one(self, size=2):
+        from pyramid_ldap3 import _WorkerPool
+        return _WorkerPool(size, 'pyramid_ldap3 test')
+
+    def test_submit(self):
+        from threading import Event
+        inst = self._make_one()
+        self.assertEqual(inst.threads, 0)
+        done = [Event() for _n in range(5)]
+        for event in done:
+            inst.submit(event.set)
+        self.assertTrue(all(event.wait(5) for event in done))
+        self.assertEqual(inst.threads, 2)
+        self.assertEqual(str(inst), 'size=2, threads=2, queued=0')
+
+    def test_restarted_after_fork(self):
+        from threading import Event
+        inst = self._make_one()
+        inst.submit(lambda: None)
+        tasks = inst.tasks
+        inst.pid = -1  # pretend that we are in a forked process
+        done = Event()
+        inst.submit(done.set)
+        self.assertTrue(done.wait(5))
+        self.assertIsNot(inst.tasks, tasks)
+        self.assertEqual(inst.threads, 1)
@@ -11,4 +11,6 @@ class TestIncludeme(TestCase):
         config = DummyConfig()
         self._call_fut(config)
         self.assertEqual(config.directives, [
-            'ldap_setup', 'ldap_set_login_query', 'ldap_set_groups_query'])
+            'ldap_setup', 'ldap_set_login_query', 'ldap_set_login_dn',
+            'ldap_set_groups_query', 'ldap_set_groups_attribute',
+            'ldap_set_groups_index'])
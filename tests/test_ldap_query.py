@@ -1,12 +1,124 @@
-from . import TestCase, DummyManager
+from threading import Event, Thread
+from time import sleep
+
+from . import TestCase, DummyManager, mock_manager
+
+
+class BlockingManager(DummyManager):
+
+    def __init__(self, with_result=None, with_search_error=None):
+        DummyManager.__init__(self, with_result=with_result)
+        self.with_search_error = with_search_error
+        self.searching = Event()
+        self.proceed = Event()
+        self.searches = 0
+
+    def get_response(self, result_id):
+        self.searches += 1
+        self.searching.set()
+        self.proceed.wait(5)
+        if self.with_search_error:
+            raise self.with_search_error
+        return DummyManager.get_response(self, result_id)
+
+
+class RangeManager(DummyManager):
+    """Returns the members of groups in ranges of two values."""
+
+    def __init__(self, groups):
+        DummyManager.__init__(self)
+        self.groups = groups
+        self.searches = []
+
+    def search(self, base_dn, filter_str, search_scope=None, attributes=None,
+               **kw):
+        self.searches.append((base_dn, attributes))
+        return len(self.searches)
+
+    def get_response(self, result_id):
+        base_dn, attributes = self.searches[result_id - 1]
+        start = 0
+        if attributes and ';range=' in attributes[0]:
+            start = int(attributes[0].split('=')[1].split('-')[0])
+        response = []
+        for dn, members in sorted(self.groups.items()):
+            if start and dn != base_dn:
+                continue
+            attrs = {'cn': [dn[3:4]]} if not start else {}
+            values = members[start:start + 2]
+            end = start + len(values) - 1
+            if end + 1 >= len(members):
+                end = '*'
+            attrs['member;range={}-{}'.format(start, end)] = values
+            raw_attrs = dict((key, [value.encode('utf-8') for value in values])
+                             for key, values in attrs.items())
+            response.append(
+                {'dn': dn, 'attributes': attrs, 'raw_attributes': raw_attrs})
+        return response, result_id
+
+
+class TestGetRanges(TestCase):
+
+    groups = {
+        'cn=a,o=org': ['cn=u{:d},o=org'.format(i) for i in range(5)],
+        'cn=b,o=org': ['cn=u{:d},o=org'.format(i) for i in range(2)],
+        'cn=c,o=org': ['cn=u{:d},o=org'.format(i) for i in range(3)]}
+
+    def _call_fut(self, conn, response):
+        from pyramid_ldap3 import _get_ranges
+        return _get_ranges(conn, response)
+
+    def test_get_ranges(self):
+        manager = RangeManager(self.groups)
+        response, ret = manager.get_response(manager.search(
+            'o=org', '(objectClass=group)', attributes=['member']))
+        self.assertEqual(response[0]['attributes'], {
+            'cn': ['a'], 'member;range=0-1': self.groups['cn=a,o=org'][:2]})
+        response = self._call_fut(manager, response)
+        self.assertEqual(
+            dict((r['dn'], r['attributes']) for r in response),
+            dict((dn, {'cn': [dn[3:4]], 'member': members})
+                 for dn, members in self.groups.items()))
+        self.assertEqual(
+            dict((r['dn'], r['raw_attributes']['member']) for r in response),
+            dict((dn, [m.encode('utf-8') for m in members])
+                 for dn, members in self.groups.items()))
+        # two more searches for group a, one more for group c
+        self.assertEqual(len(manager.searches), 4)
+        self.assertEqual(manager.searches[1:], [
+            ('cn=a,o=org', ['member;range=2-*']),
+            ('cn=c,o=org', ['member;range=2-*']),
+            ('cn=a,o=org', ['member;range=4-*'])])
+
+    def test_get_ranges_without_ranges(self):
+        manager = RangeManager({})
+        response = [{'dn': 'cn=a,o=org', 'attributes': {'member': ['x']}},
+                    {'type': 'searchResRef'}]
+        self.assertEqual(self._call_fut(manager, response), [
+            {'dn': 'cn=a,o=org', 'attributes': {'member': ['x']}},
+            {'type': 'searchResRef'}])
+        self.assertIsNone(self._call_fut(manager, None))
+        self.assertEqual(manager.searches, [])
+
+    def test_execute_gets_ranges(self):
+        from pyramid_ldap3 import _LDAPQuery
+        inst = _LDAPQuery('o=org', '(member=%(userdn)s)', 'SUBTREE',
+                          ['cn', 'member'], 10)
+        manager = RangeManager(self.groups)
+        result = inst.execute(manager, userdn='cn=u1,o=org')
+        self.assertEqual(result[0], ('cn=a,o=org', {
+            'cn': ['a'], 'member': self.groups['cn=a,o=org']}))
+        self.assertEqual(inst.query_cache(('o=org', '(member=cn=u1,o=org)')),
+                         result)
 
 
 class TestLDAPQuery(TestCase):
 
-    def _make_one(self, base_dn, filter_tmpl, scope, attributes, cache_period):
+    def _make_one(self, base_dn, filter_tmpl, scope, attributes, cache_period,
+                  **kw):
         from pyramid_ldap3 import _LDAPQuery
         return _LDAPQuery(
-            base_dn, filter_tmpl, scope, attributes, cache_period)
+            base_dn, filter_tmpl, scope, attributes, cache_period, **kw)
 
     def _manager(self, with_result):
         return DummyManager(with_result=with_result)
@@ -17,29 +129,44 @@ class TestLDAPQuery(TestCase):
         result = inst.execute(manager, login='foo')
         self.assertEqual(result, [])
 
-    def test_query_cache_no_rollover(self):
+    def test_query_cache_not_expired(self):
         inst = self._make_one(None, None, None, None, 1)
-        inst.last_timeslice = 1 << 31
-        inst.cache['foo'] = 'bar'
+        inst.cache.set('foo', 'bar', 1)
         self.assertEqual(inst.query_cache('foo'), 'bar')
 
-    def test_query_cache_with_rollover(self):
+    def test_query_cache_expired(self):
         inst = self._make_one(None, None, None, None, 1)
-        inst.cache['foo'] = 'bar'
+        inst.cache.set('foo', 'bar', 1, now=0)
         self.assertIsNone(inst.query_cache('foo'))
-        self.assertEqual(inst.cache, {})
-        self.assertNotEqual(inst.last_timeslice, 0)
+        self.assertEqual(len(inst.cache), 0)
 
     def test_execute_no_cache_period(self):
         inst = self._make_one('DN=Org', '(cn=%(login)s)', 'scope', 'attrs', 0)
         manager = self._manager([{'dn': 'a', 'attributes': {'b': 'c'}}])
         result = inst.execute(manager, login='foo')
-        self.assertEqual(inst.cache, {})
+        self.assertEqual(len(inst.cache), 0)
         self.assertEqual(result, [('a', {'b': 'c'})])
         self.assertEqual(manager.search_args, ('DN=Org', '(cn=foo)'))
         self.assertEqual(manager.search_kwargs, {
             'attributes': 'attrs', 'search_scope': 'scope'})
 
+    def test_execute_with_hedger(self):
+        inst = self._make_one('DN=Org', '(cn=%(login)s)', 'scope', 'attrs', 0)
+        manager = self._manager([{'dn': 'a', 'attributes': {'b': 'c'}}])
+        calls = []
+
+        class Hedger(object):
+
+            def get_response(self, conn, msg_id, base_dn, filter_str, **kw):
+                calls.append((base_dn, filter_str, kw))
+                return conn.get_response(msg_id)
+
+        manager.hedger = Hedger()
+        result = inst.execute(manager, login='foo')
+        self.assertEqual(result, [('a', {'b': 'c'})])
+        self.assertEqual(calls, [('DN=Org', '(cn=foo)', {
+            'attributes': 'attrs', 'search_scope': 'scope'})])
+
     def test_execute_with_cache_period_miss(self):
         inst = self._make_one('DN=Org', '(cn=%(login)s)', 'scope', 'attrs', 1)
         manager = self._manager([{'dn': 'a', 'attributes': {'b': 'c'}}])
@@ -48,13 +175,928 @@ class TestLDAPQuery(TestCase):
         self.assertEqual(manager.search_args, ('DN=Org', '(cn=foo)'))
         self.assertEqual(manager.search_kwargs, {
             'attributes': 'attrs', 'search_scope': 'scope'})
+        self.assertEqual(
+            inst.query_cache(('DN=Org', '(cn=foo)')), [('a', {'b': 'c'})])
 
     def test_execute_with_cache_period_hit(self):
         inst = self._make_one('DN=Org', '(cn=%(login)s)', 'scope', 'attrs', 1)
-        inst.last_timeslice = 1 << 31
-        inst.cache[('DN=Org', '(cn=foo)')] = ('d', {'e': 'f'})
+        inst.cache.set(('DN=Org', '(cn=foo)'), ('d', {'e': 'f'}), 1)
         manager = self._manager([{'dn': 'a', 'attributes': {'b': 'c'}}])
         result = inst.execute(manager, login='foo')
         self.assertEqual(result, ('d', {'e': 'f'}))
         self.assertIsNone(manager.search_args)
         self.assertIsNone(manager.search_kwargs)
+
+    def test_execute_with_stale_period_refreshes_in_background(self):
+        from time import time
+        inst = self._make_one(
+            'DN=Org', '(cn=%(login)s)', 'scope', 'attrs', 10, stale_period=5)
+        cache_key = ('DN=Org', '(cn=foo)')
+        inst.cache.set(cache_key, [('d', {'e': 'f'})], 10,
+                       now=time() - 12, keep=5)
+        manager = BlockingManager([{'dn': 'a', 'attributes': {'b': 'c'}}])
+        result = inst.execute(manager, login='foo')
+        self.assertEqual(result, [('d', {'e': 'f'})])
+        self.assertTrue(manager.searching.wait(5))
+        self.assertIn(cache_key, inst.flights)
+        result = inst.execute(manager, login='foo')
+        self.assertEqual(result, [('d', {'e': 'f'})])
+        manager.proceed.set()
+        for _n in range(500):
+            if cache_key not in inst.flights:
+                break
+            sleep(0.01)
+        self.assertEqual(manager.searches, 1)
+        result = inst.execute(manager, login='foo')
+        self.assertEqual(result, [('a', {'b': 'c'})])
+        self.assertEqual(manager.searches, 1)
+
+    def test_refreshes_are_dropped_when_workers_are_busy(self):
+        from time import time
+        from pyramid_ldap3 import _WorkerPool
+        inst = self._make_one(
+            'DN=Org', '(cn=%(login)s)', 'scope', 'attrs', 10, stale_period=5)
+        for login in 'abc':
+            inst.cache.set(('DN=Org', '(cn={})'.format(login)),
+                           [('d', {'e': 'f'})], 10, now=time() - 12, keep=5)
+        manager = BlockingManager([{'dn': 'a', 'attributes': {'b': 'c'}}])
+        manager.refresh_workers = _WorkerPool(1, 'test', max_queued=1)
+        self.assertEqual(inst.execute(manager, login='a'), [('d', {'e': 'f'})])
+        self.assertTrue(manager.searching.wait(5))
+        self.assertEqual(inst.execute(manager, login='b'), [('d', {'e': 'f'})])
+        self.assertEqual(inst.execute(manager, login='b'), [('d', {'e': 'f'})])
+        self.assertEqual(inst.execute(manager, login='c'), [('d', {'e': 'f'})])
+        self.assertEqual(manager.refresh_workers.tasks.qsize(), 1)
+        manager.proceed.set()
+        for _n in range(500):
+            if not manager.refresh_workers.keys:
+                break
+            sleep(0.01)
+        self.assertEqual(manager.searches, 2)
+        self.assertEqual(manager.refresh_workers.threads, 1)
+        self.assertEqual(inst.execute(manager, login='b'), [('a', {'b': 'c'})])
+
+    def test_execute_after_stale_period(self):
+        from time import time
+        inst = self._make_one(
+            'DN=Org', '(cn=%(login)s)', 'scope', 'attrs', 10, stale_period=5)
+        inst.cache.set(('DN=Org', '(cn=foo)'), [('d', {'e': 'f'})], 10,
+                       now=time() - 16, keep=10)
+        manager = self._manager([{'dn': 'a', 'attributes': {'b': 'c'}}])
+        result = inst.execute(manager, login='foo')
+        self.assertEqual(result, [('a', {'b': 'c'})])
+
+    def test_execute_with_stale_if_error(self):
+        from time import time
+        from pyramid_ldap3 import LDAPException
+        inst = self._make_one(
+            'DN=Org', '(cn=%(login)s)', 'scope', 'attrs', 10,
+            stale_if_error=60)
+        inst.cache.set(('DN=Org', '(cn=foo)'), [('d', {'e': 'f'})], 10,
+                       now=time() - 30, keep=60)
+        manager = DummyManager(with_error=LDAPException)
+        result = inst.execute(manager, login='foo')
+        self.assertEqual(result, [('d', {'e': 'f'})])
+        inst.cache.set(('DN=Org', '(cn=foo)'), [('d', {'e': 'f'})], 10,
+                       now=time() - 80, keep=100)
+        self.assertRaises(LDAPException, inst.execute, manager, login='foo')
+
+    def test_execute_without_stale_if_error(self):
+        from time import time
+        from pyramid_ldap3 import LDAPException
+        inst = self._make_one(
+            'DN=Org', '(cn=%(login)s)', 'scope', 'attrs', 10)
+        inst.cache.set(('DN=Org', '(cn=foo)'), [('d', {'e': 'f'})], 10,
+                       now=time() - 30, keep=60)
+        manager = DummyManager(with_error=LDAPException)
+        self.assertRaises(LDAPException, inst.execute, manager, login='foo')
+
+    def test_execute_with_negative_cache_period(self):
+        inst = self._make_one(
+            'DN=Org', '(cn=%(login)s)', 'scope', 'attrs', 10,
+            negative_cache_period=5, negative_cache_size=2)
+        manager = self._manager([])
+        result = inst.execute(manager, login='foo')
+        self.assertEqual(result, [])
+        self.assertEqual(len(inst.cache), 0)
+        self.assertEqual(len(inst.negative_cache), 1)
+        self.assertEqual(inst.negative_cache.max_entries, 2)
+        manager.search_args = None
+        result = inst.execute(manager, login='foo')
+        self.assertEqual(result, [])
+        self.assertIsNone(manager.search_args)
+
+    def test_execute_negative_cache_expired(self):
+        from time import time
+        inst = self._make_one(
+            'DN=Org', '(cn=%(login)s)', 'scope', 'attrs', 10,
+            negative_cache_period=5)
+        inst.negative_cache.set(('DN=Org', '(cn=foo)'), [], 5, now=time() - 6)
+        manager = self._manager([{'dn': 'a', 'attributes': {'b': 'c'}}])
+        result = inst.execute(manager, login='foo')
+        self.assertEqual(result, [('a', {'b': 'c'})])
+        self.assertEqual(
+            inst.query_cache(('DN=Org', '(cn=foo)')), [('a', {'b': 'c'})])
+
+    def test_execute_empty_result_replaces_cached_result(self):
+        from time import time
+        inst = self._make_one(
+            'DN=Org', '(cn=%(login)s)', 'scope', 'attrs', 10,
+            stale_period=60, negative_cache_period=5)
+        inst.cache.set(('DN=Org', '(cn=foo)'), [('d', {'e': 'f'})], 10,
+                       now=time() - 100, keep=60)
+        manager = self._manager([])
+        inst.search(manager, ('DN=Org', '(cn=foo)'))
+        self.assertEqual(len(inst.cache), 0)
+        self.assertEqual(len(inst.negative_cache), 1)
+
+    def test_execute_empty_result_without_negative_cache_period(self):
+        inst = self._make_one('DN=Org', '(cn=%(login)s)', 'scope', 'attrs', 10)
+        manager = self._manager([])
+        result = inst.execute(manager, login='foo')
+        self.assertEqual(result, [])
+        self.assertEqual(len(inst.negative_cache), 0)
+        self.assertEqual(inst.query_cache(('DN=Org', '(cn=foo)')), [])
+
+    def test_invalidate_negative_cache(self):
+        inst = self._make_one(
+            'DN=Org', '(member=%(userdn)s)', 'scope', 'attrs', 10,
+            negative_cache_period=5)
+        inst.negative_cache.set(('DN=Org', '(member=cn=foo,o=org)'), [], 5)
+        inst.negative_cache.set(('DN=Org', '(member=cn=bar,o=org)'), [], 5)
+        inst.invalidate({'cn=foo,o=org'})
+        self.assertEqual(list(inst.negative_cache.entries),
+                         [('DN=Org', '(member=cn=bar,o=org)')])
+
+    def _execute_concurrently(self, inst, manager, num_threads=5):
+        results, errors = [], []
+
+        def execute():
+            try:
+                results.append(inst.execute(manager, login='foo'))
+            except BaseException as e:
+                errors.append(e)
+
+        leader = Thread(target=execute)
+        leader.start()
+        self.assertTrue(manager.searching.wait(5))
+        followers = [Thread(target=execute) for _n in range(num_threads - 1)]
+        for thread in followers:
+            thread.start()
+        flight = inst.flights.flights[('DN=Org', '(cn=foo)')]
+        for _n in range(500):
+            if flight.waiters == num_threads - 1:
+                break
+            sleep(0.01)
+        self.assertEqual(flight.waiters, num_threads - 1)
+        manager.proceed.set()
+        for thread in [leader] + followers:
+            thread.join(5)
+        self.assertEqual(len(inst.flights), 0)
+        return results, errors
+
+    def test_execute_coalesces_concurrent_searches(self):
+        inst = self._make_one('DN=Org', '(cn=%(login)s)', 'scope', 'attrs', 0)
+        manager = BlockingManager([{'dn': 'a', 'attributes': {'b': 'c'}}])
+        results, errors = self._execute_concurrently(inst, manager)
+        self.assertEqual(errors, [])
+        self.assertEqual(len(results), 5)
+        for result in results:
+            self.assertEqual(result, [('a', {'b': 'c'})])
+        self.assertEqual(manager.searches, 1)
+
+    def test_execute_coalesced_searches_share_exception(self):
+        from pyramid_ldap3 import LDAPException
+        inst = self._make_one('DN=Org', '(cn=%(login)s)', 'scope', 'attrs', 0)
+        error = LDAPException('server down')
+        manager = BlockingManager(with_search_error=error)
+        results, errors = self._execute_concurrently(inst, manager)
+        self.assertEqual(results, [])
+        self.assertEqual(len(errors), 5)
+        for e in errors:
+            self.assertIs(e, error)
+        self.assertEqual(manager.searches, 1)
+
+    def test_execute_coalesced_searches_aborted(self):
+        from pyramid_ldap3 import LDAPException
+
+        class Abort(BaseException):
+            pass
+
+        inst = self._make_one('DN=Org', '(cn=%(login)s)', 'scope', 'attrs', 0)
+        manager = BlockingManager(with_search_error=Abort())
+        results, errors = self._execute_concurrently(inst, manager)
+        self.assertEqual(results, [])
+        self.assertEqual(len(errors), 5)
+        self.assertEqual(
+            sum(isinstance(e, Abort) for e in errors), 1)
+        self.assertEqual(
+            sum(isinstance(e, LDAPException) for e in errors), 4)
+
+
+class TestLDAPQueryMany(TestCase):
+
+    entries = {
+        'cn=a,o=org': {
+            'objectClass': 'groupOfNames',
+            'member': ['cn=fred,o=org', 'cn=barney,o=org']},
+        'cn=b,o=org': {
+            'objectClass': 'groupOfNames', 'member': ['cn=fred,o=org']},
+        'cn=c,o=org': {
+            'objectClass': 'groupOfNames', 'member': ['cn=wilma,o=org']}}
+
+    def _make_one(self, filter_tmpl=None, attributes=None, cache_period=0,
+                  **kw):
+        from pyramid_ldap3 import _LDAPQuery
+        if filter_tmpl is None:
+            filter_tmpl = '(&(objectClass=groupOfNames)(member=%(userdn)s))'
+        return _LDAPQuery(
+            'o=org', filter_tmpl, 'SUBTREE', attributes, cache_period, **kw)
+
+    def _execute_many(self, inst, manager, userdns, batch_size=100):
+        results = inst.execute_many(
+            manager, dict((dn, dn) for dn in userdns), batch_size)
+        return dict((dn, sorted(r[0] for r in result))
+                    for dn, result in results.items())
+
+    def test_member_attribute(self):
+        inst = self._make_one()
+        self.assertEqual(inst.member_attribute, 'member')
+        self.assertEqual(inst.member_clause, '(member=%(userdn)s)')
+        inst = self._make_one(
+            '(member:1.2.840.113556.1.4.1941:=%(userdn)s)')
+        self.assertIsNone(inst.member_attribute)
+        inst = self._make_one('(cn=%(login)s)')
+        self.assertIsNone(inst.member_attribute)
+        self.assertRaises(ValueError, inst.execute_many, None, {})
+
+    def test_execute_many(self):
+        inst = self._make_one()
+        manager = mock_manager(self.entries)
+        results = self._execute_many(inst, manager, [
+            'cn=fred,o=org', 'cn=Barney,o=org', 'cn=betty,o=org'])
+        self.assertEqual(results, {
+            'cn=fred,o=org': ['cn=a,o=org', 'cn=b,o=org'],
+            'cn=Barney,o=org': ['cn=a,o=org'],
+            'cn=betty,o=org': []})
+
+    def test_execute_many_in_batches(self):
+        inst = self._make_one()
+        manager = mock_manager(self.entries)
+        results = self._execute_many(inst, manager, [
+            'cn=fred,o=org', 'cn=barney,o=org', 'cn=wilma,o=org'], 2)
+        self.assertEqual(results, {
+            'cn=fred,o=org': ['cn=a,o=org', 'cn=b,o=org'],
+            'cn=barney,o=org': ['cn=a,o=org'],
+            'cn=wilma,o=org': ['cn=c,o=org']})
+
+    def test_batches(self):
+        import pyramid_ldap3
+        inst = self._make_one()
+        missing = [(dn, dn, None) for dn in 'abcde']
+        batches = list(inst._batches(missing, 2))
+        self.assertEqual([len(b) for b in batches], [2, 2, 1])
+        max_length = pyramid_ldap3._MAX_FILTER_LENGTH
+        pyramid_ldap3._MAX_FILTER_LENGTH = len(inst.filter_tmpl) + 50
+        try:
+            batches = list(inst._batches(missing, 10))
+        finally:
+            pyramid_ldap3._MAX_FILTER_LENGTH = max_length
+        self.assertEqual([len(b) for b in batches], [2, 2, 1])
+
+    def test_execute_many_strips_member_attribute(self):
+        inst = self._make_one(attributes=['cn'])
+        manager = mock_manager(self.entries)
+        results = inst.execute_many(
+            manager, {'cn=wilma,o=org': 'cn=wilma,o=org'})
+        self.assertEqual(
+            results, {'cn=wilma,o=org': [('cn=c,o=org', {'cn': ['c']})]})
+        inst = self._make_one(attributes=['cn', 'member'])
+        results = inst.execute_many(
+            manager, {'cn=wilma,o=org': 'cn=wilma,o=org'})
+        self.assertEqual(results, {'cn=wilma,o=org': [('cn=c,o=org', {
+            'cn': ['c'], 'member': ['cn=wilma,o=org']})]})
+
+    def test_execute_many_uses_and_fills_cache(self):
+        inst = self._make_one(cache_period=10, negative_cache_period=10)
+        inst.cache.set(
+            ('o=org', inst.filter_tmpl % {'userdn': 'cn=dino,o=org'}),
+            [('cn=d,o=org', {})], 10)
+        manager = mock_manager(self.entries)
+        results = self._execute_many(inst, manager, [
+            'cn=fred,o=org', 'cn=betty,o=org', 'cn=dino,o=org'])
+        self.assertEqual(results, {
+            'cn=fred,o=org': ['cn=a,o=org', 'cn=b,o=org'],
+            'cn=betty,o=org': [],
+            'cn=dino,o=org': ['cn=d,o=org']})
+        self.assertEqual(len(inst.cache), 2)
+        self.assertEqual(len(inst.negative_cache), 1)
+        result = inst.execute(DummyManager(), userdn='cn=fred,o=org')
+        self.assertEqual(sorted(r[0] for r in result),
+                         ['cn=a,o=org', 'cn=b,o=org'])
+
+
+class TestLDAPQueryPaged(TestCase):
+
+    entries = dict(('cn=g%d,o=org' % i, {
+        'objectClass': 'groupOfNames', 'member': ['cn=fred,o=org']})
+        for i in range(7))
+
+    def _make_one(self, page_size=0, time_limit=0, cache_period=0):
+        from pyramid_ldap3 import _LDAPQuery
+        return _LDAPQuery(
+            'o=org', '(member=%(userdn)s)', 'SUBTREE', ['cn'], cache_period,
+            page_size=page_size, time_limit=time_limit)
+
+    def test_execute_paged(self):
+        inst = self._make_one(page_size=3, cache_period=10)
+        manager = mock_manager(self.entries)
+        result = inst.execute(manager, userdn='cn=fred,o=org')
+        self.assertEqual(sorted(r[0] for r in result),
+                         sorted(self.entries))
+        self.assertEqual(len(inst.cache), 1)
+
+    def test_execute_paged_uses_separate_connection(self):
+        inst = self._make_one(page_size=3)
+        manager = mock_manager(self.entries)
+        connections = []
+        paged_connection = manager.paged_connection
+
+        def connection():
+            conn = paged_connection()
+            connections.append(conn)
+            return conn
+
+        manager.connection = None  # the pooled connection must not be used
+        manager.paged_connection = connection
+        self.assertEqual(len(inst.execute(manager, userdn='cn=fred,o=org')),
+                         len(self.entries))
+        self.assertEqual(
+            len(list(inst.iterate(manager, 2, userdn='cn=fred,o=org'))),
+            len(self.entries))
+        self.assertEqual(len(connections), 2)
+        self.assertTrue(all(
+            conn.closed and not conn.bound for conn in connections))
+
+    def test_execute_paged_without_result(self):
+        inst = self._make_one(page_size=3)
+        manager = mock_manager(self.entries)
+        result = inst.execute(manager, userdn='cn=barney,o=org')
+        self.assertEqual(result, [])
+
+    def test_execute_with_time_limit(self):
+        inst = self._make_one(time_limit=5)
+        manager = DummyManager(with_result=[])
+        inst.execute(manager, userdn='cn=fred,o=org')
+        self.assertEqual(manager.search_kwargs, {
+            'attributes': ['cn'], 'search_scope': 'SUBTREE',
+            'time_limit': 5})
+
+    def test_iterate(self):
+        import types
+        inst = self._make_one(cache_period=10)
+        manager = mock_manager(self.entries)
+        result = inst.iterate(manager, 2, userdn='cn=fred,o=org')
+        self.assertIsInstance(result, types.GeneratorType)
+        result = list(result)
+        self.assertEqual(sorted(r[0] for r in result),
+                         sorted(self.entries))
+        self.assertEqual(result[0][1], {'cn': [result[0][0][3:5]]})
+        self.assertEqual(len(inst.cache), 0)
+
+
+class TestLDAPDNQuery(TestCase):
+
+    entries = {
+        'cn=a,o=org': {
+            'objectClass': 'groupOfNames', 'description': 'group a',
+            'member': ['cn=fred,o=org']},
+        'cn=b,o=org': {
+            'objectClass': 'groupOfNames', 'description': 'group b',
+            'member': ['cn=fred,o=org']}}
+
+    def _make_one(self, cache_period=10, **kw):
+        from pyramid_ldap3 import _LDAPQuery, _LDAPDNQuery
+        query = _LDAPQuery(
+            'o=org', '(member=%(userdn)s)', 'SUBTREE', ['description'],
+            cache_period, cache_size=5, **kw)
+        query.dn_query = _LDAPDNQuery(query)
+        return query.dn_query
+
+    def test_init(self):
+        inst = self._make_one(stale_period=5, page_size=10)
+        self.assertIsNone(inst.attributes)
+        self.assertEqual(inst.cache_period, 10)
+        self.assertEqual(inst.cache.max_entries, 5)
+        self.assertEqual(inst.stale_period, 5)
+        self.assertEqual(inst.page_size, 10)
+
+    def test_execute(self):
+        inst = self._make_one()
+        manager = mock_manager(self.entries)
+        result = inst.execute(manager, userdn='cn=fred,o=org')
+        self.assertIsInstance(result, tuple)
+        self.assertEqual(sorted(result), ['cn=a,o=org', 'cn=b,o=org'])
+        self.assertIs(
+            inst.query_cache(('o=org', '(member=cn=fred,o=org)')), result)
+        self.assertEqual(inst.execute(manager, userdn='cn=barney,o=org'), [])
+
+    def test_convert_interns_dns(self):
+        from pyramid_ldap3 import _LDAPDNQuery
+        dn = ''.join(['cn=a,', 'o=org'])
+        result = _LDAPDNQuery.convert([{'dn': dn}, {'type': 'ref'}])
+        self.assertEqual(result, ('cn=a,o=org',))
+        if str is not bytes:
+            import sys
+            self.assertIs(result[0], sys.intern('cn=a,o=org'))
+
+    def test_invalidate(self):
+        from pyramid_ldap3 import _LDAPQuery
+        inst = self._make_one()
+        inst.cache.set(('o=org', '(member=cn=fred,o=org)'),
+                       ('cn=a,o=org', 'cn=b,o=org'), 10)
+        inst.cache.set(('o=org', '(member=cn=barney,o=org)'),
+                       ('cn=c,o=org',), 10)
+        query = _LDAPQuery(
+            'o=org', '(member=%(userdn)s)', 'SUBTREE', None, 10)
+        query.dn_query = inst
+        query.invalidate({'cn=b,o=org'})
+        self.assertEqual(list(inst.cache.entries),
+                         [('o=org', '(member=cn=barney,o=org)')])
+
+
+class TestLDAPEntry(TestCase):
+
+    def _make_one(self, dn='cn=a,o=org', attributes=None, names=None):
+        from pyramid_ldap3 import _LDAPEntry, _LDAPAttributes
+        if attributes is None:
+            attributes = {'cn': ['a'], 'description': 'group a'}
+        return _LDAPEntry(dn, _LDAPAttributes(attributes, names))
+
+    def test_entry(self):
+        entry = self._make_one()
+        dn, attributes = entry
+        self.assertEqual(dn, 'cn=a,o=org')
+        self.assertEqual(entry[0], 'cn=a,o=org')
+        self.assertIs(entry.dn, entry[0])
+        self.assertIs(entry.attributes, entry[1])
+        self.assertEqual(entry, ('cn=a,o=org', {
+            'cn': ('a',), 'description': 'group a'}))
+        from operator import setitem
+        self.assertRaises(TypeError, setitem, entry, 0, 'cn=b,o=org')
+        self.assertFalse(hasattr(entry, '__dict__'))
+
+    def test_attributes(self):
+        attributes = self._make_one(names=['CN', 'member'])[1]
+        self.assertEqual(len(attributes), 1)
+        self.assertEqual(list(attributes), ['cn'])
+        self.assertEqual(attributes['cn'], ('a',))
+        self.assertEqual(attributes['CN'], ('a',))
+        self.assertEqual(attributes.get('Cn'), ('a',))
+        self.assertIsNone(attributes.get('member'))
+        self.assertRaises(KeyError, attributes.__getitem__, 'description')
+        self.assertEqual(attributes, {'cn': ('a',)})
+        self.assertEqual(repr(attributes), "{'cn': ('a',)}")
+        from operator import setitem
+        self.assertRaises(TypeError, setitem, attributes, 'cn', 'b')
+
+    def test_pickle(self):
+        import pickle
+        entry = self._make_one()
+        for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+            copy = pickle.loads(pickle.dumps(entry, protocol))
+            self.assertIs(copy.__class__, entry.__class__)
+            self.assertIs(copy[1].__class__, entry[1].__class__)
+            self.assertEqual(copy, entry)
+
+    def test_execute_compact(self):
+        from pyramid_ldap3 import _LDAPQuery, _LDAPEntry
+        inst = _LDAPQuery(
+            'o=org', '(member=%(userdn)s)', 'SUBTREE', ['cn'], 10,
+            compact=True)
+        manager = mock_manager({
+            'cn=a,o=org': {
+                'objectClass': 'groupOfNames', 'member': ['cn=fred,o=org']}})
+        result = inst.execute(manager, userdn='cn=fred,o=org')
+        self.assertIsInstance(result, tuple)
+        self.assertIsInstance(result[0], _LDAPEntry)
+        self.assertEqual(result, (('cn=a,o=org', {'cn': ('a',)}),))
+        self.assertIs(
+            inst.query_cache(('o=org', '(member=cn=fred,o=org)')), result)
+
+    def test_execute_many_compact(self):
+        from pyramid_ldap3 import _LDAPQuery
+        inst = _LDAPQuery(
+            'o=org', '(member=%(userdn)s)', 'SUBTREE', ['cn'], 10,
+            compact=True)
+        manager = mock_manager({
+            'cn=a,o=org': {
+                'objectClass': 'groupOfNames', 'member': ['cn=fred,o=org']}})
+        results = inst.execute_many(
+            manager, {'cn=fred,o=org': 'cn=fred,o=org'})
+        self.assertEqual(results, {
+            'cn=fred,o=org': (('cn=a,o=org', {'cn': ('a',)}),)})
+
+
+class TestLDAPGroupsAttribute(TestCase):
+
+    def _make_one(self, attribute='memberOf', cache_period=0, **kw):
+        from pyramid_ldap3 import _LDAPGroupsAttribute
+        return _LDAPGroupsAttribute(attribute, cache_period, **kw)
+
+    def test_execute(self):
+        import ldap3
+        inst = self._make_one()
+        manager = DummyManager(with_result=[{
+            'dn': 'cn=fred,o=org',
+            'attributes': {'memberOf': ['cn=a,o=org', 'cn=b,o=org']}}])
+        result = inst.execute(manager, userdn='cn=fred,o=org')
+        self.assertEqual(result, [('cn=a,o=org', {}), ('cn=b,o=org', {})])
+        self.assertEqual(manager.search_args,
+                         ('cn=fred,o=org', '(objectClass=*)'))
+        self.assertEqual(manager.search_kwargs, {
+            'attributes': ['memberOf'], 'search_scope': ldap3.BASE})
+
+    def test_execute_ignores_case_of_attribute(self):
+        inst = self._make_one()
+        manager = DummyManager(with_result=[{
+            'dn': 'cn=fred,o=org',
+            'attributes': {'memberof': 'cn=a,o=org'}}])
+        result = inst.execute(manager, userdn='cn=fred,o=org')
+        self.assertEqual(result, [('cn=a,o=org', {})])
+
+    def test_execute_without_groups(self):
+        inst = self._make_one()
+        manager = DummyManager(with_result=[{
+            'dn': 'cn=fred,o=org', 'attributes': {}}])
+        result = inst.execute(manager, userdn='cn=fred,o=org')
+        self.assertEqual(result, [])
+
+    def test_remember(self):
+        inst = self._make_one(cache_period=10)
+        inst.remember('cn=fred,o=org', {'cn': ['Fred']})
+        self.assertEqual(len(inst.cache), 0)
+        inst.remember('cn=fred,o=org', {'memberOf': ['cn=a,o=org']})
+        manager = DummyManager()
+        result = inst.execute(manager, userdn='cn=fred,o=org')
+        self.assertEqual(result, [('cn=a,o=org', {})])
+        self.assertIsNone(manager.search_args)
+
+    def test_remember_without_groups(self):
+        inst = self._make_one(cache_period=10, negative_cache_period=5)
+        inst.remember('cn=fred,o=org', {'memberOf': []})
+        self.assertEqual(len(inst.cache), 0)
+        self.assertEqual(len(inst.negative_cache), 1)
+        manager = DummyManager()
+        result = inst.execute(manager, userdn='cn=fred,o=org')
+        self.assertEqual(result, [])
+        self.assertIsNone(manager.search_args)
+
+    def test_remember_without_cache_period(self):
+        inst = self._make_one()
+        inst.remember('cn=fred,o=org', {'memberOf': ['cn=a,o=org']})
+        self.assertEqual(len(inst.cache), 0)
+
+
+class TestLDAPGroupGraph(TestCase):
+
+    entries = {
+        'cn=a,o=org': {
+            'objectClass': 'groupOfNames', 'member': ['cn=fred,o=org']},
+        'cn=b,o=org': {
+            'objectClass': 'groupOfNames', 'member': ['cn=a,o=org']},
+        'cn=c,o=org': {
+            'objectClass': 'groupOfNames',
+            'member': ['cn=b,o=org', 'cn=d,o=org']},
+        'cn=d,o=org': {
+            'objectClass': 'groupOfNames', 'member': ['cn=c,o=org']},
+        'cn=e,o=org': {
+            'objectClass': 'groupOfNames', 'member': ['cn=barney,o=org']}}
+
+    def _make_one(self, cache_period=0, max_depth=20):
+        from pyramid_ldap3 import _LDAPQuery, _LDAPGroupGraph
+        query = _LDAPQuery(
+            'o=org', '(&(objectClass=groupOfNames)(member=%(userdn)s))',
+            'SUBTREE', ['cn'], 0)
+        return _LDAPGroupGraph(query, cache_period, max_depth)
+
+    def _expand(self, inst, manager, dn):
+        groups = inst.query.execute(manager, userdn=dn)
+        return sorted(r[0] for r in inst.expand(manager, groups))
+
+    def test_parents(self):
+        inst = self._make_one()
+        manager = mock_manager(self.entries)
+        parents = inst.parents(manager, ['cn=a,o=org', 'cn=c,o=org'])
+        self.assertEqual(parents, {
+            'cn=a,o=org': [('cn=b,o=org', {'cn': ['b']})],
+            'cn=c,o=org': [('cn=d,o=org', {'cn': ['d']})]})
+        self.assertEqual(len(inst.cache), 0)
+
+    def test_expand_with_cycle(self):
+        inst = self._make_one()
+        manager = mock_manager(self.entries)
+        self.assertEqual(self._expand(inst, manager, 'cn=fred,o=org'), [
+            'cn=a,o=org', 'cn=b,o=org', 'cn=c,o=org', 'cn=d,o=org'])
+        self.assertEqual(
+            self._expand(inst, manager, 'cn=barney,o=org'), ['cn=e,o=org'])
+        self.assertEqual(self._expand(inst, manager, 'cn=wilma,o=org'), [])
+
+    def test_expand_with_max_depth(self):
+        inst = self._make_one(max_depth=1)
+        manager = mock_manager(self.entries)
+        self.assertEqual(self._expand(inst, manager, 'cn=fred,o=org'), [
+            'cn=a,o=org', 'cn=b,o=org'])
+
+    def test_expand_with_cache_period(self):
+        inst = self._make_one(cache_period=10)
+        manager = mock_manager(self.entries)
+        self._expand(inst, manager, 'cn=fred,o=org')
+        self.assertEqual(len(inst.cache), 4)
+        self.assertEqual(
+            inst.cache.get('cn=b,o=org'), [('cn=c,o=org', {'cn': ['c']})])
+        manager = DummyManager(with_error=AssertionError)
+        groups = [('cn=a,o=org', {})]
+        self.assertEqual(sorted(r[0] for r in inst.expand(manager, groups)), [
+            'cn=a,o=org', 'cn=b,o=org', 'cn=c,o=org', 'cn=d,o=org'])
+        inst.invalidate(set(['cn=c,o=org']))
+        self.assertEqual(len(inst.cache), 1)
+        self.assertIsNotNone(inst.cache.get('cn=a,o=org'))
+
+
+class TestLDAPGroupsIndex(TestCase):
+
+    entries = dict(('cn=g%d,o=org' % i, {
+        'objectClass': 'groupOfNames', 'description': 'group %d' % i,
+        'member': ['cn=u%d,o=org' % j for j in range(i % 3 + 1)]})
+        for i in range(7))
+
+    def _make_one(self, attributes=None, refresh_period=600, page_size=3):
+        from pyramid_ldap3 import _LDAPGroupsIndex
+        return _LDAPGroupsIndex(
+            'o=org', '(objectClass=groupOfNames)', 'SUBTREE',
+            attributes=attributes, refresh_period=refresh_period,
+            page_size=page_size)
+
+    def test_execute(self):
+        inst = self._make_one()
+        manager = mock_manager(self.entries)
+        self.assertIsNone(inst.index)
+        result = inst.execute(manager, userdn='cn=u2,o=org')
+        self.assertEqual(sorted(result), [
+            ('cn=g2,o=org', {}), ('cn=g5,o=org', {})])
+        self.assertEqual(len(inst.index), 3)
+        self.assertEqual(len(inst.index['cn=u0,o=org']), 7)
+        result = inst.execute(manager, userdn='CN=U1,O=ORG')
+        self.assertEqual(len(result), 4)
+        result = inst.execute(manager, userdn='cn=u3,o=org')
+        self.assertEqual(result, [])
+
+    def test_execute_with_attributes(self):
+        inst = self._make_one(attributes=['description'])
+        manager = mock_manager(self.entries)
+        result = inst.execute(manager, userdn='cn=u2,o=org')
+        self.assertEqual(sorted(result), [
+            ('cn=g2,o=org', {'description': ['group 2']}),
+            ('cn=g5,o=org', {'description': ['group 5']})])
+
+    def test_execute_answers_from_index(self):
+        inst = self._make_one()
+        inst.index = {'cn=u,o=org': (('cn=g,o=org', {}),)}
+        inst.loaded = 1 << 31
+        manager = DummyManager(with_error=AssertionError)
+        result = inst.execute(manager, userdn='cn=u,o=org')
+        self.assertEqual(result, [('cn=g,o=org', {})])
+
+    def test_execute_refreshes_in_background(self):
+        inst = self._make_one()
+        inst.index = {'cn=u0,o=org': (('cn=g,o=org', {}),)}
+        inst.loaded = 1
+        manager = mock_manager(self.entries)
+        result = inst.execute(manager, userdn='cn=u0,o=org')
+        self.assertEqual(result, [('cn=g,o=org', {})])
+        for _n in range(500):
+            if inst.loaded > 1 and 'index' not in inst.flights:
+                break
+            sleep(0.01)
+        result = inst.execute(manager, userdn='cn=u0,o=org')
+        self.assertEqual(len(result), 7)
+
+    def test_invalidate(self):
+        inst = self._make_one()
+        inst.invalidate(set(['cn=g1,o=org']))
+        manager = mock_manager(self.entries)
+        inst.load(manager)
+        loaded = inst.loaded
+        inst.invalidate(set(['cn=u1,o=org', 'cn=x,o=other']))
+        self.assertEqual(inst.loaded, loaded)
+        inst.invalidate(set(['cn=g1,o=org']))
+        self.assertEqual(inst.loaded, 0)
+        inst.loaded = loaded
+        inst.invalidate(set(['cn=new,o=org']))
+        self.assertEqual(inst.loaded, 0)
+
+    def test_execute_raises(self):
+        from pyramid_ldap3 import LDAPException
+        inst = self._make_one()
+        manager = DummyManager(with_error=LDAPException)
+        self.assertRaises(
+            LDAPException, inst.execute, manager, userdn='cn=u0,o=org')
+        self.assertIsNone(inst.index)
+
+
+class TestSizeof(TestCase):
+
+    def _call_fut(self, obj):
+        from pyramid_ldap3 import _sizeof
+        return _sizeof(obj)
+
+    def test_plain_result(self):
+        attributes = {'member': ['cn=user{:d},o=org'.format(n)
+                                 for n in range(1000)]}
+        self.assertGreater(self._call_fut([('cn=g,o=org', attributes)]), 50000)
+
+    def test_case_insensitive_dict(self):
+        from ldap3.utils.ciDict import CaseInsensitiveDict
+        values = ['cn=user{:d},o=org'.format(n) for n in range(1000)]
+        attributes = CaseInsensitiveDict()
+        attributes['member'] = values
+        size = self._call_fut([('cn=g,o=org', attributes)])
+        self.assertGreater(size, 50000)
+        self.assertGreaterEqual(
+            size, self._call_fut([('cn=g,o=org', {'member': values})]) // 2)
+
+    def test_compact_attributes(self):
+        from pyramid_ldap3 import _LDAPAttributes, _LDAPEntry
+        values = ['cn=user{:d},o=org'.format(n) for n in range(1000)]
+        entry = _LDAPEntry('cn=g,o=org', _LDAPAttributes({'member': values}))
+        self.assertGreater(self._call_fut((entry,)), 50000)
+
+
+class TestLDAPCache(TestCase):
+
+    def _make_one(self, max_entries=0, max_bytes=0, jitter=0):
+        from pyramid_ldap3 import _LDAPCache
+        return _LDAPCache(max_entries, max_bytes, jitter)
+
+    def test_get_and_set(self):
+        inst = self._make_one()
+        self.assertIsNone(inst.get('foo'))
+        inst.set('foo', 'bar', 10)
+        self.assertEqual(inst.get('foo'), 'bar')
+        self.assertIn('foo', inst)
+        self.assertNotIn('baz', inst)
+        self.assertEqual(len(inst), 1)
+
+    def test_entries_expire_individually(self):
+        inst = self._make_one()
+        inst.set('foo', 'bar', 10, now=100)
+        inst.set('baz', 'qux', 20, now=105)
+        self.assertEqual(inst.get('foo', now=109), 'bar')
+        self.assertIsNone(inst.get('foo', now=110))
+        self.assertEqual(inst.get('baz', now=110), 'qux')
+        self.assertIsNone(inst.get('baz', now=125))
+        self.assertEqual(len(inst), 0)
+
+    def test_delete_and_clear(self):
+        inst = self._make_one()
+        inst.set('foo', 'bar', 10)
+        inst.set('baz', 'qux', 10)
+        inst.delete('foo')
+        inst.delete('foo')
+        self.assertIsNone(inst.get('foo'))
+        self.assertEqual(inst.get('baz'), 'qux')
+        inst.clear()
+        self.assertEqual(len(inst), 0)
+
+    def test_max_entries_evicts_least_recently_used(self):
+        inst = self._make_one(max_entries=2)
+        inst.set('a', 1, 10)
+        inst.set('b', 2, 10)
+        self.assertEqual(inst.get('a'), 1)
+        inst.set('c', 3, 10)
+        self.assertEqual(len(inst), 2)
+        self.assertEqual(inst.get('a'), 1)
+        self.assertIsNone(inst.get('b'))
+        self.assertEqual(inst.get('c'), 3)
+
+    def test_max_bytes(self):
+        inst = self._make_one(max_bytes=1000)
+        value = [('dn', {'attr': ['x' * 100]})]
+        for n in range(20):
+            inst.set(n, value, 10)
+            self.assertLessEqual(inst.size, 1000)
+        self.assertGreater(len(inst), 0)
+        self.assertLess(len(inst), 20)
+        self.assertEqual(inst.get(19), value)
+        self.assertIsNone(inst.get(0))
+        inst.clear()
+        self.assertEqual(inst.size, 0)
+
+    def test_jitter(self):
+        inst = self._make_one(jitter=0.5)
+        for n in range(20):
+            inst.set(n, n, 100, now=0)
+        expires = [inst.entries[n][1] for n in range(20)]
+        self.assertTrue(all(50 <= e <= 100 for e in expires))
+        self.assertGreater(len(set(expires)), 1)
+
+    def test_keep_stale_entries(self):
+        inst = self._make_one()
+        inst.set('foo', 'bar', 10, now=100, keep=5)
+        self.assertEqual(inst.lookup('foo', now=105), ('bar', 110))
+        self.assertEqual(inst.get('foo', now=105), 'bar')
+        self.assertEqual(inst.lookup('foo', now=112), ('bar', 110))
+        self.assertIsNone(inst.get('foo', now=112))
+        self.assertEqual(len(inst), 1)
+        self.assertIsNone(inst.lookup('foo', now=115))
+        self.assertEqual(len(inst), 0)
+
+    def test_concurrent_access(self):
+        inst = self._make_one(max_entries=48, max_bytes=100000)
+        errors = []
+
+        def work(offset):
+            try:
+                for n in range(2000):
+                    key = (n * 7 + offset) % 100
+                    if n % 5 == 0:
+                        inst.delete(key)
+                    elif inst.get(key) is None:
+                        inst.set(key, [('dn', {'n': [n]})], 10)
+            except Exception as e:  # pragma: no cover
+                errors.append(e)
+
+        threads = [Thread(target=work, args=(n,)) for n in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(10)
+        self.assertEqual(errors, [])
+        self.assertLessEqual(len(inst), 48)
+        shards = getattr(inst, 'shards', [inst])
+        for shard in shards:
+            self.assertEqual(
+                shard.size, sum(e[3] for e in shard.entries.values()))
+
+
+class TestStripedLDAPCache(TestLDAPCache):
+
+    def _make_one(self, max_entries=0, max_bytes=0, jitter=0, shards=1):
+        from pyramid_ldap3 import _StripedLDAPCache
+        return _StripedLDAPCache(max_entries, max_bytes, jitter, shards)
+
+    def test_jitter(self):
+        inst = self._make_one(jitter=0.5, shards=4)
+        for n in range(20):
+            inst.set(n, n, 100, now=0)
+        expires = [inst.lookup(n, now=0)[1] for n in range(20)]
+        self.assertTrue(all(50 <= e <= 100 for e in expires))
+        self.assertGreater(len(set(expires)), 1)
+
+    def test_max_bytes(self):
+        inst = self._make_one(max_bytes=1000)
+        value = [('dn', {'attr': ['x' * 100]})]
+        for n in range(20):
+            inst.set(n, value, 10)
+            self.assertLessEqual(inst.shards[0].size, 1000)
+        self.assertEqual(inst.get(19), value)
+        self.assertIsNone(inst.get(0))
+
+    def test_shards(self):
+        inst = self._make_one(max_entries=10, max_bytes=1000, shards=4)
+        self.assertEqual(len(inst.shards), 4)
+        self.assertEqual([s.max_entries for s in inst.shards], [3] * 4)
+        self.assertEqual([s.max_bytes for s in inst.shards], [250] * 4)
+        for n in range(100):
+            inst.set(n, n, 10)
+        self.assertLessEqual(len(inst), 12)
+        self.assertTrue(all(len(s) for s in inst.shards))
+        items = inst.items()
+        self.assertEqual(len(items), len(inst))
+        for key, value in items:
+            self.assertEqual(inst.get(key), value)
+        inst.clear()
+        self.assertEqual(len(inst), 0)
+
+    def test_concurrent_access(self):
+        from pyramid_ldap3 import _StripedLDAPCache
+        self._make_one = lambda max_entries, max_bytes: _StripedLDAPCache(
+            max_entries, max_bytes, shards=4)
+        super(TestStripedLDAPCache, self).test_concurrent_access()
+
+    def test_new_cache(self):
+        import pyramid_ldap3
+        from pyramid_ldap3 import _LDAPCache, _StripedLDAPCache, _new_cache
+        shards = pyramid_ldap3._CACHE_SHARDS
+        try:
+            pyramid_ldap3._CACHE_SHARDS = 1
+            self.assertIsInstance(_new_cache(100), _LDAPCache)
+            pyramid_ldap3._CACHE_SHARDS = 4
+            inst = _new_cache(100, 0, 0.1)
+            self.assertIsInstance(inst, _StripedLDAPCache)
+            self.assertEqual(len(inst.shards), 4)
+            self.assertEqual(inst.max_entries, 100)
+            self.assertEqual(inst.jitter, 0.1)
+        finally:
+            pyramid_ldap3._CACHE_SHARDS = shards
@@ -16,6 +16,7 @@ class TestLdapSetup(TestCase):
         request = DummyRequest()
         connector = config.req_method(request)
         self.assertEqual(connector.__class__, Connector)
+        self.assertEqual(connector.groups_memo, {})
         server = connector.manager.server
         import ldap3
         self.assertIsInstance(server, ldap3.Server)
@@ -87,3 +88,73 @@ class TestLdapSetup(TestCase):
         self.assertEqual(server.port, 389)
         self.assertFalse(server.tls)
         self.assertEqual(server.get_info, ldap3.NONE)
+
+    def test_it_bind_pool(self):
+        config = DummyConfig()
+        self._call_fut(
+            config, 'ldap://dummyhost',
+            bind_pool_size=5, bind_pool_lifetime=300)
+        request = DummyRequest()
+        connector = config.req_method(request)
+        bind_pool = connector.manager.bind_pool
+        self.assertEqual(bind_pool.size, 5)
+        self.assertEqual(bind_pool.lifetime, 300)
+
+    def test_it_warm_up(self):
+        from pyramid_ldap3 import ConnectionManager
+        calls = []
+        start_warm_up = ConnectionManager.start_warm_up
+        ConnectionManager.start_warm_up = lambda self, num: calls.append(num)
+        try:
+            config = DummyConfig()
+            self._call_fut(config, 'ldap://dummyhost')
+            config.req_method(DummyRequest())
+            self.assertEqual(calls, [])
+            self._call_fut(config, 'ldap://dummyhost', warm_up=4)
+            config.req_method(DummyRequest())
+            self.assertEqual(calls, [4])
+        finally:
+            ConnectionManager.start_warm_up = start_warm_up
+
+    def test_it_refresh_workers(self):
+        config = DummyConfig()
+        self._call_fut(
+            config, 'ldap://dummyhost', refresh_workers=3, max_refreshes=50)
+        connector = config.req_method(DummyRequest())
+        workers = connector.manager.refresh_workers
+        self.assertEqual(workers.size, 3)
+        self.assertEqual(workers.max_queued, 50)
+        self.assertEqual(workers.threads, 0)
+
+    def test_it_login_workers(self):
+        config = DummyConfig()
+        self._call_fut(config, 'ldap://dummyhost', login_workers=8)
+        self.assertEqual(config.registry.ldap_login_workers.size, 8)
+        self._call_fut(
+            config, 'ldap://dummyhost', realm='other', login_workers=4)
+        self.assertEqual(config.registry.ldap_login_workers.size, 8)
+        self._call_fut(
+            config, 'ldap://dummyhost', realm='another', login_workers=32)
+        self.assertEqual(config.registry.ldap_login_workers.size, 32)
+
+    def test_it_circuit_breaker(self):
+        config = DummyConfig()
+        self._call_fut(config, 'ldap://dummyhost')
+        connector = config.req_method(DummyRequest())
+        self.assertIsNone(connector.manager.breaker)
+        self.assertNotIn('circuit_breaker', config.introspectables[0])
+        config = DummyConfig()
+        self._call_fut(
+            config, 'ldap://dummyhost',
+            breaker_failures=3, breaker_reset_timeout=10)
+        connector = config.req_method(DummyRequest())
+        breaker = connector.manager.breaker
+        self.assertEqual(breaker.max_failures, 3)
+        self.assertEqual(breaker.reset_timeout, 10)
+        introspectable = config.introspectables[0]
+        self.assertTrue(
+            introspectable.title.startswith('uri=ldap://dummyhost,'))
+        self.assertIs(introspectable['circuit_breaker'], breaker)
+        breaker.failure()
+        self.assertTrue(str(introspectable['circuit_breaker']).startswith(
+            'state=closed, failures=1,'))
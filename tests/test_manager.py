@@ -1,4 +1,11 @@
-from . import TestCase, DummyLdap3
+import os
+
+from time import time
+
+import ldap3
+
+from . import (
+    TestCase, Dummy, DummyLdap3, DummyLdap3Connection, mock_manager)
 
 
 class TestConnectionManager(TestCase):
@@ -7,14 +14,14 @@ class TestConnectionManager(TestCase):
             self, uri,
             bind=None, passwd=None, tls=None,
             use_pool=True, pool_size=10, pool_lifetime=3600,
-            get_info=None, realm=None):
+            get_info=None, realm=None, **kw):
         from pyramid_ldap3 import ConnectionManager
         ldap3 = DummyLdap3()
         return ConnectionManager(
             uri, bind=bind, passwd=passwd, tls=tls,
             use_pool=use_pool, pool_size=pool_size,
             pool_lifetime=pool_lifetime,
-            get_info=get_info, ldap3=ldap3, realm=realm)
+            get_info=get_info, ldap3=ldap3, realm=realm, **kw)
 
     def test_uri(self):
         manager = self._make_one('testhost')
@@ -85,3 +92,675 @@ class TestConnectionManager(TestCase):
         conn = manager.connection('fred', 'flint')
         self.assertEqual(conn.user, 'fred')
         self.assertEqual(conn.password, 'flint')
+
+    def test_paged_connection(self):
+        from pyramid_ldap3 import ldap3
+        manager = self._make_one('testhost', 'fred', 'flint')
+        conn = manager.paged_connection()
+        self.assertEqual(conn.server.host, 'testhost')
+        self.assertEqual(conn.user, 'fred')
+        self.assertEqual(conn.password, 'flint')
+        self.assertEqual(conn.client_strategy, ldap3.ASYNC)
+        self.assertFalse(conn.auto_bind)
+        self.assertIsNot(manager.paged_connection(), conn)
+        manager = self._make_one('testhost', use_pool=False)
+        conn = manager.paged_connection()
+        self.assertEqual(conn.client_strategy, manager.strategy)
+
+    def test_async_connection(self):
+        from pyramid_ldap3 import ldap3
+        manager = self._make_one('testhost', 'fred', 'secret')
+        conn = manager.async_connection()
+        self.assertEqual(conn.server.host, 'testhost')
+        self.assertEqual(conn.user, 'fred')
+        self.assertEqual(conn.client_strategy, ldap3.ASYNC)
+        self.assertTrue(conn.auto_bind)
+        self.assertFalse(conn.closed)
+        self.assertTrue(conn.bound)
+        self.assertIsNot(manager.async_connection(), conn)
+        manager = self._make_one('testhost', use_pool=False)
+        conn = manager.async_connection()
+        self.assertEqual(conn.client_strategy, manager.strategy)
+
+    def test_no_bind_pool(self):
+        manager = self._make_one('testhost')
+        self.assertIsNone(manager.bind_pool)
+
+    def test_bind_pool(self):
+        manager = self._make_one(
+            'testhost', bind_pool_size=2, bind_pool_lifetime=600)
+        pool = manager.bind_pool
+        self.assertEqual(pool.size, 2)
+        self.assertEqual(pool.lifetime, 600)
+        self.assertEqual(len(pool), 0)
+        conn = manager.connection('fred', 'secret')
+        self.assertTrue(conn.bound)
+        self.assertEqual(conn.user, 'fred')
+        self.assertEqual(conn.server.host, 'testhost')
+        raw_conn = conn.conn
+        conn.unbind()
+        self.assertEqual(len(pool), 1)
+        self.assertFalse(raw_conn.closed)
+        with manager.connection('barney', 'secret') as conn:
+            self.assertIs(conn.conn, raw_conn)
+            self.assertEqual(conn.user, 'barney')
+            self.assertEqual(len(pool), 0)
+        self.assertEqual(len(pool), 1)
+        pool.clear()
+        self.assertEqual(len(pool), 0)
+        self.assertTrue(raw_conn.closed)
+
+    def test_bind_pool_invalid_credentials(self):
+        from pyramid_ldap3 import LDAPBindError
+        manager = self._make_one('testhost', bind_pool_size=1)
+        pool = manager.bind_pool
+        self.assertRaises(LDAPBindError, manager.connection, 'fred', 'wrong')
+        self.assertEqual(len(pool), 1)
+        conn = manager.connection('fred', 'secret')
+        self.assertTrue(conn.bound)
+        conn.unbind()
+        conn.unbind()
+        self.assertEqual(len(pool), 1)
+
+    def test_bind_pool_reconnects_closed_connection(self):
+        from ldap3.core.exceptions import LDAPSessionTerminatedByServerError
+        manager = self._make_one('testhost', bind_pool_size=1)
+        pool = manager.bind_pool
+        conn = manager.connection('fred', 'secret')
+        raw_conn = conn.conn
+        conn.unbind()
+
+        def rebind(user=None, password=None):
+            raise LDAPSessionTerminatedByServerError('idle timeout')
+
+        raw_conn.rebind = rebind  # the server has closed the idle connection
+        conn = manager.connection('fred', 'secret')
+        self.assertTrue(conn.bound)
+        self.assertIsNot(conn.conn, raw_conn)
+        self.assertTrue(raw_conn.closed)
+        conn.unbind()
+        self.assertEqual(len(pool), 1)
+
+    def test_bind_pool_new_connection_fails(self):
+        from ldap3.core.exceptions import LDAPSocketOpenError
+        manager = self._make_one('testhost', bind_pool_size=1)
+        manager.connection('fred', 'secret').unbind()
+        calls = []
+
+        def rebind(user=None, password=None):
+            calls.append(user)
+            raise LDAPSocketOpenError('down')
+
+        class Connection(DummyLdap3Connection):
+
+            def rebind(self, user=None, password=None):
+                return rebind(user, password)
+
+        manager.bind_pool.idle[0][1].rebind = rebind
+        manager.ldap3.Connection = Connection
+        self.assertRaises(
+            LDAPSocketOpenError, manager.connection, 'fred', 'secret')
+        self.assertEqual(calls, ['fred', 'fred'])
+        self.assertEqual(len(manager.bind_pool), 0)
+        self.assertRaises(
+            LDAPSocketOpenError, manager.connection, 'fred', 'secret')
+        self.assertEqual(len(calls), 3)
+        # the slots have been released
+        self.assertTrue(manager.bind_pool.slots.acquire(False))
+
+    def test_bind_pool_lifetime(self):
+        manager = self._make_one(
+            'testhost', bind_pool_size=1, bind_pool_lifetime=0)
+        pool = manager.bind_pool
+        conn = manager.connection('fred', 'secret')
+        raw_conn = conn.conn
+        conn.unbind()
+        self.assertEqual(len(pool), 0)
+        self.assertTrue(raw_conn.closed)
+        conn = manager.connection('fred', 'secret')
+        self.assertIsNot(conn.conn, raw_conn)
+        conn.unbind()
+
+    def test_warm_up(self):
+        manager = self._make_one('testhost', bind_pool_size=2)
+        connections = []
+        connect = manager.ldap3.Connection
+
+        def connection(*args, **kw):
+            conn = connect(*args, **kw)
+            connections.append(conn)
+            return conn
+
+        manager.ldap3.Connection = connection
+        manager.warm_up(3)
+        pool_conn = connections[0]
+        self.assertEqual(pool_conn.pool_name, 'pyramid_ldap3')
+        self.assertEqual(pool_conn.searches, 3)
+        self.assertEqual(len(manager.bind_pool), 2)
+        self.assertEqual(len(connections), 3)
+        self.assertFalse(any(conn.closed for conn in connections))
+        manager.warm_up(3)
+        self.assertEqual(len(manager.bind_pool), 2)
+        self.assertEqual(len(connections), 4)
+
+    def test_start_warm_up_once_per_process(self):
+        from threading import Event
+        manager = self._make_one('testhost')
+        calls = []
+        done = Event()
+
+        def warm_up(num):
+            calls.append(num)
+            done.set()
+
+        manager.warm_up = warm_up
+        manager.start_warm_up(2)
+        manager.start_warm_up(3)
+        self.assertTrue(done.wait(5))
+        self.assertEqual(calls, [2])
+        self.assertEqual(manager.warm_up_pid, os.getpid())
+
+    def test_after_fork(self):
+        from ldap3.strategy.reusable import ReusableStrategy
+        manager = self._make_one('testhost', bind_pool_size=1)
+        conn = manager.connection('fred', 'secret')
+        raw_conn = conn.conn
+        conn.unbind()
+        pool = manager.bind_pool
+        self.assertEqual(len(pool), 1)
+        ReusableStrategy.pools[manager.pool_name] = 'inherited pool'
+        manager.pid = -1  # pretend that we are in a forked process
+        try:
+            conn = manager.connection('fred', 'secret')
+            self.assertNotIn(manager.pool_name, ReusableStrategy.pools)
+        finally:
+            ReusableStrategy.pools.pop(manager.pool_name, None)
+        self.assertIsNot(conn.conn, raw_conn)
+        self.assertFalse(raw_conn.closed)
+        self.assertEqual(manager.pid, os.getpid())
+
+
+class TestServerPool(TestCase):
+
+    def _make_one(self, num=3, **kw):
+        from pyramid_ldap3 import _ServerPool
+        servers = [DummyPoolServer('host{:d}'.format(n)) for n in range(num)]
+        kw.setdefault('active', False)
+        return _ServerPool(servers, **kw)
+
+    def test_unmeasured_servers_are_not_preferred(self):
+        pool = self._make_one()
+        servers = pool.servers
+        pool.success(servers[0], 0.5)
+        pool.success(servers[2], 0.1)
+        self.assertIs(pool.get_server(), servers[2])
+        self.assertIs(pool.selected_server(), servers[2])
+        pool.failure(servers[0])
+        pool.failure(servers[0])
+        pool.failure(servers[0])
+        pool.failure(servers[2])
+        pool.failure(servers[2])
+        pool.failure(servers[2])
+        self.assertIs(pool.get_server(), servers[1])
+
+    def test_unavailable_server_is_skipped(self):
+        pool = self._make_one(max_errors=1, active=True)
+        servers = pool.servers
+        pool.success(servers[0], 0.1)
+        pool.success(servers[1], 0.2)
+        servers[0].available = False
+        self.assertIs(pool.get_server(), servers[1])
+        self.assertIs(pool.selected_server(), servers[1])
+        self.assertEqual(servers[0].checks, 1)
+        stats = pool.server_stats()
+        self.assertEqual(stats['host0:389']['quarantines'], 1)
+        self.assertEqual(stats['host1:389']['successes'], 2)
+        self.assertIs(pool.get_server(), servers[1])
+        self.assertEqual(servers[0].checks, 1)
+
+    def test_no_server_available(self):
+        pool = self._make_one(2, active=True)
+        servers = pool.servers
+        for server in servers:
+            server.available = False
+        self.assertIn(pool.get_server(), servers)
+        self.assertEqual([server.checks for server in servers], [1, 1])
+        stats = pool.server_stats()
+        self.assertEqual(stats['host0:389']['failures'], 1)
+        self.assertEqual(stats['host1:389']['failures'], 1)
+
+    def test_fastest_server_is_selected(self):
+        pool = self._make_one(decay=0.5)
+        servers = pool.servers
+        pool.success(servers[0], 0.2)
+        pool.success(servers[1], 0.1)
+        pool.success(servers[2], 0.4)
+        self.assertIs(pool.get_server(), servers[1])
+        pool.success(servers[1], 0.5)  # average is now 0.3
+        self.assertIs(pool.get_server(), servers[0])
+        stats = pool.server_stats()
+        self.assertEqual(list(stats), ['host0:389', 'host1:389', 'host2:389'])
+        self.assertAlmostEqual(stats['host1:389']['latency'], 0.3)
+        self.assertEqual(stats['host1:389']['successes'], 2)
+
+    def test_quarantine_with_backoff(self):
+        pool = self._make_one(
+            2, max_errors=2, quarantine=10, max_quarantine=30)
+        servers = pool.servers
+        pool.success(servers[0], 0.1)
+        pool.success(servers[1], 0.2)
+        pool.failure(servers[0])
+        self.assertIs(pool.get_server(), servers[0])
+        pool.failure(servers[0])
+        self.assertIs(pool.get_server(), servers[1])
+        stats = pool.server_stats()['host0:389']
+        self.assertEqual(stats['errors'], 2)
+        self.assertEqual(stats['failures'], 2)
+        self.assertEqual(stats['quarantines'], 1)
+        self.assertAlmostEqual(stats['until'], time() + 10, delta=1)
+        for quarantine in (20, 30, 30):
+            pool.failure(servers[0])
+            stats = pool.server_stats()['host0:389']
+            self.assertAlmostEqual(
+                stats['until'], time() + quarantine, delta=1)
+        pool.success(servers[0], 0.1)
+        stats = pool.server_stats()['host0:389']
+        self.assertEqual(stats['errors'], 0)
+        self.assertEqual(stats['quarantines'], 0)
+        self.assertEqual(stats['until'], 0)
+        self.assertIs(pool.get_server(), servers[0])
+
+    def test_all_servers_in_quarantine(self):
+        pool = self._make_one(2, max_errors=1, quarantine=10)
+        servers = pool.servers
+        pool.failure(servers[1])
+        pool.failure(servers[0])
+        pool.failure(servers[0])
+        self.assertIs(pool.get_server(), servers[1])
+
+    def test_unknown_server_is_ignored(self):
+        import ldap3
+        pool = self._make_one()
+        pool.success(ldap3.Server('other'), 0.1)
+        pool.failure(ldap3.Server('other'))
+        self.assertFalse(any(
+            stats['successes'] or stats['failures']
+            for stats in pool.server_stats().values()))
+
+    def test_check(self):
+        from pyramid_ldap3 import LDAPException
+        pool = self._make_one(2, max_errors=1)
+
+        class Connection(DummyLdap3Connection):
+
+            def open(self):
+                if self.server.host == 'host1':
+                    raise LDAPException('down')
+
+        pool.check(Connection)
+        stats = pool.server_stats()
+        self.assertEqual(stats['host0:389']['successes'], 1)
+        self.assertIsNotNone(stats['host0:389']['latency'])
+        self.assertEqual(stats['host1:389']['failures'], 1)
+        self.assertEqual(stats['host1:389']['quarantines'], 1)
+
+    def test_start_without_interval(self):
+        pool = self._make_one()
+        pool.start()
+        self.assertIsNone(pool.thread)
+
+    def test_start_and_stop(self):
+        pool = self._make_one(check_interval=3600)
+        pool.start()
+        thread = pool.thread
+        self.assertTrue(thread.is_alive())
+        pool.start()
+        self.assertIs(pool.thread, thread)
+        pool.stop()
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+
+    def test_manager(self):
+        import ldap3
+        from pyramid_ldap3 import ConnectionManager, _ServerPool
+        manager = ConnectionManager(
+            'ldap://host0 ldap://host1', use_pool=False, bind_pool_size=1,
+            latency_aware=True, quarantine_errors=1)
+        self.assertIsInstance(manager.server, _ServerPool)
+        self.assertTrue(manager.server.active)
+        self.assertIs(manager.server_pool, manager.server)
+        self.assertIs(manager.bind_pool.server_pool, manager.server)
+        manager.server.active = False  # do not probe the servers
+        servers = manager.server.servers
+
+        class Connection(DummyLdap3Connection):
+
+            def __init__(self, server, **kw):
+                server = server.get_server()
+                if server is servers[0]:
+                    raise ldap3.core.exceptions.LDAPSocketOpenError('down')
+                super(Connection, self).__init__(server, **kw)
+
+        manager.ldap3 = Dummy()
+        manager.ldap3.Connection = Connection
+        manager.server.success(servers[0], 0.05)
+        manager.server.success(servers[1], 0.1)
+        self.assertRaises(
+            ldap3.core.exceptions.LDAPSocketOpenError, manager.connection)
+        self.assertEqual(manager.server_pool.server_stats()[
+            'host0:389']['quarantines'], 1)
+        conn = manager.connection()
+        self.assertIs(conn.server, servers[1])
+        self.assertEqual(manager.server_pool.server_stats()[
+            'host1:389']['successes'], 2)
+
+    def test_manager_not_latency_aware(self):
+        import ldap3
+        from pyramid_ldap3 import ConnectionManager, _ServerPool
+        manager = ConnectionManager('ldap://host0 ldap://host1')
+        self.assertIsInstance(manager.server, ldap3.ServerPool)
+        self.assertNotIsInstance(manager.server, _ServerPool)
+        self.assertIsNone(manager.server_pool)
+        manager = ConnectionManager('ldap://host0', latency_aware=True)
+        self.assertIsNone(manager.server_pool)
+
+
+class DummyPoolServer(ldap3.Server):
+
+    available = True
+    checks = 0
+
+    def check_availability(self, *args, **kw):
+        self.checks += 1
+        return self.available
+
+
+class DummyHedgeConnection(object):
+
+    def __init__(self, delay=0, response=None, server=None):
+        self.delay = delay
+        self.response = response
+        self.server = server
+        self.searches = []
+        self.unbound = False
+
+    def search(self, base_dn, filter_str, **kw):
+        self.searches.append((base_dn, filter_str, kw))
+        return 1
+
+    def get_response(self, msg_id, timeout=None):
+        from time import sleep
+        from pyramid_ldap3 import _LDAPResponseTimeoutError
+        if timeout is not None and timeout < self.delay:
+            sleep(timeout)
+            raise _LDAPResponseTimeoutError('no response')
+        sleep(self.delay)
+        if isinstance(self.response, Exception):
+            raise self.response
+        return self.response, {'result': 0}
+
+    def unbind(self):
+        self.unbound = True
+
+
+class TestHedger(TestCase):
+
+    def _make_one(self, hedge_conn=None, **kw):
+        from pyramid_ldap3 import _Hedger
+        manager = Dummy()
+        manager.hedge_connection = lambda conn: hedge_conn
+        hedger = _Hedger(manager, **kw)
+        for _n in range(100):
+            hedger.record(0.01)
+        return hedger
+
+    def test_delay(self):
+        from pyramid_ldap3 import _Hedger
+        hedger = _Hedger(None, percentile=90)
+        for n in range(19):
+            hedger.record(n / 100.0)
+        self.assertIsNone(hedger.delay)
+        hedger.record(0.19)
+        self.assertEqual(hedger.delay, 0.18)
+
+    def test_fast_search_is_not_hedged(self):
+        hedge_conn = DummyHedgeConnection(response=['hedged'])
+        hedger = self._make_one(hedge_conn)
+        conn = DummyHedgeConnection(response=['first'])
+        self.assertEqual(
+            hedger.get_response(conn, 1, 'o=org', '(cn=fred)')[0], ['first'])
+        self.assertFalse(hedge_conn.searches)
+        self.assertEqual(hedger.searches, 101)
+        self.assertEqual(hedger.hedged, 0)
+
+    def test_slow_search_is_hedged(self):
+        hedge_conn = DummyHedgeConnection(response=['hedged'])
+        hedger = self._make_one(hedge_conn)
+        conn = DummyHedgeConnection(0.5, response=['first'])
+        self.assertEqual(hedger.get_response(
+            conn, 1, 'o=org', '(cn=fred)', attributes=['cn'])[0], ['hedged'])
+        self.assertEqual(hedge_conn.searches, [
+            ('o=org', '(cn=fred)', {'attributes': ['cn']})])
+        self.assertTrue(hedge_conn.unbound)
+        self.assertEqual(hedger.hedged, 1)
+        self.assertEqual(hedger.won, 1)
+        self.assertIn('hedged=1', str(hedger))
+
+    def test_failed_hedge_is_ignored(self):
+        from pyramid_ldap3 import LDAPException
+        hedge_conn = DummyHedgeConnection(response=LDAPException('down'))
+        hedger = self._make_one(hedge_conn)
+        conn = DummyHedgeConnection(0.1, response=['first'])
+        self.assertEqual(
+            hedger.get_response(conn, 1, 'o=org', '(cn=fred)')[0], ['first'])
+        self.assertEqual(hedger.hedged, 1)
+        self.assertEqual(hedger.won, 0)
+
+    def test_both_searches_fail(self):
+        from pyramid_ldap3 import LDAPException
+        hedge_conn = DummyHedgeConnection(response=LDAPException('down'))
+        hedger = self._make_one(hedge_conn)
+        conn = DummyHedgeConnection(0.1, response=LDAPException('down'))
+        self.assertRaises(
+            LDAPException, hedger.get_response, conn, 1, 'o=org', '(cn=x)')
+
+    def test_budget(self):
+        hedge_conn = DummyHedgeConnection(response=['hedged'])
+        hedger = self._make_one(hedge_conn, budget=0.01)
+        self.assertAlmostEqual(hedger.tokens, 1)
+        conn = DummyHedgeConnection(0.05, response=['first'])
+        self.assertEqual(
+            hedger.get_response(conn, 1, 'o=org', '(cn=fred)')[0], ['hedged'])
+        self.assertLess(hedger.tokens, 1)
+        self.assertEqual(
+            hedger.get_response(conn, 1, 'o=org', '(cn=fred)')[0], ['first'])
+        self.assertEqual(hedger.hedged, 1)
+
+
+class TestHedgeConnection(TestCase):
+
+    def test_no_hedging_by_default(self):
+        from pyramid_ldap3 import ConnectionManager
+        manager = ConnectionManager('ldap://host0 ldap://host1')
+        self.assertIsNone(manager.hedger)
+        manager = ConnectionManager('ldap://host0', hedge_percentile=95)
+        self.assertIsNone(manager.hedger)
+
+    def test_hedge_connection_uses_other_server(self):
+        from pyramid_ldap3 import ConnectionManager
+        for latency_aware in (False, True):
+            manager = ConnectionManager(
+                'ldap://host0 ldap://host1', use_pool=False,
+                latency_aware=latency_aware, hedge_percentile=95)
+            self.assertEqual(manager.hedger.percentile, 95)
+            manager.ldap3 = DummyLdap3()
+            servers = manager.server.servers
+            for server in servers:
+                conn = manager.hedge_connection(
+                    DummyHedgeConnection(server=server))
+                self.assertIsNot(conn.server, server)
+                self.assertIn(conn.server, servers)
+
+    def test_hedge_connection_with_reusable_pool(self):
+        from pyramid_ldap3 import ConnectionManager
+        manager = ConnectionManager(
+            'ldap://host0 ldap://host1', latency_aware=True,
+            hedge_percentile=95)
+        manager.ldap3 = DummyLdap3()
+        servers = manager.server.servers
+        manager.server.success(servers[1], 0.1)
+        manager.server.success(servers[0], 0.2)
+        conn = manager.hedge_connection(
+            DummyHedgeConnection(server=servers[0]))
+        self.assertIs(conn.server, servers[0])
+
+
+class TestCircuitBreaker(TestCase):
+
+    def _make_one(self, max_failures=2, reset_timeout=30):
+        from pyramid_ldap3 import _CircuitBreaker
+        return _CircuitBreaker(max_failures, reset_timeout)
+
+    def test_opens_after_consecutive_failures(self):
+        from pyramid_ldap3 import LDAPCircuitOpenError
+        breaker = self._make_one(3)
+        self.assertEqual(breaker.state, 'closed')
+        breaker.failure()
+        breaker.failure()
+        breaker.success()
+        breaker.failure()
+        breaker.failure()
+        breaker.allow()
+        self.assertEqual(breaker.state, 'closed')
+        breaker.failure()
+        self.assertEqual(breaker.state, 'open')
+        self.assertRaises(LDAPCircuitOpenError, breaker.allow)
+        self.assertRaises(LDAPCircuitOpenError, breaker.allow)
+        self.assertEqual(breaker.trips, 1)
+        self.assertEqual(breaker.rejected, 2)
+        self.assertEqual(
+            str(breaker), 'state=open, failures=3, max_failures=3, '
+            'reset_timeout=30, trips=1, rejected=2')
+
+    def test_probe_after_reset_timeout(self):
+        from pyramid_ldap3 import LDAPCircuitOpenError
+        breaker = self._make_one(1)
+        breaker.failure()
+        breaker.opened -= 30
+        breaker.allow()  # the probe
+        self.assertEqual(breaker.state, 'half-open')
+        self.assertRaises(LDAPCircuitOpenError, breaker.allow)
+        breaker.success()
+        self.assertEqual(breaker.state, 'closed')
+        self.assertEqual(breaker.failures, 0)
+        breaker.allow()
+
+    def test_failed_probe(self):
+        from pyramid_ldap3 import LDAPCircuitOpenError
+        breaker = self._make_one(1)
+        breaker.failure()
+        breaker.opened -= 30
+        breaker.allow()
+        breaker.failure()
+        self.assertEqual(breaker.state, 'open')
+        self.assertRaises(LDAPCircuitOpenError, breaker.allow)
+        self.assertEqual(breaker.trips, 1)
+
+    def test_lost_probe_is_repeated(self):
+        breaker = self._make_one(1)
+        breaker.failure()
+        breaker.opened -= 60
+        breaker.allow()
+        breaker.probing -= 30
+        breaker.allow()
+        self.assertEqual(breaker.state, 'half-open')
+
+    def _manager(self, connection_class, **kw):
+        from pyramid_ldap3 import ConnectionManager
+        manager = ConnectionManager(
+            'testhost', ldap3=DummyLdap3(), breaker_failures=2, **kw)
+        manager.ldap3.Connection = connection_class
+        return manager
+
+    def test_manager_fails_fast(self):
+        from ldap3.core.exceptions import LDAPSocketOpenError
+        from pyramid_ldap3 import LDAPCircuitOpenError
+        calls = []
+
+        class Connection(DummyLdap3Connection):
+
+            def __init__(self, *args, **kw):
+                calls.append(args)
+                raise LDAPSocketOpenError('down')
+
+        manager = self._manager(Connection)
+        self.assertEqual(manager.breaker.max_failures, 2)
+        self.assertEqual(manager.breaker.reset_timeout, 30)
+        self.assertRaises(LDAPSocketOpenError, manager.connection)
+        self.assertRaises(LDAPSocketOpenError, manager.connection)
+        self.assertRaises(LDAPCircuitOpenError, manager.connection)
+        self.assertRaises(
+            LDAPCircuitOpenError, manager.connection, 'fred', 'secret')
+        self.assertEqual(len(calls), 2)
+
+    def test_manager_records_errors_in_context(self):
+        from ldap3.core.exceptions import LDAPSessionTerminatedByServerError
+        manager = self._manager(DummyLdap3Connection)
+        breaker = manager.breaker
+        for _n in range(2):
+            try:
+                with manager.connection() as conn:
+                    self.assertIsNone(conn.user)
+                    raise LDAPSessionTerminatedByServerError('gone')
+            except LDAPSessionTerminatedByServerError:
+                pass
+        self.assertEqual(breaker.state, 'open')
+        breaker.opened -= 30
+        with manager.connection() as conn:
+            self.assertEqual(breaker.state, 'half-open')
+            conn.search('o=org', '(cn=fred)')
+        self.assertEqual(breaker.state, 'closed')
+
+    def test_manager_records_errors_when_binding_in_context(self):
+        from ldap3.core.exceptions import LDAPSocketOpenError
+
+        class Connection(DummyLdap3Connection):
+
+            def __enter__(self):
+                raise LDAPSocketOpenError('down')
+
+        manager = self._manager(Connection)
+        for _n in range(2):
+            try:
+                with manager.paged_connection():
+                    pass  # pragma: no cover
+            except LDAPSocketOpenError:
+                pass
+        self.assertEqual(manager.breaker.state, 'open')
+
+    def test_manager_invalid_credentials_are_no_failures(self):
+        from pyramid_ldap3 import LDAPBindError
+        manager = self._manager(DummyLdap3Connection, bind_pool_size=1)
+        breaker = manager.breaker
+        breaker.failure()
+        self.assertRaises(
+            LDAPBindError, manager.connection, 'fred', 'wrong')
+        self.assertEqual(breaker.failures, 0)
+        breaker.failure()
+        manager.connection('fred', 'secret').unbind()
+        self.assertEqual(breaker.failures, 0)
+        self.assertEqual(len(manager.bind_pool), 1)
+
+    def test_stale_result_while_circuit_is_open(self):
+        from pyramid_ldap3 import _CircuitBreaker, _LDAPQuery
+        manager = mock_manager({})
+        manager.breaker = _CircuitBreaker(1, 60)
+        manager.breaker.failure()
+        query = _LDAPQuery(
+            'o=org', '(cn=%(login)s)', 'SUBTREE', None, 10,
+            stale_if_error=60)
+        query.cache.set(('o=org', '(cn=fred)'), [('cn=fred,o=org', {})], 10,
+                        now=time() - 30, keep=60)
+        self.assertEqual(query.execute(manager, login='fred'),
+                         [('cn=fred,o=org', {})])
+        self.assertEqual(manager.breaker.rejected, 1)
@@ -9,6 +9,7 @@ class TestLdapSetGroupsQuery(TestCase):
 
     def test_it_defaults(self):
         import ldap3
+        from pyramid_ldap3 import _LDAPDNQuery
         config = DummyConfig()
         self._call_fut(config, 'dn', 'tmpl')
         ldap_groups_query = getattr(config.registry, 'ldap_groups_query', None)
@@ -17,6 +18,59 @@ class TestLdapSetGroupsQuery(TestCase):
         self.assertEqual(ldap_groups_query.filter_tmpl, 'tmpl')
         self.assertEqual(ldap_groups_query.scope, ldap3.SUBTREE)
         self.assertEqual(ldap_groups_query.cache_period, 0)
+        self.assertIsNone(ldap_groups_query.graph)
+        self.assertIsNone(ldap_groups_query.dn_query)
+        self._call_fut(config, 'dn', 'tmpl', attributes=['cn'])
+        ldap_groups_query = getattr(config.registry, 'ldap_groups_query', None)
+        self.assertIs(ldap_groups_query.dn_query.__class__, _LDAPDNQuery)
+        self.assertIsNone(ldap_groups_query.dn_query.attributes)
+
+    def test_it_nested(self):
+        config = DummyConfig()
+        self._call_fut(
+            config, 'dn', 'tmpl', nested=True, nested_cache_period=300)
+        ldap_groups_query = getattr(config.registry, 'ldap_groups_query', None)
+        graph = ldap_groups_query.graph
+        self.assertIs(graph.query, ldap_groups_query)
+        self.assertIsNone(ldap_groups_query.dn_query)
+        self.assertEqual(graph.cache_period, 300)
+        self.assertIn('nested=(cache_period=300', str(ldap_groups_query))
+
+    def test_it_cache(self):
+        config = DummyConfig()
+        self._call_fut(
+            config, 'dn', 'tmpl', cache_period=600,
+            cache_size=100, cache_bytes=10000, cache_jitter=0.1)
+        ldap_groups_query = getattr(config.registry, 'ldap_groups_query', None)
+        self.assertEqual(ldap_groups_query.cache_period, 600)
+        cache = ldap_groups_query.cache
+        self.assertEqual(cache.max_entries, 100)
+        self.assertEqual(cache.max_bytes, 10000)
+        self.assertEqual(cache.jitter, 0.1)
+
+    def test_it_paged(self):
+        config = DummyConfig()
+        self._call_fut(config, 'dn', 'tmpl', page_size=500, time_limit=10)
+        ldap_groups_query = getattr(config.registry, 'ldap_groups_query', None)
+        self.assertEqual(ldap_groups_query.page_size, 500)
+        self.assertEqual(ldap_groups_query.time_limit, 10)
+        self.assertIn('page_size=500, time_limit=10', str(ldap_groups_query))
+
+    def test_it_compact(self):
+        config = DummyConfig()
+        self._call_fut(config, 'dn', 'tmpl', compact=True)
+        ldap_groups_query = getattr(config.registry, 'ldap_groups_query', None)
+        self.assertTrue(ldap_groups_query.compact)
+
+    def test_it_negative_cache(self):
+        config = DummyConfig()
+        self._call_fut(
+            config, 'dn', 'tmpl', cache_period=600,
+            negative_cache_period=60, negative_cache_size=50)
+        ldap_groups_query = getattr(config.registry, 'ldap_groups_query', None)
+        self.assertEqual(ldap_groups_query.negative_cache_period, 60)
+        self.assertEqual(ldap_groups_query.negative_cache.max_entries, 50)
+        self.assertIn('negative_cache_period=60', str(ldap_groups_query))
 
     def test_it_realm(self):
         import ldap3
@@ -59,3 +113,87 @@ class TestLdapSetLoginQuery(TestCase):
         self.assertEqual(ldap_login_query.filter_tmpl, 'tmpl_test')
         self.assertEqual(ldap_login_query.scope, ldap3.LEVEL)
         self.assertEqual(ldap_login_query.cache_period, 0)
+
+
+class TestLdapSetLoginDn(TestCase):
+
+    def _call_fut(self, config, dn_tmpl, **kw):
+        from pyramid_ldap3 import ldap_set_login_dn
+        return ldap_set_login_dn(config, dn_tmpl, **kw)
+
+    def test_it_defaults(self):
+        from pyramid_ldap3 import _LDAPLoginBind
+        config = DummyConfig()
+        self._call_fut(config, 'uid=%(login)s')
+        ldap_login_query = getattr(config.registry, 'ldap_login_query', None)
+        self.assertIsInstance(ldap_login_query, _LDAPLoginBind)
+        self.assertEqual(ldap_login_query.dn_tmpl, 'uid=%(login)s')
+        self.assertIsNone(ldap_login_query.attributes)
+
+    def test_it_realm(self):
+        config = DummyConfig()
+        self._call_fut(
+            config, 'uid=%(login)s', attributes=['cn'], realm='test')
+        ldap_login_query = getattr(
+            config.registry, 'ldap_login_query_test', None)
+        self.assertIsNotNone(ldap_login_query)
+        self.assertEqual(ldap_login_query.attributes, ['cn'])
+
+
+class TestLdapSetGroupsAttribute(TestCase):
+
+    def _call_fut(self, config, **kw):
+        from pyramid_ldap3 import ldap_set_groups_attribute
+        return ldap_set_groups_attribute(config, **kw)
+
+    def test_it_defaults(self):
+        from pyramid_ldap3 import _LDAPGroupsAttribute
+        config = DummyConfig()
+        self._call_fut(config)
+        ldap_groups_query = getattr(config.registry, 'ldap_groups_query', None)
+        self.assertIsInstance(ldap_groups_query, _LDAPGroupsAttribute)
+        self.assertEqual(ldap_groups_query.attribute, 'memberOf')
+        self.assertEqual(ldap_groups_query.cache_period, 0)
+
+    def test_it_realm(self):
+        config = DummyConfig()
+        self._call_fut(
+            config, attribute='isMemberOf', cache_period=600, realm='test')
+        ldap_groups_query = getattr(
+            config.registry, 'ldap_groups_query_test', None)
+        self.assertIsNotNone(ldap_groups_query)
+        self.assertEqual(ldap_groups_query.attribute, 'isMemberOf')
+        self.assertEqual(ldap_groups_query.cache_period, 600)
+
+
+class TestLdapSetGroupsIndex(TestCase):
+
+    def _call_fut(self, config, base_dn, **kw):
+        from pyramid_ldap3 import ldap_set_groups_index
+        return ldap_set_groups_index(config, base_dn, **kw)
+
+    def test_it_defaults(self):
+        from pyramid_ldap3 import _LDAPGroupsIndex, ldap3
+        config = DummyConfig()
+        self._call_fut(config, 'dn')
+        ldap_groups_query = getattr(config.registry, 'ldap_groups_query', None)
+        self.assertIsInstance(ldap_groups_query, _LDAPGroupsIndex)
+        self.assertEqual(ldap_groups_query.base_dn, 'dn')
+        self.assertEqual(ldap_groups_query.group_filter, '(objectClass=group)')
+        self.assertEqual(ldap_groups_query.scope, ldap3.SUBTREE)
+        self.assertEqual(ldap_groups_query.member_attribute, 'member')
+        self.assertIsNone(ldap_groups_query.attributes)
+        self.assertEqual(ldap_groups_query.refresh_period, 600)
+        self.assertEqual(ldap_groups_query.page_size, 500)
+
+    def test_it_realm(self):
+        config = DummyConfig()
+        self._call_fut(
+            config, 'dn', group_filter='(objectClass=groupOfNames)',
+            refresh_period=60, realm='test')
+        ldap_groups_query = getattr(
+            config.registry, 'ldap_groups_query_test', None)
+        self.assertIsNotNone(ldap_groups_query)
+        self.assertEqual(
+            ldap_groups_query.group_filter, '(objectClass=groupOfNames)')
+        self.assertEqual(ldap_groups_query.refresh_period, 60)
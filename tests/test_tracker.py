@@ -0,0 +1,139 @@
+from . import TestCase, Dummy, DummyConfig, DummyRequest, mock_manager
+
+
+class TestChangeTracker(TestCase):
+
+    entries = {
+        'cn=fred,o=org': {
+            'objectClass': 'person', 'modifyTimestamp': '20240101000000Z'},
+        'cn=barney,o=org': {
+            'objectClass': 'person', 'modifyTimestamp': '20240101000000Z'},
+        'cn=a,o=org': {
+            'objectClass': 'groupOfNames', 'member': ['cn=fred,o=org'],
+            'modifyTimestamp': '20240101000000Z'},
+        'cn=b,o=org': {
+            'objectClass': 'groupOfNames', 'member': ['cn=barney,o=org'],
+            'modifyTimestamp': '20240101000000Z'}}
+
+    def setUp(self):
+        from pyramid_ldap3 import _LDAPQuery
+        self.manager = mock_manager(self.entries)
+        self.registry = Dummy()
+        self.login_query = _LDAPQuery(
+            'o=org', '(&(objectClass=person)(cn=%(login)s))',
+            'SUBTREE', ['cn'], 600)
+        self.groups_query = _LDAPQuery(
+            'o=org', '(&(objectClass=groupOfNames)(member=%(userdn)s))',
+            'SUBTREE', ['cn'], 600)
+        self.registry.ldap_login_query = self.login_query
+        self.registry.ldap_groups_query = self.groups_query
+
+    def _make_one(self, **kw):
+        from pyramid_ldap3 import _ChangeTracker
+        return _ChangeTracker(self.manager, self.registry, 'o=org', **kw)
+
+    def _modify(self, dn, timestamp, **changes):
+        import ldap3
+        changes['modifyTimestamp'] = [timestamp]
+        conn = ldap3.Connection(
+            self.manager.server, 'cn=admin,o=org', 'secret',
+            client_strategy=ldap3.MOCK_SYNC)
+        conn.bind()
+        conn.modify(dn, dict(
+            (key, [(ldap3.MODIFY_REPLACE, value)])
+            for key, value in changes.items()))
+
+    def _fill_caches(self):
+        for login in ('fred', 'barney'):
+            self.login_query.execute(self.manager, login=login)
+        for userdn in ('cn=fred,o=org', 'cn=barney,o=org'):
+            self.groups_query.execute(self.manager, userdn=userdn)
+        self.assertEqual(len(self.login_query.cache), 2)
+        self.assertEqual(len(self.groups_query.cache), 2)
+
+    def test_initial_value(self):
+        inst = self._make_one()
+        value = inst.initial_value()
+        self.assertEqual(len(value), 15)
+        self.assertTrue(value.endswith('Z'))
+
+    def test_poll_without_changes(self):
+        inst = self._make_one()
+        inst.last_value = '20240601000000Z'
+        self._fill_caches()
+        self.assertEqual(inst.poll(), set())
+        self.assertEqual(len(self.login_query.cache), 2)
+        self.assertEqual(len(self.groups_query.cache), 2)
+
+    def test_poll_with_changed_user(self):
+        inst = self._make_one()
+        inst.last_value = '20240601000000Z'
+        self._fill_caches()
+        self._modify('cn=fred,o=org', '20240701000000Z')
+        self.assertEqual(inst.poll(), set(['cn=fred,o=org']))
+        self.assertEqual(inst.last_value, '20240701000000Z')
+        self.assertIsNone(self.login_query.query_cache(
+            ('o=org', '(&(objectClass=person)(cn=fred))')))
+        self.assertIsNotNone(self.login_query.query_cache(
+            ('o=org', '(&(objectClass=person)(cn=barney))')))
+        self.assertIsNone(self.groups_query.query_cache(
+            ('o=org', '(&(objectClass=groupOfNames)(member=cn=fred,o=org))')))
+        self.assertIsNotNone(self.groups_query.query_cache(
+            ('o=org',
+             '(&(objectClass=groupOfNames)(member=cn=barney,o=org))')))
+        self.assertEqual(inst.poll(), set())
+
+    def test_poll_with_changed_group(self):
+        inst = self._make_one()
+        inst.last_value = '20240601000000Z'
+        self._fill_caches()
+        self._modify('cn=b,o=org', '20240701000000Z',
+                     member=['cn=barney,o=org', 'cn=fred,o=org'])
+        self.assertEqual(inst.poll(), set(['cn=b,o=org']))
+        self.assertEqual(len(self.login_query.cache), 2)
+        self.assertEqual(len(self.groups_query.cache), 0)
+        result = self.groups_query.execute(
+            self.manager, userdn='cn=fred,o=org')
+        self.assertEqual(sorted(r[0] for r in result), [
+            'cn=a,o=org', 'cn=b,o=org'])
+
+
+class TestLdapSetupTracker(TestCase):
+
+    def test_without_tracker(self):
+        from pyramid_ldap3 import ldap_setup
+        config = DummyConfig()
+        ldap_setup(config, 'ldap://dummyhost')
+        connector = config.req_method(DummyRequest())
+        self.assertIsNone(connector.manager.tracker)
+
+    def test_without_base_dn(self):
+        from pyramid_ldap3 import ldap_setup, ConfigurationError
+        config = DummyConfig()
+        self.assertRaises(
+            ConfigurationError, ldap_setup, config, 'ldap://dummyhost',
+            track_changes=60)
+
+    def test_with_tracker(self):
+        from pyramid_ldap3 import ldap_setup
+        config = DummyConfig()
+        ldap_setup(config, 'ldap://dummyhost', track_changes=3600,
+                   track_base_dn='o=org', track_attribute='uSNChanged',
+                   realm='test')
+        connector = config.req_method(DummyRequest())
+        tracker = connector.manager.tracker
+        try:
+            self.assertIs(tracker.registry, config.registry)
+            self.assertEqual(tracker.interval, 3600)
+            self.assertEqual(tracker.base_dn, 'o=org')
+            self.assertEqual(tracker.attribute, 'uSNChanged')
+            self.assertEqual(tracker.query_identifiers, [
+                'ldap_login_query_test', 'ldap_groups_query_test'])
+            thread = tracker.thread
+            self.assertTrue(thread.is_alive())
+            config.req_method(DummyRequest())
+            self.assertIs(tracker.thread, thread)
+        finally:
+            tracker.stop()
+        tracker.thread.join(5)
+        self.assertFalse(tracker.thread.is_alive())